@@ -1,3 +1,10 @@
+import copy
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List
+
 import torch
 
 from ..utils import utils
@@ -19,30 +26,62 @@ def get_psuedo_label_weights(
     psuedo_label_weights : torch.Tensor of shape(N, )
     """
     output_size = source_Y_batch[:, :-1].shape[1]
-    psuedo_label_weights = []
 
     if output_size == 1:
         pred_y = source_Y_batch[:, utils.COL_IDX_TASK]
-        for i in pred_y:
-            if i > thr:
-                psuedo_label_weights.append(1)
-            elif i < 1 - thr:
-                psuedo_label_weights.append(1)
-            else:
-                if i > 0.5:
-                    psuedo_label_weights.append(i ** alpha + (1 - thr))
-                else:
-                    psuedo_label_weights.append((1 - i) ** alpha + (1 - thr))
-
+        is_confident = (pred_y > thr) | (pred_y < 1 - thr)
+        pred_y = torch.where(pred_y > 0.5, pred_y, 1 - pred_y)
     else:
         pred_y = source_Y_batch[:, :output_size]
         pred_y = torch.max(pred_y, axis=1).values
-        for i in pred_y:
-            if i > thr:
-                psuedo_label_weights.append(1)
-            else:
-                psuedo_label_weights.append(i ** alpha + (1 - thr))
-    return torch.tensor(psuedo_label_weights, dtype=torch.float32).to(device)
+        is_confident = pred_y > thr
+    psuedo_label_weights = torch.where(is_confident, torch.ones_like(pred_y), pred_y ** alpha + (1 - thr))
+    return psuedo_label_weights.to(device=device, dtype=torch.float32)
+
+
+def get_adaptation_factors(num_epochs: int, gamma: float = 10) -> List[float]:
+    """
+    Precompute the adaptation factor schedule of DANN once per fit on host,
+    lambda_p = 2 / (1 + exp(-gamma * p)) - 1, p = epoch / (num_epochs + 1).
+    https://arxiv.org/pdf/1505.07818.pdf
+
+    Parameters
+    ----------
+    num_epochs : int
+    gamma : float
+
+    Returns
+    -------
+    adaptation_factors : list of float of length num_epochs
+    adaptation_factors[epoch - 1] is the factor for epoch.
+    """
+    epochs = torch.arange(1, num_epochs + 1, dtype=torch.float32)
+    adaptation_factors = 2 / (1 + torch.exp(-gamma * (epochs / (num_epochs + 1)))) - 1
+    return adaptation_factors.tolist()
+
+
+def forward_fused(feature_extractor, X_batches, is_domain_specific_bn=True):
+    """
+    Forward batches of several domains through feature_extractor at once and split the features afterwards.
+
+    Parameters
+    ----------
+    feature_extractor : subclass of torch.nn.Module
+    X_batches : list of torch.Tensor
+    is_domain_specific_bn : bool
+        pass domain sizes to feature_extractor so that its BatchNorm statistics stay per-domain.
+
+    Returns
+    -------
+    features : tuple of torch.Tensor, in the same order as X_batches
+    """
+    domain_sizes = [X_batch.shape[0] for X_batch in X_batches]
+    X = torch.cat(X_batches, dim=0)
+    if is_domain_specific_bn:
+        features = feature_extractor(X, domain_sizes=domain_sizes)
+    else:
+        features = feature_extractor(X)
+    return torch.split(features, domain_sizes, dim=0)
 
 
 def get_terminal_weights(
@@ -86,15 +125,12 @@ def get_terminal_weights(
 
 
 def _get_class_weights(source_y_task_batch):
-    p_occupied = sum(source_y_task_batch) / source_y_task_batch.shape[0]
+    p_occupied = source_y_task_batch.sum() / source_y_task_batch.shape[0]
     p_unoccupied = 1 - p_occupied
-    class_weights = torch.zeros_like(source_y_task_batch)
-    for i, y in enumerate(source_y_task_batch):
-        if y == 1:
-            class_weights[i] = p_unoccupied
-        elif y == 0:
-            class_weights[i] = p_occupied
-    return class_weights
+    class_weights = torch.zeros_like(source_y_task_batch, dtype=p_occupied.dtype)
+    class_weights = torch.where(source_y_task_batch == 0, p_occupied, class_weights)
+    class_weights = torch.where(source_y_task_batch == 1, p_unoccupied, class_weights)
+    return class_weights.to(source_y_task_batch.dtype)
 
 
 class EarlyStopping:
@@ -118,3 +154,225 @@ class EarlyStopping:
         else:
             self.best_score = score
             self.counter = 0
+
+
+class MetricsAccumulator:
+    """
+    Accumulate per-batch losses on the device without synchronizing with host every step.
+    Running sums are kept as device tensors, sampled traces are buffered as detached tensors,
+    and both are only materialized as python floats every log_interval steps or at epoch end.
+
+    Parameters
+    ----------
+    names : list of str
+    device : torch.device
+    trace_interval : int
+        record one trace point every trace_interval steps.
+    log_interval : int or None
+        materialize buffered traces every log_interval steps, None means only at epoch end.
+    """
+
+    def __init__(self, names, device=utils.DEVICE, trace_interval=1, log_interval=None):
+        self.names = names
+        self.device = device
+        self.trace_interval = trace_interval
+        self.log_interval = log_interval
+        self.traces = {name: [] for name in names}
+        self.num_steps = 0
+        self._reset_sums()
+        self._buffers = {name: [] for name in names}
+
+    def _reset_sums(self):
+        self.sums = {name: torch.zeros((), device=self.device) for name in self.names}
+        self.num_epoch_steps = 0
+
+    def update(self, **losses):
+        self.num_steps += 1
+        self.num_epoch_steps += 1
+        for name, loss in losses.items():
+            loss = loss.detach()
+            self.sums[name] += loss
+            if self.num_steps % self.trace_interval == 0:
+                self._buffers[name].append(loss)
+        if self.log_interval and (self.num_steps % self.log_interval == 0):
+            self.flush()
+
+    def flush(self):
+        for name, buffer in self._buffers.items():
+            if buffer:
+                self.traces[name].extend(torch.stack(buffer).tolist())
+                buffer.clear()
+
+    def epoch_end(self):
+        """
+        Returns
+        -------
+        means : dict of float
+        mean of each loss over the batches of the finished epoch.
+        """
+        self.flush()
+        num_epoch_steps = max(self.num_epoch_steps, 1)
+        means = torch.stack([self.sums[name] for name in self.names]) / num_epoch_steps
+        means = dict(zip(self.names, means.tolist()))
+        self._reset_sums()
+        return means
+
+
+class EvaluationScheduler:
+    """
+    Schedule the per-epoch evaluation of feature_extractor + task_classifier on (X, y).
+    Evaluation runs every eval_interval epochs (and always at the last epoch), optionally on a fixed random
+    subsample of X, and optionally on a background thread against a snapshot of the weights,
+    so that training of the next epoch goes on while the accuracy of the previous one is computed.
+
+    Parameters
+    ----------
+    X : torch.Tensor
+    y : torch.Tensor
+    num_epochs : int
+    eval_interval : int
+    eval_sample_size : int or None
+        size of the fixed random subsample of X, None means the whole X.
+    is_async_eval : bool
+    seed : int
+        seed of the subsample.
+    is_keep_best : bool
+        keep a copy of the weights evaluated best in best_state, (feature_extractor, task_classifier) state_dicts.
+    """
+
+    def __init__(
+        self,
+        X,
+        y,
+        num_epochs,
+        eval_interval=1,
+        eval_sample_size=None,
+        is_async_eval=False,
+        seed=0,
+        is_keep_best=False,
+    ):
+        if eval_sample_size is not None and eval_sample_size < X.shape[0]:
+            generator = torch.Generator().manual_seed(seed)
+            idx = torch.randperm(X.shape[0], generator=generator)[:eval_sample_size]
+            X, y = X[idx.to(X.device)], y[idx.to(y.device)]
+        self.X, self.y = X, y
+        self.num_epochs = num_epochs
+        self.eval_interval = eval_interval
+        self.is_async_eval = is_async_eval
+        self.last_acc = None
+        self.is_keep_best = is_keep_best
+        self.best_acc = None
+        self.best_state = None
+        self._executor = ThreadPoolExecutor(max_workers=1) if is_async_eval else None
+        self._pending = deque()
+
+    def is_eval_epoch(self, epoch):
+        return (epoch % self.eval_interval == 0) or (epoch == self.num_epochs)
+
+    def submit(self, epoch, feature_extractor, task_classifier, is_last=False):
+        """
+        Evaluate at epoch if it is scheduled or is_last, results are handed out by collect.
+        """
+        if not (is_last or self.is_eval_epoch(epoch)):
+            return
+        state = None
+        if self.is_keep_best:
+            state = (_copy_state_dict(feature_extractor), _copy_state_dict(task_classifier))
+        if self.is_async_eval:
+            feature_extractor, task_classifier = _snapshot(feature_extractor), _snapshot(task_classifier)
+            future = self._executor.submit(self._evaluate, feature_extractor, task_classifier)
+        else:
+            feature_extractor.eval()
+            task_classifier.eval()
+            future = Future()
+            future.set_result(self._evaluate(feature_extractor, task_classifier))
+        self._pending.append((future, state))
+
+    def collect(self, wait=False):
+        """
+        Returns
+        -------
+        accs : list of float
+        accuracies of finished evaluations in epoch order, earlier than still running ones.
+        """
+        accs = []
+        while self._pending and (wait or self._pending[0][0].done()):
+            future, state = self._pending.popleft()
+            acc = future.result()
+            if self.is_keep_best and (self.best_acc is None or acc > self.best_acc):
+                self.best_acc, self.best_state = acc, state
+            accs.append(acc)
+        if accs:
+            self.last_acc = accs[-1]
+        return accs
+
+    @property
+    def final_acc(self):
+        """
+        Accuracy of the weights the trainer ends with, the best kept ones (restored at the end) or the last ones.
+        """
+        return self.best_acc if self.best_state is not None else self.last_acc
+
+    def close(self):
+        """
+        Wait for the running evaluations and return their accuracies.
+        """
+        accs = self.collect(wait=True)
+        if self._executor is not None:
+            self._executor.shutdown()
+        return accs
+
+    def _evaluate(self, feature_extractor, task_classifier):
+        pred_y_task = utils.predict_in_chunks(lambda X: task_classifier.predict(feature_extractor(X)), self.X)
+        return (pred_y_task == self.y).float().mean().item()
+
+
+def _snapshot(module):
+    snapshot = copy.deepcopy(module)
+    snapshot.eval()
+    return snapshot
+
+
+def _copy_state_dict(module):
+    return {name: tensor.detach().clone() for name, tensor in module.state_dict().items()}
+
+
+def prefetch(iterable, size=2):
+    """
+    Iterate iterable on a background thread keeping up to size items ready,
+    so that fetching/collating the next batch overlaps with the training step on the current one.
+    """
+    buffer = queue.Queue(maxsize=size)
+    stop = threading.Event()
+    end = object()
+
+    def _put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce():
+        try:
+            for item in iterable:
+                if not _put((item, None)):
+                    return
+            _put((end, None))
+        except Exception as e:  # pylint: disable=broad-except
+            _put((end, e))
+
+    thread = threading.Thread(target=_produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = buffer.get()
+            if error is not None:
+                raise error
+            if item is end:
+                return
+            yield item
+    finally:
+        stop.set()
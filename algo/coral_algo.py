@@ -1,12 +1,11 @@
-from typing import List
-
 import matplotlib.pyplot as plt
 import torch
 from torch import nn
-from tqdm import tqdm
 
-from ..utils import utils
-from .algo_utils import EarlyStopping, get_psuedo_label_weights
+from .algo_utils import get_psuedo_label_weights
+from .trainer import Trainer
+
+COV_MODES = ["batch", "ema", "welford"]
 
 
 def get_MSE(x, y):
@@ -14,136 +13,188 @@ def get_MSE(x, y):
 
 
 def get_covariance_matrix(x, y):
-    N_x = x.shape[0]
-    N_y = y.shape[0]
-    average_x = torch.mean(x, dim=0)
-    average_y = torch.mean(y, dim=0)
-    cov_mat_x = (x - average_x).T @ (x - average_x) / (N_x - 1)
-    cov_mat_y = (y - average_y).T @ (y - average_y) / (N_y - 1)
-    return cov_mat_x, cov_mat_y
-
-
-def fit(data, network, **kwargs):
-    # Args
-    source_loader, target_loader = data["source_loader"], data["target_loader"]
-    target_X, target_y_task = data["target_X"], data["target_y_task"]
-
-    feature_extractor = network["feature_extractor"]
-    task_classifier = network["task_classifier"]
-    task_optimizer = network["task_optimizer"]
-    feature_optimizer = network["feature_optimizer"]
-
-    config = {
-        "num_epochs": 1000,
+    return _get_covariance_matrix(x), _get_covariance_matrix(y)
+
+
+def get_covariance_matrices(xs):
+    """
+    Covariances of K domains by one batched matmul, batches of different sizes are zero-padded and masked.
+
+    Parameters
+    ----------
+    xs : list of torch.Tensor of shape(N_k, D)
+
+    Returns
+    -------
+    cov_mats : torch.Tensor of shape(K, D, D)
+    """
+    # float32 even under autocast, bfloat16 loses the small (co)variances
+    with torch.autocast(xs[0].device.type, enabled=False):
+        if len(set(x.shape[0] for x in xs)) == 1:
+            x = torch.stack([x.float() for x in xs])
+            centered_x = x - torch.mean(x, dim=1, keepdim=True)
+            return torch.bmm(centered_x.transpose(1, 2), centered_x) / (x.shape[1] - 1)
+        x = nn.utils.rnn.pad_sequence([x.float() for x in xs], batch_first=True)
+        num_samples = torch.tensor([x.shape[0] for x in xs], device=x.device).reshape(-1, 1, 1)
+        mask = (torch.arange(x.shape[1], device=x.device).reshape(1, -1, 1) < num_samples).float()
+        centered_x = (x - torch.sum(x, dim=1, keepdim=True) / num_samples) * mask
+        return torch.bmm(centered_x.transpose(1, 2), centered_x) / (num_samples - 1)
+
+
+def _get_covariance_matrix(x):
+    # float32 even under autocast, bfloat16 loses the small (co)variances
+    with torch.autocast(x.device.type, enabled=False):
+        x = x.float()
+        average_x = torch.mean(x, dim=0)
+        return (x - average_x).T @ (x - average_x) / (x.shape[0] - 1)
+
+
+class StreamingCovariance:
+    """
+    Mean and covariance of one domain accumulated across batches, so that small batches give stable estimates.
+    Every update merges the batch statistics into the running ones with weight w (Chan et al.'s parallel update),
+    w = momentum for "ema", w = N_batch / N_seen for "welford" (all batches seen so far weigh the same).
+    The returned covariance has the value of the running estimate and the gradient of the batch covariance,
+    so that the gradient does not shrink with w and alpha weighs CoRAL as in the "batch" mode.
+
+    Parameters
+    ----------
+    mode : str
+        "ema" or "welford".
+    momentum : float
+        ema only.
+    """
+
+    def __init__(self, mode="ema", momentum=0.1):
+        self.mode = mode
+        self.momentum = momentum
+        self.num_samples = 0
+        self.mean = None
+        self.cov_mat = None
+
+    def update(self, x, batch_cov_mat=None):
+        """
+        Parameters
+        ----------
+        x : torch.Tensor of shape(N, D)
+        batch_cov_mat : torch.Tensor of shape(D, D) or None
+            covariance of x if already computed.
+
+        Returns
+        -------
+        cov_mat : torch.Tensor of shape(D, D)
+            the running covariance including x, differentiable w.r.t. x through batch_cov_mat.
+        """
+        with torch.autocast(x.device.type, enabled=False):
+            x = x.float()
+            N = x.shape[0]
+            batch_mean = torch.mean(x, dim=0)
+            if batch_cov_mat is None:
+                batch_cov_mat = _get_covariance_matrix(x)
+            self.num_samples += N
+            if self.mean is None:
+                mean, cov_mat = batch_mean, batch_cov_mat
+            else:
+                w = self.momentum if self.mode == "ema" else N / self.num_samples
+                delta = batch_mean - self.mean
+                mean = self.mean + w * delta
+                cov_mat = (1 - w) * self.cov_mat + w * batch_cov_mat + w * (1 - w) * torch.outer(delta, delta)
+        self.mean, self.cov_mat = mean.detach(), cov_mat.detach()
+        return self.cov_mat + batch_cov_mat - batch_cov_mat.detach()
+
+
+class CoralTrainer(Trainer):
+    """
+    coral_cov_mode "ema" or "welford" aligns running covariances (StreamingCovariance) instead of the batch ones.
+    "welford" restarts every epoch, so that the features of earlier epochs, stale since, drop out.
+    """
+
+    loss_names = ["loss_coral", "loss_task"]
+    default_config = {
         "alpha": 1,
-        "device": utils.DEVICE,
         "is_psuedo_weights": False,
-        "is_changing_lr": False,
-        "epoch_thr_for_changing_lr": 200,
-        "changed_lrs": [0.00005, 0.00005],
-        "stop_during_epochs": False,
-        "epoch_thr_for_stopping": 2,
-        "do_plot": False,
-        "do_early_stop": False,
+        "coral_cov_mode": "batch",
+        "coral_momentum": 0.1,
+        "print_interval": 10,
     }
-    config.update(kwargs)
-    num_epochs = config["num_epochs"]
-    alpha = config["alpha"]
-    device = config["device"]
-    is_psuedo_weights = config["is_psuedo_weights"]
-    is_changing_lr = config["is_changing_lr"]
-    epoch_thr_for_changing_lr = config["epoch_thr_for_changing_lr"]
-    changed_lrs = config["changed_lrs"]
-    stop_during_epochs = config["stop_during_epochs"]
-    epoch_thr_for_stopping = config["epoch_thr_for_stopping"]
-    do_plot = config["do_plot"]
-    do_early_stop = config["do_early_stop"]
-
-    # Fit
-    early_stopping = EarlyStopping()
-    loss_corals = []
-    loss_tasks = []
-    loss_evals = []
-    for epoch in tqdm(range(1, num_epochs + 1)):
-        task_classifier.train()
-        feature_extractor.train()
-        if stop_during_epochs & (epoch == epoch_thr_for_stopping):
-            break
-        if is_changing_lr:
-            feature_optimizer, task_optimizer = _change_lr_during_coral_training(
-                feature_optimizer, task_optimizer, epoch, epoch_thr=epoch_thr_for_changing_lr, changed_lrs=changed_lrs,
-            )
-
-        for (source_X_batch, source_Y_batch), (target_X_batch, _) in zip(source_loader, target_loader):
-            # 0. Data
-            if task_classifier.output_size == 1:
-                source_y_task_batch = source_Y_batch[:, utils.COL_IDX_TASK] > 0.5
-                source_y_task_batch = source_y_task_batch.to(torch.float32)
-            else:
-                if is_psuedo_weights:
-                    output_size = source_Y_batch[:, :-1].shape[1]
-                    source_y_task_batch = source_Y_batch[:, :output_size]
-                    source_y_task_batch = torch.argmax(source_y_task_batch, dim=1)
-                    source_y_task_batch = source_y_task_batch.to(torch.long)
-                else:
-                    source_y_task_batch = source_Y_batch[:, utils.COL_IDX_TASK]
-                    source_y_task_batch = source_y_task_batch.to(torch.long)
-
-            if is_psuedo_weights:
-                weights = get_psuedo_label_weights(source_Y_batch=source_Y_batch, device=device).detach()
-            else:
-                weights = torch.ones_like(source_y_task_batch)
-
-            # 1. Forward
-            source_X_batch = feature_extractor(source_X_batch)
-            target_X_batch = feature_extractor(target_X_batch)
-            source_out = task_classifier(source_X_batch)
-            target_out = task_classifier(target_X_batch)
-
-            # 1.1 Task Loss
-            if task_classifier.output_size == 1:
-                source_preds = torch.sigmoid(source_out).reshape(-1)
-                criterion_weight = nn.BCELoss(weight=weights)
-                loss_task = criterion_weight(source_preds, source_y_task_batch)
-            else:
-                source_preds = torch.softmax(source_out, dim=1)
-                criterion_weight = nn.CrossEntropyLoss(reduction="none")
-                loss_task = criterion_weight(source_preds, source_y_task_batch)
-                loss_task = loss_task * weights
-                loss_task = loss_task.mean()
-
-            # 1.2 CoRAL Loss
-            cov_mat_source, cov_mat_target = get_covariance_matrix(source_out, target_out)
-            k = source_out.shape[1]
-            loss_coral = get_MSE(cov_mat_source, cov_mat_target) * (1 / (4 * k ** 2))
-            loss_corals.append(loss_coral.item())
-            loss_tasks.append(loss_task.item())
-
-            loss = loss_task + loss_coral * alpha
-            # 2. Backward
-            task_optimizer.zero_grad()
-            feature_optimizer.zero_grad()
-            loss.backward()
-            # 3. Update Params
-            task_optimizer.step()
-            feature_optimizer.step()
-
-        # 4. Eval
-        with torch.no_grad():
-            feature_extractor.eval()
-            task_classifier.eval()
-            target_out = task_classifier.predict(feature_extractor(target_X))
-            acc = sum(target_out == target_y_task) / len(target_y_task)
-            if epoch % 10 == 0:
-                print(f"Epoch: {epoch}, Loss Coral: {loss_coral}, Loss Task: {loss_task}, Acc: {acc}")
-            early_stopping(acc.item())
-            loss_evals.append(acc.item())
-        if early_stopping.early_stop & do_early_stop:
-            break
-
-    if do_plot:
-        plot_coral_loss(loss_corals, loss_tasks, loss_evals)
-    return feature_extractor, task_classifier, None
+
+    def __init__(self, data, network, **kwargs):
+        super().__init__(data, network, **kwargs)
+        if self.config["coral_cov_mode"] not in COV_MODES:
+            raise ValueError(f"coral_cov_mode should be one of {COV_MODES}, got {self.config['coral_cov_mode']}")
+        self.streaming_covariances = {}
+        self.streaming_epoch = None
+
+    def get_covariance_matrices(self, outs):
+        """
+        Parameters
+        ----------
+        outs : list of torch.Tensor of shape(N_k, D)
+            outputs of each domain, in the same order every step.
+
+        Returns
+        -------
+        cov_mats : list of torch.Tensor of shape(D, D)
+        """
+        batch_cov_mats = list(get_covariance_matrices(outs))
+        if self.config["coral_cov_mode"] == "batch":
+            return batch_cov_mats
+        if self.config["coral_cov_mode"] == "welford" and self.streaming_epoch != self.epoch:
+            self.streaming_covariances = {}
+            self.streaming_epoch = self.epoch
+        for k in range(len(outs)):
+            if k not in self.streaming_covariances:
+                self.streaming_covariances[k] = StreamingCovariance(
+                    self.config["coral_cov_mode"], self.config["coral_momentum"]
+                )
+        return [
+            self.streaming_covariances[k].update(out, batch_cov_mat)
+            for k, (out, batch_cov_mat) in enumerate(zip(outs, batch_cov_mats))
+        ]
+
+    def compute_losses(self, batch):
+        (source_X_batch, source_Y_batch), (target_X_batch, _) = batch
+        # 0. Data
+        source_y_task_batch, _ = self.get_source_y(source_Y_batch)
+        if self.config["is_psuedo_weights"]:
+            weights = get_psuedo_label_weights(source_Y_batch=source_Y_batch, device=self.device).detach()
+        else:
+            weights = torch.ones_like(source_y_task_batch)
+
+        # 1. Forward
+        source_X_batch, target_X_batch = self.forward_features([source_X_batch, target_X_batch])
+        source_out = self.task_classifier(source_X_batch).float()
+        target_out = self.task_classifier(target_X_batch).float()
+
+        # 1.1 Task Loss
+        if self.task_classifier.output_size == 1:
+            source_preds = torch.sigmoid(source_out).reshape(-1)
+            criterion_weight = nn.BCELoss(weight=weights)
+            loss_task = criterion_weight(source_preds, source_y_task_batch)
+        else:
+            source_preds = torch.softmax(source_out, dim=1)
+            criterion_weight = nn.CrossEntropyLoss(reduction="none")
+            loss_task = criterion_weight(source_preds, source_y_task_batch)
+            loss_task = loss_task * weights
+            loss_task = loss_task.mean()
+
+        # 1.2 CoRAL Loss
+        cov_mat_source, cov_mat_target = self.get_covariance_matrices([source_out, target_out])
+        k = source_out.shape[1]
+        loss_coral = get_MSE(cov_mat_source, cov_mat_target) * (1 / (4 * k ** 2))
+        return loss_task + loss_coral * self.config["alpha"], {"loss_coral": loss_coral, "loss_task": loss_task}
+
+    def plot(self, traces, loss_task_evals):
+        plot_coral_loss(traces["loss_coral"], traces["loss_task"], loss_task_evals)
+
+
+def fit(data, network, **kwargs):
+    """
+    Fit Feature Extractor, Task Classifier by Deep CoRAL algo.
+    https://arxiv.org/abs/1607.01719
+    """
+    CoralTrainer(data, network, **kwargs).fit()
+    return network["feature_extractor"], network["task_classifier"], None
 
 
 def plot_coral_loss(loss_corals, loss_tasks, loss_evals):
@@ -159,16 +210,3 @@ def plot_coral_loss(loss_corals, loss_tasks, loss_evals):
     plt.xlabel("epoch")
     plt.ylabel("accuracy")
     plt.show()
-
-
-def _change_lr_during_coral_training(
-    feature_optimizer: torch.optim.Adam,
-    task_optimizer: torch.optim.Adam,
-    epoch: torch.Tensor,
-    epoch_thr: int = 200,
-    changed_lrs: List[float] = [0.00005],
-):
-    if epoch == epoch_thr:
-        feature_optimizer.param_groups[0]["lr"] = changed_lrs[0]
-        task_optimizer.param_groups[0]["lr"] = changed_lrs[0]
-    return feature_optimizer, task_optimizer
@@ -1,104 +1,282 @@
 import matplotlib.pyplot as plt
 import torch
-from sklearn.gaussian_process.kernels import RBF
 from torch import nn, optim
 
-from ..networks import Encoder, ThreeLayersDecoder
 from ..utils import utils
+from .trainer import Trainer
 
+MMD_ESTIMATORS = ["quadratic", "linear", "rff"]
 
-def fit_kernel(x, y):
+
+def get_pairwise_squared_distances(x, y):
     """
-    https://scikit-learn.org/stable/modules/generated/sklearn.gaussian_process.kernels.RBF.html
+    One (N + M, N + M) squared euclidean distance matrix of the stacked samples, shared by the xx, yy and xy terms.
     """
-    x = x.cpu().detach().numpy()
-    y = y.cpu().detach().numpy()
-    rbf = RBF(length_scale=1.0)
-    return torch.tensor(rbf(x, y), dtype=torch.float32).to(utils.DEVICE)
+    z = torch.cat([x, y], dim=0)
+    squared_norms = torch.sum(z ** 2, dim=1)
+    distances = squared_norms.unsqueeze(1) + squared_norms.unsqueeze(0) - 2 * z @ z.T
+    return torch.clamp(distances, min=0)
 
 
-def get_MMD(x, y):
+def get_MMD(x, y, num_kernels=5, kernel_mul=2.0):
     """
+    Biased MMD^2 with a sum of Gaussian kernels, bandwidths spaced by kernel_mul around the median heuristic.
+    https://arxiv.org/abs/1502.02791
     https://jejjohnson.github.io/research_journal/appendix/similarity/mmd/
+
+    Parameters
+    ----------
+    x : torch.Tensor of shape(N, D)
+    y : torch.Tensor of shape(M, D)
+    num_kernels : int
+    kernel_mul : float
+
+    Returns
+    -------
+    mmd : torch.Tensor of shape()
     """
-    mmd_xx = torch.mean(fit_kernel(x, x))
-    mmd_yy = torch.mean(fit_kernel(y, y))
-    mmd_xy = -2 * torch.mean(fit_kernel(x, y))
+    with torch.autocast(x.device.type, enabled=False):
+        distances = get_pairwise_squared_distances(x.float(), y.float())
+        bandwidths = _get_bandwidths(distances, num_kernels, kernel_mul)
+        kernel = torch.sum(torch.exp(-distances.unsqueeze(0) / bandwidths.reshape(-1, 1, 1)), dim=0)
+    N = x.shape[0]
+    mmd_xx = torch.mean(kernel[:N, :N])
+    mmd_yy = torch.mean(kernel[N:, N:])
+    mmd_xy = -2 * torch.mean(kernel[:N, N:])
     return mmd_xx + mmd_yy + mmd_xy
 
 
-def fit(
-    source_loader,
-    target_loader,
-    num_epochs,
-    feature_extractor,
-    task_classifier_source,
-    task_classifier_target,
-    criterion,
-    feature_optimizer,
-    task_optimizer_source,
-    task_optimizer_target,
-    is_psuedo_weights,
-    alpha_feat,
-    alpha_task,
+def get_linear_MMD(x, y, num_kernels=5, kernel_mul=2.0):
+    """
+    Unbiased linear-time MMD^2 over disjoint pairs of samples, O(N) instead of O(N^2) at the cost of a higher variance.
+    https://jmlr.org/papers/v13/gretton12a.html (Lemma 14)
+
+    Parameters
+    ----------
+    x : torch.Tensor of shape(N, D)
+    y : torch.Tensor of shape(M, D)
+        min(N, M) // 2 pairs are used, the MMD is 0 without any pair (e.g. a last batch of 1 sample).
+    num_kernels : int
+    kernel_mul : float
+
+    Returns
+    -------
+    mmd : torch.Tensor of shape()
+    """
+    if min(x.shape[0], y.shape[0]) < 2:
+        return x.new_zeros((), dtype=torch.float32)
+    with torch.autocast(x.device.type, enabled=False):
+        distances = _get_linear_distances(x.float(), y.float())
+        bandwidths = _get_bandwidths(torch.cat(distances), num_kernels, kernel_mul).reshape(-1, 1)
+        kernel_x1x2, kernel_y1y2, kernel_x1y2, kernel_x2y1 = [
+            torch.sum(torch.exp(-distance.unsqueeze(0) / bandwidths), dim=0) for distance in distances
+        ]
+    return torch.mean(kernel_x1x2 + kernel_y1y2 - kernel_x1y2 - kernel_x2y1)
+
+
+def get_RFF_MMD(x, y, num_features=256, num_kernels=5, kernel_mul=2.0):
+    """
+    MMD^2 between the mean embeddings of random Fourier features, O((N + M) * num_features) per kernel,
+    converging to the biased quadratic estimate get_MMD as num_features grows.
+    https://papers.nips.cc/paper/3182-random-features-for-large-scale-kernel-machines
+
+    Parameters
+    ----------
+    x : torch.Tensor of shape(N, D)
+    y : torch.Tensor of shape(M, D)
+    num_features : int
+        random features per kernel, resampled every call.
+    num_kernels : int
+    kernel_mul : float
+
+    Returns
+    -------
+    mmd : torch.Tensor of shape()
+    """
+    with torch.autocast(x.device.type, enabled=False):
+        x, y = x.float(), y.float()
+        weights, bias = _get_random_fourier_params(x, y, num_features, num_kernels, kernel_mul)
+        mean_embedding_x = _get_random_fourier_features(x, weights, bias, num_features).mean(dim=0)
+        mean_embedding_y = _get_random_fourier_features(y, weights, bias, num_features).mean(dim=0)
+        return torch.sum((mean_embedding_x - mean_embedding_y) ** 2)
+
+
+@torch.no_grad()
+def get_dataset_MMD(
+    source_X,
     target_X,
-    target_y_task,
+    feature_extractor=None,
+    mmd_estimator="rff",
+    num_features=1024,
+    num_kernels=5,
+    kernel_mul=2.0,
+    chunk_size=utils.PREDICT_CHUNK_SIZE,
 ):
+    """
+    MMD^2 between whole datasets for diagnostics, in time and memory linear in the number of samples.
+
+    Parameters
+    ----------
+    source_X : torch.Tensor of shape(N, ...)
+    target_X : torch.Tensor of shape(M, ...)
+    feature_extractor : subclass of torch.nn.Module or None
+        MMD of the features if given, of the inputs (flattened) otherwise.
+    mmd_estimator : str
+        "linear" or "rff", the quadratic estimator does not scale to datasets.
+    num_features : int
+        rff only.
+    chunk_size : int
+        the number of samples embedded at once, bounds the peak memory.
+
+    Returns
+    -------
+    mmd : float
+    """
+    if mmd_estimator not in ["linear", "rff"]:
+        raise ValueError(f"mmd_estimator of datasets should be linear or rff, got {mmd_estimator}")
+    if feature_extractor is not None:
+        source_X = utils.predict_in_chunks(feature_extractor, source_X, chunk_size=chunk_size)
+        target_X = utils.predict_in_chunks(feature_extractor, target_X, chunk_size=chunk_size)
+    x, y = source_X.reshape(source_X.shape[0], -1).float(), target_X.reshape(target_X.shape[0], -1).float()
+    if mmd_estimator == "linear":
+        return get_linear_MMD(x, y, num_kernels=num_kernels, kernel_mul=kernel_mul).item()
+    weights, bias = _get_random_fourier_params(x, y, num_features, num_kernels, kernel_mul)
+    mean_embeddings = []
+    for z in [x, y]:
+        embedding_sum = torch.zeros(weights.shape[1], device=z.device)
+        for start in range(0, z.shape[0], chunk_size):
+            features = _get_random_fourier_features(z[start : start + chunk_size], weights, bias, num_features)
+            embedding_sum += features.sum(dim=0)
+        mean_embeddings.append(embedding_sum / z.shape[0])
+    return torch.sum((mean_embeddings[0] - mean_embeddings[1]) ** 2).item()
+
+
+def _get_bandwidths(distances, num_kernels, kernel_mul):
+    """
+    Median heuristic over the positive squared distances, detached so that the bandwidths are constants of the loss.
+    1 without any positive distance, e.g. of a batch of 1 sample or of equal samples.
+    """
+    positive_distances = distances[distances > 0].detach()
+    if positive_distances.numel() == 0:
+        bandwidth = torch.ones((), device=distances.device)
+    else:
+        bandwidth = torch.median(positive_distances)
+    return bandwidth * kernel_mul ** (torch.arange(num_kernels, device=distances.device) - num_kernels // 2)
+
+
+def _get_linear_distances(x, y):
+    """
+    Squared distances of the disjoint pairs (x1, x2), (y1, y2), (x1, y2), (x2, y1).
+    """
+    num_pairs = min(x.shape[0], y.shape[0]) // 2
+    x1, x2 = x[0 : 2 * num_pairs : 2], x[1 : 2 * num_pairs : 2]
+    y1, y2 = y[0 : 2 * num_pairs : 2], y[1 : 2 * num_pairs : 2]
+    return [torch.sum((a - b) ** 2, dim=1) for a, b in [(x1, x2), (y1, y2), (x1, y2), (x2, y1)]]
+
+
+def _get_random_fourier_params(x, y, num_features, num_kernels, kernel_mul):
+    """
+    exp(-||x - y||^2 / bandwidth) has the spectral density N(0, 2 / bandwidth), one block of features per kernel.
+    The bandwidths come from the linear-time pairs, so that the parameters cost O(N) as well.
+
+    Returns
+    -------
+    weights : torch.Tensor of shape(D, num_kernels * num_features)
+    bias : torch.Tensor of shape(num_kernels * num_features, )
+    """
+    bandwidths = _get_bandwidths(torch.cat(_get_linear_distances(x, y)), num_kernels, kernel_mul)
+    weights = torch.randn(x.shape[1], num_kernels, num_features, device=x.device)
+    weights = (weights * torch.sqrt(2 / bandwidths).reshape(1, -1, 1)).reshape(x.shape[1], -1)
+    bias = torch.rand(num_kernels * num_features, device=x.device) * 2 * torch.pi
+    return weights, bias
+
+
+def _get_random_fourier_features(z, weights, bias, num_features):
+    # sqrt(2 / num_features) per block of a kernel, the kernels sum up in the inner product
+    return torch.cos(z @ weights + bias) * (2 / num_features) ** 0.5
+
+
+class DanTrainer(Trainer):
+    """
+    MMD between source and target on the features and on the task classifier outputs.
+    The task classifier is shared by both domains, unless network has task_classifier_source (+ its optimizer).
+    mmd_estimator "linear" or "rff" makes the alignment cost linear in the batch size instead of quadratic.
+    """
+
+    loss_names = ["loss_mmd", "loss_task"]
+    default_config = {
+        "alpha_feat": 0.5,
+        "alpha_task": 0.1,
+        "num_kernels": 5,
+        "kernel_mul": 2.0,
+        "mmd_estimator": "quadratic",
+        "rff_num_features": 256,
+        "print_interval": 10,
+    }
 
-    for epoch in range(1, num_epochs + 1):
-        feature_extractor.train()
-        task_classifier_source.train()
-        task_classifier_target.train()
-
-        for (source_X_batch, source_Y_batch), (target_X_batch, _) in zip(source_loader, target_loader):
-            # 0. Data
-            source_y_task_batch = source_Y_batch[:, utils.COL_IDX_TASK] > 0.5
-            source_y_task_batch = source_y_task_batch.to(torch.float32)
-
-            # 1. Forward
-            # 1.1 Feature Extractor
-            source_feat = feature_extractor(source_X_batch)
-            target_feat = feature_extractor(target_X_batch)
-
-            # 1.2 Task Classifier
-            source_out = task_classifier_source(source_feat)
-            target_out = task_classifier_target(target_feat)
-
-            # 1.3 MMD Loss
-            loss_mmd = get_MMD(source_feat, target_feat) * alpha_feat
-            loss_mmd += get_MMD(source_out, target_out) * alpha_task
-
-            # 1.4 Task Loss
-            source_out = torch.sigmoid(source_out).reshape(-1)
-            loss_task = criterion(source_out, source_y_task_batch)
-            loss = loss_task + loss_mmd
-
-            # 2. Backward
-            feature_optimizer.zero_grad()
-            task_optimizer_source.zero_grad()
-            task_optimizer_target.zero_grad()
-            loss.backward()
-
-            # 3. Update Params
-            feature_optimizer.step()
-            task_optimizer_source.step()
-            task_optimizer_target.step()
-
-        # 4. Eval
-        with torch.no_grad():
-            feature_extractor.eval()
-            task_classifier_target.eval()
-            target_feat = feature_extractor(target_X)
-            target_out = task_classifier_target(target_feat)
-            target_out = torch.sigmoid(target_out).reshape(-1)
-            target_out = target_out > 0.5
-            acc = sum(target_out == target_y_task) / len(target_y_task)
-            if epoch % 10 == 0:
-                print(f"Epoch: {epoch}, Loss MMD: {loss_mmd}, Loss Task: {loss_task}, Acc: {acc}")
-    return feature_extractor, task_classifier_target
+    def __init__(self, data, network, **kwargs):
+        if "task_classifier_source" in network:
+            self.task_optimizer_names = ["feature_optimizer", "task_optimizer_source", "task_optimizer"]
+        super().__init__(data, network, **kwargs)
+        if self.config["mmd_estimator"] not in MMD_ESTIMATORS:
+            raise ValueError(f"mmd_estimator should be one of {MMD_ESTIMATORS}, got {self.config['mmd_estimator']}")
+        self.task_classifier_source = network.get("task_classifier_source", self.task_classifier)
+        self.criterion = network["criterion"]
+
+    def get_MMD(self, x, y):
+        kwargs = {"num_kernels": self.config["num_kernels"], "kernel_mul": self.config["kernel_mul"]}
+        if self.config["mmd_estimator"] == "linear":
+            return get_linear_MMD(x, y, **kwargs)
+        if self.config["mmd_estimator"] == "rff":
+            return get_RFF_MMD(x, y, num_features=self.config["rff_num_features"], **kwargs)
+        return get_MMD(x, y, **kwargs)
+
+    def compute_losses(self, batch):
+        (source_X_batch, source_Y_batch), (target_X_batch, _) = batch
+        # 0. Data
+        source_y_task_batch, _ = self.get_source_y(source_Y_batch)
+
+        # 1. Forward
+        # 1.1 Feature Extractor
+        source_feat, target_feat = self.forward_features([source_X_batch, target_X_batch])
+
+        # 1.2 Task Classifier
+        source_out = self.task_classifier_source(source_feat)
+        target_out = self.task_classifier(target_feat)
+
+        # 1.3 MMD Loss
+        loss_mmd = self.get_MMD(source_feat, target_feat) * self.config["alpha_feat"]
+        loss_mmd += self.get_MMD(source_out, target_out) * self.config["alpha_task"]
+
+        # 1.4 Task Loss
+        if self.task_classifier.output_size == 1:
+            source_preds = torch.sigmoid(source_out.float()).reshape(-1)
+            loss_task = self.criterion(source_preds, source_y_task_batch)
+        else:
+            criterion = nn.CrossEntropyLoss()
+            source_preds = torch.softmax(source_out.float(), dim=1)
+            loss_task = criterion(source_preds, source_y_task_batch)
+        return loss_task + loss_mmd, {"loss_mmd": loss_mmd, "loss_task": loss_task}
+
+
+def fit(data, network, **kwargs):
+    """
+    Fit Feature Extractor, Task Classifier by DAN algo.
+    https://arxiv.org/abs/1502.02791
+
+    Returns
+    -------
+    feature_extractor : subclass of torch.nn.Module
+    task_classifier : subclass of torch.nn.Module
+    loss_task_evals : list of float
+    """
+    loss_task_evals = DanTrainer(data, network, **kwargs).fit()
+    return network["feature_extractor"], network["task_classifier"], loss_task_evals
 
 
 if __name__ == "__main__":
+    from ..networks import Encoder, ThreeLayersDecoder
+
     # Load Data
     (
         source_X,
@@ -131,23 +309,23 @@ if __name__ == "__main__":
     task_optimizer_source = optim.Adam(task_classifier_source.parameters(), lr=learning_rate)
 
     # Fit DAN
-    feature_extractor, task_classifier = fit(
-        source_loader=source_loader,
-        target_loader=target_loader,
-        num_epochs=100,
-        feature_extractor=feature_extractor,
-        task_classifier_source=task_classifier_source,
-        task_classifier_target=task_classifier_target,
-        criterion=criterion,
-        feature_optimizer=feature_optimizer,
-        task_optimizer_source=task_optimizer_source,
-        task_optimizer_target=task_optimizer_target,
-        is_psuedo_weights=False,
-        alpha_feat=0.5,
-        alpha_task=0.1,
-        target_X=target_X,
-        target_y_task=target_y_task,
-    )
+    data = {
+        "source_loader": source_loader,
+        "target_loader": target_loader,
+        "target_X": target_X,
+        "target_y_task": target_y_task,
+    }
+    network = {
+        "feature_extractor": feature_extractor,
+        "task_classifier_source": task_classifier_source,
+        "task_classifier": task_classifier_target,
+        "criterion": criterion,
+        "feature_optimizer": feature_optimizer,
+        "task_optimizer_source": task_optimizer_source,
+        "task_optimizer": task_optimizer_target,
+    }
+    config = {"num_epochs": 100, "alpha_feat": 0.5, "alpha_task": 0.1}
+    feature_extractor, task_classifier, _ = fit(data, network, **config)
     print("Done!")
     source_X = source_X.cpu()
     target_X = target_X.cpu()
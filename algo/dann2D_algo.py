@@ -3,195 +3,116 @@ from typing import List
 import matplotlib.pyplot as plt
 import torch
 from torch import nn
-from tqdm import tqdm
 
-from ..utils import utils
-from .algo_utils import EarlyStopping
 from .dann_algo import ReverseGradient
+from .trainer import Trainer
 
 
-def fit(data, network, **kwargs):
-    # Args
-    source_loader, target_loader, target_prime_loader = (
-        data["source_loader"],
-        data["target_loader"],
-        data["target_prime_loader"],
-    )
-    target_prime_X, target_prime_y_task = data["target_prime_X"], data["target_prime_y_task"]
-    feature_extractor, domain_classifier_dim1, domain_classifier_dim2, task_classifier = (
-        network["feature_extractor"],
-        network["domain_classifier_dim1"],
-        network["domain_classifier_dim2"],
-        network["task_classifier"],
-    )
-    criterion = network["criterion"]
-    feature_optimizer, domain_optimizer_dim1, domain_optimizer_dim2, task_optimizer = (
-        network["feature_optimizer"],
-        network["domain_optimizer_dim1"],
-        network["domain_optimizer_dim2"],
-        network["task_optimizer"],
-    )
-    config = {
-        "num_epochs": 1000,
-        "device": utils.DEVICE,
-        "is_changing_lr": False,
-        "epoch_thr_for_changing_lr": 200,
-        "changed_lrs": [0.00005, 0.00005],
-        "do_early_stop": False,
-        "do_plot": False,
-    }
-    config.update(kwargs)
-    num_epochs, device = config["num_epochs"], config["device"]
-    is_changing_lr, epoch_thr_for_changing_lr, changed_lrs = (
-        config["is_changing_lr"],
-        config["epoch_thr_for_changing_lr"],
-        config["changed_lrs"],
-    )
-    do_early_stop = config["do_early_stop"]
-    do_plot = config["do_plot"]
-
-    # Fit
-    loss_tasks = []
-    loss_task_evals = []
-    loss_domain_dim1s = []
-    loss_domain_dim2s = []
-    reverse_grad = ReverseGradient.apply
-    early_stopping = EarlyStopping()
-    num_epochs = torch.tensor(num_epochs, dtype=torch.int32).to(device)
-    for epoch in tqdm(range(1, num_epochs + 1)):
-        epoch = torch.tensor(epoch, dtype=torch.float32).to(device)
-        feature_extractor.train()
-        task_classifier.train()
-        if is_changing_lr:
-            (
-                feature_optimizer,
-                domain_optimizer_dim1,
-                domain_optimizer_dim2,
-                task_optimizer,
-            ) = _change_lr_during_dann2D_training(
-                feature_optimizer,
-                domain_optimizer_dim1,
-                domain_optimizer_dim2,
-                task_optimizer,
-                epoch,
-                epoch_thr=epoch_thr_for_changing_lr,
-                changed_lrs=changed_lrs,
-            )
-        for (
+class Dann2DTrainer(Trainer):
+    loader_names = ["source_loader", "target_loader", "target_prime_loader"]
+    eval_data_names = ["target_prime_X", "target_prime_y_task"]
+    domain_optimizer_names = ["domain_optimizer_dim1", "domain_optimizer_dim2"]
+    loss_names = ["loss_domain_dim1", "loss_domain_dim2", "loss_task"]
+    default_config = {"is_single_backward": True}
+
+    def __init__(self, data, network, **kwargs):
+        super().__init__(data, network, **kwargs)
+        self.domain_classifier_dim1 = network["domain_classifier_dim1"]
+        self.domain_classifier_dim2 = network["domain_classifier_dim2"]
+        self.criterion = network["criterion"]
+        self.reverse_grad = ReverseGradient.apply
+
+    def compute_losses(self, batch):
+        (
             (source_X_batch, source_Y_batch),
             (target_X_batch, target_y_domain_batch),
             (target_prime_X_batch, target_prime_y_domain_batch),
-        ) in zip(source_loader, target_loader, target_prime_loader):
-            # 0. Prep Data
-            target_prime_y_domain_batch = target_prime_y_domain_batch - 1
-
-            source_y_domain_batch = source_Y_batch[:, utils.COL_IDX_DOMAIN]
-            source_y_task_batch = source_Y_batch[:, utils.COL_IDX_TASK]
-            if task_classifier.output_size == 1:
-                source_y_task_batch = source_y_task_batch.to(torch.float32)
-            else:
-                source_y_task_batch = source_y_task_batch.to(torch.long)
-
-            # 1. Forward
-            ## 1.1 Feature Extractor
-            source_X_batch = feature_extractor(source_X_batch)
-            target_X_batch = feature_extractor(target_X_batch)
-            target_prime_X_batch = feature_extractor(target_prime_X_batch)
-
-            ## 1.2.1 Domain Classifier Dim1
-            source_X_batch_reversed_grad = reverse_grad(source_X_batch, epoch, num_epochs)
-            target_X_batch = reverse_grad(target_X_batch, epoch, num_epochs)
-            target_prime_X_batch = reverse_grad(target_prime_X_batch, epoch, num_epochs)
-
-            pred_source_y_domain = domain_classifier_dim1(source_X_batch_reversed_grad)
-            pred_target_y_domain_dim1 = domain_classifier_dim1(target_X_batch)
-            pred_source_y_domain = torch.sigmoid(pred_source_y_domain).reshape(-1)
-            pred_target_y_domain_dim1 = torch.sigmoid(pred_target_y_domain_dim1).reshape(-1)
-            loss_domain_dim1 = criterion(pred_source_y_domain, source_y_domain_batch)
-            loss_domain_dim1 += criterion(pred_target_y_domain_dim1, target_y_domain_batch)
-            loss_domain_dim1s.append(loss_domain_dim1.item())
-
-            ## 1.2.2 Domain Classifier Dim2
-            pred_target_y_domain_dim2 = domain_classifier_dim2(target_X_batch)
-            pred_target_prime_y_domain = domain_classifier_dim2(target_prime_X_batch)
-
-            pred_target_y_domain_dim2 = torch.sigmoid(pred_target_y_domain_dim2).reshape(-1)
-            pred_target_prime_y_domain = torch.sigmoid(pred_target_prime_y_domain).reshape(-1)
-
-            loss_domain_dim2 = criterion(pred_target_y_domain_dim2, target_y_domain_batch)
-            loss_domain_dim2 += criterion(pred_target_prime_y_domain, target_prime_y_domain_batch)
-            loss_domain_dim2s.append(loss_domain_dim2.item())
-
-            loss_domain = loss_domain_dim1 + loss_domain_dim2
-            ## 1.3 Task Classifier
-            pred_y_task = task_classifier.predict_proba(source_X_batch)
-            if task_classifier.output_size == 1:
-                criterion_task = nn.BCELoss()
-            else:
-                criterion_task = nn.CrossEntropyLoss()
-            loss_task = criterion_task(pred_y_task, source_y_task_batch)
-            loss_tasks.append(loss_task.item())
-
-            # 2. Backward
-            feature_optimizer.zero_grad()
-            domain_optimizer_dim1.zero_grad()
-            domain_optimizer_dim2.zero_grad()
-            task_optimizer.zero_grad()
+        ) = batch
+        # 0. Prep Data
+        target_prime_y_domain_batch = target_prime_y_domain_batch - 1
+        source_y_task_batch, source_y_domain_batch = self.get_source_y(source_Y_batch)
+
+        # 1. Forward
+        ## 1.1 Feature Extractor
+        source_X_batch, target_X_batch, target_prime_X_batch = self.forward_features(
+            [source_X_batch, target_X_batch, target_prime_X_batch]
+        )
 
+        ## 1.2.1 Domain Classifier Dim1
+        source_X_batch_reversed_grad = self.reverse_grad(source_X_batch, self.adaptation_factor)
+        target_X_batch = self.reverse_grad(target_X_batch, self.adaptation_factor)
+        target_prime_X_batch = self.reverse_grad(target_prime_X_batch, self.adaptation_factor)
+
+        pred_source_y_domain = self.domain_classifier_dim1(source_X_batch_reversed_grad)
+        pred_target_y_domain_dim1 = self.domain_classifier_dim1(target_X_batch)
+        pred_source_y_domain = torch.sigmoid(pred_source_y_domain.float()).reshape(-1)
+        pred_target_y_domain_dim1 = torch.sigmoid(pred_target_y_domain_dim1.float()).reshape(-1)
+        loss_domain_dim1 = self.criterion(pred_source_y_domain, source_y_domain_batch)
+        loss_domain_dim1 += self.criterion(pred_target_y_domain_dim1, target_y_domain_batch)
+
+        ## 1.2.2 Domain Classifier Dim2
+        pred_target_y_domain_dim2 = self.domain_classifier_dim2(target_X_batch)
+        pred_target_prime_y_domain = self.domain_classifier_dim2(target_prime_X_batch)
+
+        pred_target_y_domain_dim2 = torch.sigmoid(pred_target_y_domain_dim2.float()).reshape(-1)
+        pred_target_prime_y_domain = torch.sigmoid(pred_target_prime_y_domain.float()).reshape(-1)
+
+        loss_domain_dim2 = self.criterion(pred_target_y_domain_dim2, target_y_domain_batch)
+        loss_domain_dim2 += self.criterion(pred_target_prime_y_domain, target_prime_y_domain_batch)
+
+        ## 1.3 Task Classifier
+        pred_y_task = self.task_classifier.predict_proba(source_X_batch).float()
+        if self.task_classifier.output_size == 1:
+            criterion_task = nn.BCELoss()
+        else:
+            criterion_task = nn.CrossEntropyLoss()
+        loss_task = criterion_task(pred_y_task, source_y_task_batch)
+
+        losses = {"loss_domain_dim1": loss_domain_dim1, "loss_domain_dim2": loss_domain_dim2, "loss_task": loss_task}
+        return loss_domain_dim1 + loss_domain_dim2 + loss_task, losses
+
+    def backward(self, loss, losses):
+        if self.config["is_single_backward"]:
+            loss.backward()
+        else:
+            loss_domain = losses["loss_domain_dim1"] + losses["loss_domain_dim2"]
             loss_domain.backward(retain_graph=True)
-            loss_task.backward()
-            # 3. Update Params
-
-            feature_optimizer.step()
-            domain_optimizer_dim1.step()
-            domain_optimizer_dim2.step()
-            task_optimizer.step()
-
-        # Eval
-        feature_extractor.eval()
-        task_classifier.eval()
-        with torch.no_grad():
-            target_prime_feature_eval = feature_extractor(target_prime_X)
-            pred_y_task_eval = task_classifier.predict(target_prime_feature_eval)
-            acc = sum(pred_y_task_eval == target_prime_y_task) / target_prime_y_task.shape[0]
-            early_stopping(acc)
-        loss_task_evals.append(acc.item())
-        if early_stopping.early_stop & do_early_stop:
-            break
-        print(
-            f"Epoch: {epoch}, Loss Domain Dim1: {loss_domain_dim1}, Loss Domain Dim2: {loss_domain_dim2},  Loss Task: {loss_task}, Acc: {acc}"
-        )
+            losses["loss_task"].backward()
+
+    def plot(self, traces, loss_task_evals):
+        _plot_dann2D_loss(traces["loss_domain_dim1"], traces["loss_domain_dim2"], traces["loss_task"], loss_task_evals)
 
-    # Plot
-    if do_plot:
-        plt.plot(loss_domain_dim1s, label="loss domain dim1")
-        plt.plot(loss_domain_dim2s, label="loss domain dim2")
-        plt.plot(loss_tasks, label="loss task")
-        plt.xlabel("batch")
-        plt.ylabel("entropy loss")
-        plt.legend()
-        plt.show()
-
-        plt.figure()
-        plt.plot(loss_task_evals)
-        plt.xlabel("epoch")
-        plt.ylabel("accuracy")
-        plt.show()
-    return feature_extractor, task_classifier, acc.item()
-
-
-def _change_lr_during_dann2D_training(
-    feature_optimizer: torch.optim.Adam,
-    domain_optimizer_dim1: torch.optim.Adam,
-    domain_optimizer_dim2: torch.optim.Adam,
-    task_optimizer: torch.optim.Adam,
-    epoch: torch.Tensor,
-    epoch_thr: int = 200,
-    changed_lrs: List[float] = [0.00005, 0.00005],
-):
-    if epoch == epoch_thr:
-        domain_optimizer_dim1.param_groups[0]["lr"] = changed_lrs[1]
-        domain_optimizer_dim2.param_groups[0]["lr"] = changed_lrs[1]
-        feature_optimizer.param_groups[0]["lr"] = changed_lrs[0]
-        task_optimizer.param_groups[0]["lr"] = changed_lrs[0]
-    return feature_optimizer, domain_optimizer_dim1, domain_optimizer_dim2, task_optimizer
+
+def fit(data, network, **kwargs):
+    """
+    Returns
+    -------
+    feature_extractor : subclass of torch.nn.Module
+    task_classifier : subclass of torch.nn.Module
+    acc : float
+    accuracy on target_prime_X of the returned networks, the best evaluated ones when they are kept.
+    """
+    trainer = Dann2DTrainer(data, network, **kwargs)
+    trainer.fit()
+    return network["feature_extractor"], network["task_classifier"], trainer.evaluator.final_acc
+
+
+def _plot_dann2D_loss(
+    loss_domains_dim1: List[float],
+    loss_domains_dim2: List[float],
+    loss_tasks: List[float],
+    loss_task_evals: List[float],
+) -> None:
+    plt.plot(loss_domains_dim1, label="loss domain dim1")
+    plt.plot(loss_domains_dim2, label="loss domain dim2")
+    plt.plot(loss_tasks, label="loss task")
+    plt.xlabel("batch")
+    plt.ylabel("entropy loss")
+    plt.legend()
+    plt.show()
+
+    plt.figure()
+    plt.plot(loss_task_evals)
+    plt.xlabel("epoch")
+    plt.ylabel("accuracy")
+    plt.show()
@@ -3,10 +3,9 @@ from typing import List
 import matplotlib.pyplot as plt
 import torch
 from torch import nn
-from tqdm import tqdm
 
-from ..utils import utils
-from .algo_utils import EarlyStopping, get_psuedo_label_weights, get_terminal_weights
+from .algo_utils import get_psuedo_label_weights, get_terminal_weights
+from .trainer import Trainer
 
 
 class ReverseGradient(torch.autograd.Function):
@@ -15,17 +14,84 @@ class ReverseGradient(torch.autograd.Function):
     """
 
     @staticmethod
-    def forward(ctx, x: torch.Tensor, step: torch.Tensor, num_steps: torch.Tensor):
-        # TODO: Refactor num_steps, should not pass iteratively.
-        ctx.save_for_backward(step, num_steps)
+    def forward(ctx, x: torch.Tensor, adaptation_factor: float):
+        # adaptation_factor is precomputed on host by get_adaptation_factors
+        ctx.adaptation_factor = adaptation_factor
         return x
 
     @staticmethod
     def backward(ctx, grad_output: torch.Tensor):
-        step, num_steps, = ctx.saved_tensors
-        scheduler = 2 / (1 + torch.exp(-10 * (step / (num_steps + 1)))) - 1
         # https://arxiv.org/pdf/1505.07818.pdf
-        return grad_output * -1 * scheduler, None, None
+        return grad_output * -1 * ctx.adaptation_factor, None
+
+
+class DannTrainer(Trainer):
+    domain_optimizer_names = ["domain_optimizer"]
+    loss_names = ["loss_domain", "loss_task"]
+    default_config = {
+        "is_target_weights": False,
+        "is_class_weights": False,
+        "is_psuedo_weights": False,
+        "is_single_backward": True,
+    }
+
+    def __init__(self, data, network, **kwargs):
+        super().__init__(data, network, **kwargs)
+        self.domain_classifier = network["domain_classifier"]
+        self.criterion = network["criterion"]
+        self.reverse_grad = ReverseGradient.apply
+
+    def compute_losses(self, batch):
+        (source_X_batch, source_Y_batch), (target_X_batch, target_y_domain_batch) = batch
+        # 0. Data
+        source_y_task_batch, source_y_domain_batch = self.get_source_y(source_Y_batch)
+        psuedo_label_weights = get_psuedo_label_weights(source_Y_batch=source_Y_batch, device=self.device)
+
+        # 1. Forward
+        # 1.1 Feature Extractor
+        source_X_batch, target_X_batch = self.forward_features([source_X_batch, target_X_batch])
+
+        # 1.2. Domain Classifier
+        source_X_batch_reversed_grad = self.reverse_grad(source_X_batch, self.adaptation_factor)
+        target_X_batch = self.reverse_grad(target_X_batch, self.adaptation_factor)
+        pred_source_y_domain = self.domain_classifier(source_X_batch_reversed_grad)
+        pred_target_y_domain = self.domain_classifier(target_X_batch)
+        # float32 under is_autocast, the target weights p/(1-p) blow up with bfloat16 p
+        pred_source_y_domain = torch.sigmoid(pred_source_y_domain.float()).reshape(-1)
+        pred_target_y_domain = torch.sigmoid(pred_target_y_domain.float()).reshape(-1)
+
+        loss_domain = self.criterion(pred_source_y_domain, source_y_domain_batch)
+        loss_domain += self.criterion(pred_target_y_domain, target_y_domain_batch)
+
+        # 1.3. Task Classifier
+        pred_y_task = self.task_classifier.predict_proba(source_X_batch).float()
+        weights = get_terminal_weights(
+            self.config["is_target_weights"],
+            self.config["is_class_weights"],
+            self.config["is_psuedo_weights"],
+            pred_source_y_domain,
+            source_y_task_batch,
+            psuedo_label_weights,
+        )
+        if self.task_classifier.output_size == 1:
+            criterion_weight = nn.BCELoss(weight=weights.detach())
+            loss_task = criterion_weight(pred_y_task, source_y_task_batch)
+        else:
+            criterion_weight = nn.CrossEntropyLoss(reduction="none")
+            loss_task = criterion_weight(pred_y_task, source_y_task_batch)
+            loss_task = loss_task * weights
+            loss_task = loss_task.mean()
+        return loss_domain + loss_task, {"loss_domain": loss_domain, "loss_task": loss_task}
+
+    def backward(self, loss, losses):
+        if self.config["is_single_backward"]:
+            loss.backward()
+        else:
+            losses["loss_domain"].backward(retain_graph=True)
+            losses["loss_task"].backward()
+
+    def plot(self, traces, loss_task_evals):
+        _plot_dann_loss(True, traces["loss_domain"], traces["loss_task"], loss_task_evals)
 
 
 def fit(data, network, **kwargs):
@@ -39,189 +105,8 @@ def fit(data, network, **kwargs):
     task_classifier : subclass of torch.nn.Module
     loss_task_evals : list of float
     """
-    # Args
-    source_loader, target_loader = data["source_loader"], data["target_loader"]
-    target_X, target_y_task = data["target_X"], data["target_y_task"]
-
-    feature_extractor, domain_classifier, task_classifier = (
-        network["feature_extractor"],
-        network["domain_classifier"],
-        network["task_classifier"],
-    )
-    criterion = network["criterion"]
-    feature_optimizer, domain_optimizer, task_optimizer = (
-        network["feature_optimizer"],
-        network["domain_optimizer"],
-        network["task_optimizer"],
-    )
-
-    config = {
-        "num_epochs": 1000,
-        "is_target_weights": False,
-        "is_class_weights": False,
-        "is_psuedo_weights": False,
-        "do_plot": False,
-        "do_print": False,
-        "device": utils.DEVICE,
-        "is_changing_lr": False,
-        "epoch_thr_for_changing_lr": 200,
-        "changed_lrs": [0.00005, 0.00005],
-        "stop_during_epochs": False,
-        "epoch_thr_for_stopping": 2,
-        "do_early_stop": False,
-    }
-    config.update(kwargs)
-    num_epochs = config["num_epochs"]
-    is_target_weights, is_class_weights, is_psuedo_weights = (
-        config["is_target_weights"],
-        config["is_class_weights"],
-        config["is_psuedo_weights"],
-    )
-    do_plot, _ = config["do_plot"], config["do_print"]
-    device = config["device"]
-    is_changing_lr, epoch_thr_for_changing_lr, changed_lrs = (
-        config["is_changing_lr"],
-        config["epoch_thr_for_changing_lr"],
-        config["changed_lrs"],
-    )
-    stop_during_epochs, epoch_thr_for_stopping = config["stop_during_epochs"], config["epoch_thr_for_stopping"]
-    do_early_stop = config["do_early_stop"]
-    # Fit
-    reverse_grad = ReverseGradient.apply
-    early_stopping = EarlyStopping()
-
-    # TODO: Understand torch.autograd.Function.apply
-    loss_domains = []
-    loss_tasks = []
-    loss_task_evals = []
-    num_epochs = torch.tensor(num_epochs, dtype=torch.int32).to(device)
-
-    for epoch in tqdm(range(1, num_epochs.item() + 1)):
-        epoch = torch.tensor(epoch, dtype=torch.float32).to(device)
-        feature_extractor.train()
-        task_classifier.train()
-
-        if stop_during_epochs & (epoch.item() == epoch_thr_for_stopping):
-            break
-        if is_changing_lr:
-            domain_optimizer, feature_optimizer, task_optimizer = _change_lr_during_dann_training(
-                domain_optimizer,
-                feature_optimizer,
-                task_optimizer,
-                epoch,
-                epoch_thr=epoch_thr_for_changing_lr,
-                changed_lrs=changed_lrs,
-            )
-
-        for (source_X_batch, source_Y_batch), (target_X_batch, target_y_domain_batch) in zip(
-            source_loader, target_loader
-        ):
-            # 0. Data
-            if task_classifier.output_size == 1:
-                source_y_task_batch = source_Y_batch[:, utils.COL_IDX_TASK] > 0.5
-                source_y_task_batch = source_y_task_batch.to(torch.float32)
-                source_y_domain_batch = source_Y_batch[:, utils.COL_IDX_DOMAIN]
-            else:
-                if is_psuedo_weights:
-                    output_size = source_Y_batch[:, :-1].shape[1]
-                    source_y_task_batch = source_Y_batch[:, :output_size]
-                    source_y_task_batch = torch.argmax(source_y_task_batch, dim=1)
-                    source_y_task_batch = source_y_task_batch.to(torch.long)
-                    source_y_domain_batch = source_Y_batch[:, output_size]
-                else:
-                    source_y_task_batch = source_Y_batch[:, utils.COL_IDX_TASK]
-                    source_y_task_batch = source_y_task_batch.to(torch.long)
-                    source_y_domain_batch = source_Y_batch[:, utils.COL_IDX_DOMAIN]
-
-            psuedo_label_weights = get_psuedo_label_weights(source_Y_batch=source_Y_batch, device=device)
-
-            # 1. Forward
-            # 1.1 Feature Extractor
-            source_X_batch = feature_extractor(source_X_batch)
-            target_X_batch = feature_extractor(target_X_batch)
-
-            # 1.2. Domain Classifier
-            source_X_batch_reversed_grad = reverse_grad(source_X_batch, epoch, num_epochs)
-            target_X_batch = reverse_grad(target_X_batch, epoch, num_epochs)
-            pred_source_y_domain = domain_classifier(source_X_batch_reversed_grad)
-            pred_target_y_domain = domain_classifier(target_X_batch)
-            pred_source_y_domain = torch.sigmoid(pred_source_y_domain).reshape(-1)
-            pred_target_y_domain = torch.sigmoid(pred_target_y_domain).reshape(-1)
-
-            loss_domain = criterion(pred_source_y_domain, source_y_domain_batch)
-            loss_domain += criterion(pred_target_y_domain, target_y_domain_batch)
-            loss_domains.append(loss_domain.item())
-
-            # 1.3. Task Classifier
-            pred_y_task = task_classifier.predict_proba(source_X_batch)
-            weights = get_terminal_weights(
-                is_target_weights,
-                is_class_weights,
-                is_psuedo_weights,
-                pred_source_y_domain,
-                source_y_task_batch,
-                psuedo_label_weights,
-            )
-            if task_classifier.output_size == 1:
-                criterion_weight = nn.BCELoss(weight=weights.detach())
-                loss_task = criterion_weight(pred_y_task, source_y_task_batch)
-                loss_tasks.append(loss_task.item())
-            else:
-                criterion_weight = nn.CrossEntropyLoss(reduction="none")
-                loss_task = criterion_weight(pred_y_task, source_y_task_batch)
-                loss_task = loss_task * weights
-                loss_task = loss_task.mean()
-                loss_tasks.append(loss_task.item())
-
-            # 2. Backward, Update Params
-
-            domain_optimizer.zero_grad()
-            task_optimizer.zero_grad()
-            feature_optimizer.zero_grad()
-
-            loss_domain.backward(retain_graph=True)
-            loss_task.backward()
-
-            domain_optimizer.step()
-            task_optimizer.step()
-            feature_optimizer.step()
-
-        # 3. Evaluation
-        feature_extractor.eval()
-        task_classifier.eval()
-        with torch.no_grad():
-            target_feature_eval = feature_extractor(target_X)
-            pred_y_task_eval = task_classifier.predict(target_feature_eval)
-            acc = sum(pred_y_task_eval == target_y_task) / target_y_task.shape[0]
-            early_stopping(acc)
-        loss_task_evals.append(acc.item())
-        if early_stopping.early_stop & do_early_stop:
-            break
-        print(f"Epoch: {epoch}, Loss Domain: {loss_domain}, Loss Task: {loss_task}, Acc: {acc}")
-    _plot_dann_loss(do_plot, loss_domains, loss_tasks, loss_task_evals)
-    return feature_extractor, task_classifier, loss_task_evals
-
-
-def _change_lr_during_dann_training(
-    domain_optimizer: torch.optim.Adam,
-    feature_optimizer: torch.optim.Adam,
-    task_optimizer: torch.optim.Adam,
-    epoch: torch.Tensor,
-    epoch_thr: int = 200,
-    changed_lrs: List[float] = [0.00005, 0.00005],
-):
-    """
-    Returns
-    -------
-    domain_optimizer : torch.optim.adam.Adam
-    feature_optimizer : torch.optim.adam.Adam
-    task_optimizer : torch.optim.adam.Adam
-    """
-    if epoch == epoch_thr:
-        domain_optimizer.param_groups[0]["lr"] = changed_lrs[1]
-        feature_optimizer.param_groups[0]["lr"] = changed_lrs[0]
-        task_optimizer.param_groups[0]["lr"] = changed_lrs[0]
-    return domain_optimizer, feature_optimizer, task_optimizer
+    loss_task_evals = DannTrainer(data, network, **kwargs).fit()
+    return network["feature_extractor"], network["task_classifier"], loss_task_evals
 
 
 def _plot_dann_loss(
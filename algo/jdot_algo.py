@@ -1,173 +1,267 @@
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import List
 
 import matplotlib.pyplot as plt
-import ot
 import torch
 from torch import nn
-from tqdm import tqdm
 
-from ..utils import utils
-from .algo_utils import EarlyStopping, get_psuedo_label_weights
+from .algo_utils import get_psuedo_label_weights
+from .ot_utils import ALIGNMENTS, DualPotentialCache, get_optimal_transport_weights, sliced_wasserstein_distance
+from .trainer import Trainer
 
 
-def fit(data, network, **kwargs):
+def get_pseudo_task_loss_mat(pred_y_task, y_task):
     """
-    Fit Feature Extractor, Task Classifier by DeepJDOT algo.
-    https://arxiv.org/abs/1803.10081
+    Cross entropy of every prediction against every label, pred_y_task taken as logits like nn.CrossEntropyLoss,
+    logsumexp(pred) - pred[label] gathered per label instead of expanding to (N, M, C).
+
+    Parameters
+    ----------
+    pred_y_task : torch.Tensor of shape(N, ) for binary, (N, C) otherwise
+        probabilities of the predictions, rows of the matrix.
+    y_task : torch.Tensor of shape(M, )
+        labels, columns of the matrix.
+
+    Returns
+    -------
+    loss_pseudo_task_mat : torch.Tensor of shape(N, M)
     """
-    # Args
-    source_loader, target_loader = data["source_loader"], data["target_loader"]
-    target_X, target_y_task = data["target_X"], data["target_y_task"]
-
-    feature_extractor, task_classifier = (
-        network["feature_extractor"],
-        network["task_classifier"],
-    )
-    feature_optimizer, task_optimizer = (
-        network["feature_optimizer"],
-        network["task_optimizer"],
-    )
-    config = {
-        "num_epochs": 1000,
+    y_task = y_task.to(torch.long)
+    if pred_y_task.dim() == 1:
+        # logits of the binary classes are [1 - p, p]
+        pred_y_task = pred_y_task.unsqueeze(1)
+        log_sum_exp = torch.logaddexp(1 - pred_y_task, pred_y_task)
+        return log_sum_exp - torch.where(y_task.unsqueeze(0) == 1, pred_y_task, 1 - pred_y_task)
+    return torch.logsumexp(pred_y_task, dim=1, keepdim=True) - pred_y_task[:, y_task]
+
+
+class JdotTrainer(Trainer):
+    loss_names = ["loss_domain", "loss_pseudo_task", "loss_task"]
+    default_config = {
         "is_target_weights": False,
         "is_class_weights": False,
         "is_psuedo_weights": False,
-        "do_plot": False,
-        "do_print": False,
-        "device": utils.DEVICE,
-        "is_changing_lr": False,
-        "epoch_thr_for_changing_lr": 200,
-        "changed_lrs": [0.00005, 0.00005],
-        "stop_during_epochs": False,
-        "epoch_thr_for_stopping": 2,
-        "do_early_stop": False,
+        "ot_backend": "emd",
+        "sinkhorn_epsilon": 0.1,
+        "sinkhorn_num_iters": 100,
+        "sinkhorn_threshold": None,
+        "is_warm_start": False,
+        "is_async_ot": False,
+        "alignment": "ot",
+        "num_projections": 50,
+        "is_label_aware": True,
     }
-    config.update(kwargs)
-    num_epochs = config["num_epochs"]
-    is_psuedo_weights = config["is_psuedo_weights"]
-    do_plot, _ = config["do_plot"], config["do_print"]
-    device = config["device"]
-    is_changing_lr, epoch_thr_for_changing_lr, changed_lrs = (
-        config["is_changing_lr"],
-        config["epoch_thr_for_changing_lr"],
-        config["changed_lrs"],
-    )
-    stop_during_epochs, epoch_thr_for_stopping = config["stop_during_epochs"], config["epoch_thr_for_stopping"]
-    do_early_stop = config["do_early_stop"]
-    # Fit
-    early_stopping = EarlyStopping()
-    loss_domains = []
-    loss_tasks = []
-    loss_task_evals = []
-    loss_pseudo_tasks = []
-    num_epochs = torch.tensor(num_epochs, dtype=torch.int32).to(device)
-    for epoch in tqdm(range(1, num_epochs.item() + 1)):
-        epoch = torch.tensor(epoch, dtype=torch.float32).to(device)
-        scheduler = 2 / (1 + torch.exp(-10 * (epoch / (num_epochs + 1)))) - 1
-        feature_extractor.train()
-        task_classifier.train()
-        if stop_during_epochs & (epoch.item() == epoch_thr_for_stopping):
-            break
-        if is_changing_lr:
-            feature_optimizer, task_optimizer = _change_lr_during_jdot_training(
-                feature_optimizer, task_optimizer, epoch, epoch_thr=epoch_thr_for_changing_lr, changed_lrs=changed_lrs,
-            )
-        # batch_training
-        for (source_X_batch, source_Y_batch), (target_X_batch, _) in zip(source_loader, target_loader):
-            # 0. Data
-            if task_classifier.output_size == 1:
-                source_y_task_batch = source_Y_batch[:, utils.COL_IDX_TASK] > 0.5
-                source_y_task_batch = source_y_task_batch.to(torch.float32)
-            else:
-                if is_psuedo_weights:
-                    output_size = source_Y_batch[:, :-1].shape[1]
-                    source_y_task_batch = source_Y_batch[:, :output_size]
-                    source_y_task_batch = torch.argmax(source_y_task_batch, dim=1)
-                    source_y_task_batch = source_y_task_batch.to(torch.long)
-                else:
-                    source_y_task_batch = source_Y_batch[:, utils.COL_IDX_TASK]
-                    source_y_task_batch = source_y_task_batch.to(torch.long)
-            if is_psuedo_weights:
-                weights = get_psuedo_label_weights(source_Y_batch=source_Y_batch, device=device).detach()
-            else:
-                weights = torch.ones_like(source_y_task_batch)
-            # 1. Forward
-            # 1.1 Feature Extractor
-            source_X_batch = feature_extractor(source_X_batch)
-            target_X_batch = feature_extractor(target_X_batch)
-            # 1.2 Task Classifier
-            pred_source_y_task = task_classifier.predict_proba(source_X_batch)
-            pred_target_y_task = task_classifier.predict_proba(target_X_batch)
-
-            # 1.3 Optimal Transport
-            loss_domain_mat = torch.cdist(target_X_batch, source_X_batch, p=2).to("cpu")
-
-            criterion_pseudo = nn.CrossEntropyLoss(reduction="none")
-            if task_classifier.output_size == 1:
-                pred_target_y_task = torch.cat(
-                    [(1 - pred_target_y_task).reshape(-1, 1), pred_target_y_task.reshape(-1, 1)], dim=1
-                )
-            num_classes = pred_target_y_task.shape[1]
-            pred_target_y_task = pred_target_y_task.unsqueeze(0).expand(len(source_y_task_batch), -1, -1)
-            source_y_task_batch_expanded = source_y_task_batch.unsqueeze(1).expand(-1, pred_target_y_task.shape[1])
-            loss_pseudo_task_mat = (
-                criterion_pseudo(
-                    pred_target_y_task.reshape(-1, num_classes), source_y_task_batch_expanded.reshape(-1).to(torch.long)
-                )
-                .reshape(len(source_y_task_batch_expanded), pred_target_y_task.shape[1])
-                .T
+
+    def __init__(self, data, network, **kwargs):
+        super().__init__(data, network, **kwargs)
+        if self.config["alignment"] not in ALIGNMENTS:
+            raise ValueError(f"alignment should be one of {ALIGNMENTS}, got {self.config['alignment']}")
+        self.potential_cache = DualPotentialCache()
+        self.ot_num_iters = None
+        self._ot_executor = None
+        self._pending_ot = None
+        if self.config["ot_backend"] == "sinkhorn":
+            self.loss_names = self.loss_names + ["ot_num_iters"]
+
+    def compute_losses(self, batch):
+        (source_X_batch, source_Y_batch, *source_ids), (target_X_batch, _, *target_ids) = batch
+        # 0. Data
+        source_y_task_batch, _ = self.get_source_y(source_Y_batch)
+        if self.config["is_psuedo_weights"]:
+            weights = get_psuedo_label_weights(source_Y_batch=source_Y_batch, device=self.device).detach()
+        else:
+            weights = torch.ones_like(source_y_task_batch)
+        # 1. Forward
+        # 1.1 Feature Extractor
+        source_X_batch, target_X_batch = self.forward_features([source_X_batch, target_X_batch])
+        # 1.2 Task Classifier
+        pred_source_y_task = self.task_classifier.predict_proba(source_X_batch).float()
+        pred_target_y_task = self.task_classifier.predict_proba(target_X_batch).float()
+
+        # 1.3 Optimal Transport
+        if self.config["alignment"] == "sliced":
+            loss_domain, loss_pseudo_task = self.get_sliced_losses(
+                target_X_batch, source_X_batch, pred_target_y_task, source_y_task_batch
             )
-            loss_pseudo_task_mat = loss_pseudo_task_mat.to("cpu")
+        else:
+            # cost matrix in float32 even under is_autocast, the plan is sensitive to ties
+            with self.float32():
+                loss_domain_mat = torch.cdist(target_X_batch.float(), source_X_batch.float(), p=2)
+            loss_pseudo_task_mat = get_pseudo_task_loss_mat(pred_target_y_task, source_y_task_batch)
 
             cost_mat = loss_domain_mat + loss_pseudo_task_mat
-            optimal_transport_weights = ot.emd(
-                torch.ones(len(target_X_batch)) / len(target_X_batch),
-                torch.ones(len(source_X_batch)) / len(source_X_batch),
-                cost_mat,
+            future = self.submit_optimal_transport_weights(
+                [cost_mat], ids=[(_get_ids(target_ids), _get_ids(source_ids))]
             )
 
-            # 1.4 Align Loss
-            loss_domain = torch.mean(optimal_transport_weights * loss_domain_mat)
-            loss_domains.append(loss_domain.item())
-
-            # 1.5 Task Loss
-            loss_pseudo_task = torch.mean(optimal_transport_weights * loss_pseudo_task_mat)
-            loss_pseudo_tasks.append(loss_pseudo_task.item())
-            if task_classifier.output_size == 1:
-                criterion_weight = nn.BCELoss(weight=weights.detach())
-                loss_task = criterion_weight(pred_source_y_task, source_y_task_batch)
-                loss_tasks.append(loss_task.item())
-            else:
-                criterion_weight = nn.CrossEntropyLoss(reduction="none")
-                loss_task = criterion_weight(pred_source_y_task, source_y_task_batch)
-                loss_task = loss_task * weights
-                loss_task = loss_task.mean()
-                loss_tasks.append(loss_task.item())
-
-            # 2. Backward
-            loss = loss_task + scheduler * loss_domain + loss_pseudo_task
-            feature_optimizer.zero_grad()
-            task_optimizer.zero_grad()
+        # 1.4 Task Loss
+        if self.task_classifier.output_size == 1:
+            criterion_weight = nn.BCELoss(weight=weights.detach())
+            loss_task = criterion_weight(pred_source_y_task, source_y_task_batch)
+        else:
+            criterion_weight = nn.CrossEntropyLoss(reduction="none")
+            loss_task = criterion_weight(pred_source_y_task, source_y_task_batch)
+            loss_task = loss_task * weights
+            loss_task = loss_task.mean()
+
+        # 1.5 Align Loss
+        if self.config["alignment"] != "sliced":
+            return self.get_ot_losses(loss_task, future, [loss_domain_mat], [loss_pseudo_task_mat])
+        loss = loss_task + self.adaptation_factor * loss_domain + loss_pseudo_task
+        return loss, {"loss_domain": loss_domain, "loss_pseudo_task": loss_pseudo_task, "loss_task": loss_task}
+
+    def get_ot_losses(self, loss_task, future, loss_domain_mats, loss_pseudo_task_mats):
+        """
+        Loss and its terms given the plans of future. With is_async_ot only loss_task is returned, the plans are
+        awaited by backward after the backward of loss_task, which runs while they are solved.
+
+        Parameters
+        ----------
+        loss_task : torch.Tensor of shape()
+        future : concurrent.futures.Future of list of torch.Tensor of shape(N_k, M_k)
+        loss_domain_mats : list of torch.Tensor of shape(N_k, M_k)
+        loss_pseudo_task_mats : list of torch.Tensor of shape(N_k, M_k)
+        """
+        losses = {"loss_task": loss_task}
+        if self.config["is_async_ot"]:
+            self._pending_ot = (future, loss_domain_mats, loss_pseudo_task_mats)
+            return loss_task, losses
+        align_loss = self._add_align_losses(losses, future.result(), loss_domain_mats, loss_pseudo_task_mats)
+        return loss_task + align_loss, self.add_ot_num_iters(losses)
+
+    def backward(self, loss, losses):
+        if self._pending_ot is None:
             loss.backward()
-            # 3. Update Params
-            feature_optimizer.step()
-            task_optimizer.step()
-        # 4. Eval
-        feature_extractor.eval()
-        task_classifier.eval()
-        with torch.no_grad():
-            target_feature_eval = feature_extractor(target_X)
-            pred_y_task_eval = task_classifier.predict(target_feature_eval)
-            acc = sum(pred_y_task_eval == target_y_task) / target_y_task.shape[0]
-            early_stopping(acc)
-        loss_task_evals.append(acc.item())
-        if early_stopping.early_stop & do_early_stop:
-            break
-        print(
-            f"Epoch: {epoch}, Loss Domain: {loss_domain}, Loss Task: {loss_task}, Loss Pseudo Task: {loss_pseudo_task}, Acc: {acc}"
+            return
+        future, loss_domain_mats, loss_pseudo_task_mats = self._pending_ot
+        self._pending_ot = None
+        # the graph up to the features is shared with the align loss, the gradients of both add up
+        loss.backward(retain_graph=True)
+        align_loss = self._add_align_losses(losses, future.result(), loss_domain_mats, loss_pseudo_task_mats)
+        align_loss.backward()
+        self.add_ot_num_iters(losses)
+
+    def _add_align_losses(self, losses, optimal_transport_weights, loss_domain_mats, loss_pseudo_task_mats):
+        losses["loss_domain"] = sum(
+            torch.mean(weights * mat) for weights, mat in zip(optimal_transport_weights, loss_domain_mats)
         )
-    _plot_jdot_loss(do_plot, loss_domains, loss_pseudo_tasks, loss_tasks, loss_task_evals)
-    return feature_extractor, task_classifier, loss_task_evals
+        losses["loss_pseudo_task"] = sum(
+            torch.mean(weights * mat) for weights, mat in zip(optimal_transport_weights, loss_pseudo_task_mats)
+        )
+        return self.adaptation_factor * losses["loss_domain"] + losses["loss_pseudo_task"]
+
+    def fit(self):
+        try:
+            return super().fit()
+        finally:
+            if self._ot_executor is not None:
+                self._ot_executor.shutdown()
+                self._ot_executor = None
+
+    def submit_optimal_transport_weights(self, cost_mats, ids=None):
+        """
+        Start solving the plans, with is_async_ot on a background thread so that the backward of the task loss
+        goes on meanwhile (see backward). Only the plans of the current step are in flight, so the gradients are
+        the same as the serial ones.
+
+        Parameters
+        ----------
+        cost_mats : list of torch.Tensor of shape(N_k, M_k)
+        ids : list of (row_ids, col_ids) or None
+            sample ids of the rows and the columns per problem, to warm-start by id if the loaders yield them.
+
+        Returns
+        -------
+        future : concurrent.futures.Future of list of torch.Tensor of shape(N_k, M_k)
+        """
+        if self.config["is_async_ot"]:
+            if self._ot_executor is None:
+                self._ot_executor = ThreadPoolExecutor(max_workers=1)
+            return self._ot_executor.submit(self.get_optimal_transport_weights, cost_mats, ids)
+        future = Future()
+        future.set_result(self.get_optimal_transport_weights(cost_mats, ids))
+        return future
+
+    def get_optimal_transport_weights(self, cost_mats, ids=None):
+        ids = ids or [(None, None)] * len(cost_mats)
+        init_potentials = None
+        if self.config["is_warm_start"]:
+            init_potentials = [
+                self.potential_cache.get(k, cost_mat.shape, *ids[k]) for k, cost_mat in enumerate(cost_mats)
+            ]
+        optimal_transport_weights, log = get_optimal_transport_weights(
+            cost_mats,
+            backend=self.config["ot_backend"],
+            epsilon=self.config["sinkhorn_epsilon"],
+            num_iters=self.config["sinkhorn_num_iters"],
+            threshold=self.config["sinkhorn_threshold"],
+            init_potentials=init_potentials,
+            log=True,
+            # the plans of a step are solved concurrently, Jdot2DTrainer only as JdotTrainer has one
+            num_workers=self.config.get("ot_num_workers", 1),
+        )
+        if self.config["is_warm_start"]:
+            for k, potentials in enumerate(log["potentials"]):
+                self.potential_cache.update(k, potentials, *ids[k])
+        self.ot_num_iters = log["num_iters"]
+        return optimal_transport_weights
+
+    def get_sliced_losses(self, X_rows, X_cols, pred_y_task_rows, y_task_cols):
+        """
+        Sliced Wasserstein counterparts of the JDOT terms, for batches too large for an exact plan.
+        loss_domain aligns the features. The label-aware loss_pseudo_task aligns the joint (feature, label)
+        distributions with the features detached, so that only the predictions of the rows are pulled towards
+        the labels of the columns they match.
+
+        Parameters
+        ----------
+        X_rows : torch.Tensor of shape(N, D)
+        X_cols : torch.Tensor of shape(M, D)
+        pred_y_task_rows : torch.Tensor of shape(N, ) for binary, (N, C) otherwise
+        y_task_cols : torch.Tensor of shape(M, )
+
+        Returns
+        -------
+        loss_domain : torch.Tensor of shape()
+        loss_pseudo_task : torch.Tensor of shape()
+        """
+        num_projections = self.config["num_projections"]
+        loss_domain = sliced_wasserstein_distance(X_rows, X_cols, num_projections=num_projections)
+        if not self.config["is_label_aware"]:
+            return loss_domain, torch.zeros((), device=loss_domain.device)
+        if pred_y_task_rows.dim() == 1:
+            pred_y_task_rows = torch.stack([1 - pred_y_task_rows, pred_y_task_rows], dim=1)
+        y_task_cols = nn.functional.one_hot(y_task_cols.to(torch.long), num_classes=pred_y_task_rows.shape[1])
+        joint_rows = torch.cat([X_rows.detach().float(), pred_y_task_rows], dim=1)
+        joint_cols = torch.cat([X_cols.detach().float(), y_task_cols.float()], dim=1)
+        return loss_domain, sliced_wasserstein_distance(joint_rows, joint_cols, num_projections=num_projections)
+
+    def add_ot_num_iters(self, losses):
+        """
+        Log the sinkhorn iterations of the step along with the losses, to measure the savings of is_warm_start.
+        """
+        if self.ot_num_iters is not None:
+            losses["ot_num_iters"] = torch.tensor(float(self.ot_num_iters), device=self.device)
+        return losses
+
+    def plot(self, traces, loss_task_evals):
+        _plot_jdot_loss(True, traces["loss_domain"], traces["loss_pseudo_task"], traces["loss_task"], loss_task_evals)
+
+
+def fit(data, network, **kwargs):
+    """
+    Fit Feature Extractor, Task Classifier by DeepJDOT algo.
+    https://arxiv.org/abs/1803.10081
+    """
+    loss_task_evals = JdotTrainer(data, network, **kwargs).fit()
+    return network["feature_extractor"], network["task_classifier"], loss_task_evals
+
+
+def _get_ids(extra):
+    """
+    ids yielded by the loader as the third item of a batch, if any.
+    """
+    return extra[0] if extra else None
 
 
 def _plot_jdot_loss(
@@ -199,22 +293,3 @@ def _plot_jdot_loss(
         plt.xlabel("epoch")
         plt.ylabel("accuracy")
         plt.show()
-
-
-def _change_lr_during_jdot_training(
-    feature_optimizer: torch.optim.Adam,
-    task_optimizer: torch.optim.Adam,
-    epoch: torch.Tensor,
-    epoch_thr: int = 200,
-    changed_lrs: List[float] = [0.00005, 0.00005],
-):
-    """
-    Returns
-    -------
-    feature_optimizer : torch.optim.adam.Adam
-    task_optimizer : torch.optim.adam.Adam
-    """
-    if epoch == epoch_thr:
-        feature_optimizer.param_groups[0]["lr"] = changed_lrs[0]
-        task_optimizer.param_groups[0]["lr"] = changed_lrs[0]
-    return feature_optimizer, task_optimizer
@@ -0,0 +1,279 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import ot
+import torch
+
+OT_BACKENDS = ["emd", "sinkhorn"]
+ALIGNMENTS = ["ot", "sliced"]
+SINKHORN_CHECK_INTERVAL = 10
+
+
+def sinkhorn(a, b, cost_mat, epsilon=0.1, num_iters=100, threshold=None, init_potentials=None, log=False):
+    """
+    Entropic OT by log-domain stabilized Sinkhorn, on the device of cost_mat.
+    https://arxiv.org/abs/1803.00567 (Algorithm 3.1 / Remark 4.23)
+
+    Parameters
+    ----------
+    a : torch.Tensor of shape(..., N)
+    b : torch.Tensor of shape(..., M)
+        zero weights (padding) are allowed, their rows/columns of the plan are zero.
+    cost_mat : torch.Tensor of shape(..., N, M)
+        leading dims are a batch of independent problems.
+    epsilon : float
+        entropic regularization, the smaller the closer to emd and the slower to converge.
+    num_iters : int
+        maximum number of iterations.
+    threshold : float or None
+        stop once the L1 error of the row marginals is below threshold for every problem,
+        checked every SINKHORN_CHECK_INTERVAL iterations (one host sync each). None runs num_iters iterations.
+    init_potentials : tuple of torch.Tensor of shape(..., N), (..., M) or None
+        dual potentials (f, g) to warm-start from, zeros if None.
+    log : bool
+
+    Returns
+    -------
+    optimal_transport_weights : torch.Tensor of shape(..., N, M)
+    log : dict, only if log
+        "potentials": (f, g) to warm-start the next solve, "num_iters": the number of iterations run.
+    """
+    log_a, log_b = torch.log(a), torch.log(b)
+    log_kernel = -cost_mat / epsilon
+    if init_potentials is None:
+        f, g = torch.zeros_like(a), torch.zeros_like(b)
+    else:
+        f, g = init_potentials
+    # padded columns must not carry mass into the first update of f
+    g = torch.where(b > 0, g, torch.full_like(g, -float("inf")))
+    num_iters_run = 0
+    while num_iters_run < num_iters:
+        f = epsilon * (log_a - torch.logsumexp(log_kernel + g.unsqueeze(-2) / epsilon, dim=-1))
+        g = epsilon * (log_b - torch.logsumexp(log_kernel + f.unsqueeze(-1) / epsilon, dim=-2))
+        num_iters_run += 1
+        if (threshold is not None) and (num_iters_run % SINKHORN_CHECK_INTERVAL == 0):
+            optimal_transport_weights = torch.exp(log_kernel + f.unsqueeze(-1) / epsilon + g.unsqueeze(-2) / epsilon)
+            error = torch.sum(torch.abs(optimal_transport_weights.sum(dim=-1) - a), dim=-1).max()
+            if error.item() < threshold:
+                break
+    optimal_transport_weights = torch.exp(log_kernel + f.unsqueeze(-1) / epsilon + g.unsqueeze(-2) / epsilon)
+    if log:
+        return optimal_transport_weights, {"potentials": (f, g), "num_iters": num_iters_run}
+    return optimal_transport_weights
+
+
+def get_optimal_transport_weights(
+    cost_mats,
+    backend="emd",
+    epsilon=0.1,
+    num_iters=100,
+    threshold=None,
+    init_potentials=None,
+    log=False,
+    num_workers=1,
+):
+    """
+    Transport plans between uniform weights over the rows and the columns of each cost matrix.
+    The K problems may differ in size, they are zero-padded to one (K, N_max, M_max) problem with zero marginals
+    on the padding, so that sinkhorn solves all of them at once, e.g. the plans of every pair of adjacent domains.
+    The plans are constants of the loss as in DeepJDOT, so no gradient flows through them.
+
+    Parameters
+    ----------
+    cost_mats : list of torch.Tensor of shape(N_k, M_k)
+    backend : str
+        "emd" solves exactly by network simplex on CPU (POT), "sinkhorn" stays on the device.
+    epsilon : float
+        sinkhorn only.
+    num_iters : int
+        sinkhorn only.
+    threshold : float or None
+        sinkhorn only.
+    init_potentials : list of (torch.Tensor of shape(N_k, ), torch.Tensor of shape(M_k, )) or None
+        sinkhorn only, potentials to warm-start from per problem, an item may be None.
+    log : bool
+    num_workers : int
+        emd only, the K problems are solved concurrently on up to num_workers threads (the solver releases the GIL),
+        the plans are the same as the serial ones.
+
+    Returns
+    -------
+    optimal_transport_weights : list of torch.Tensor of shape(N_k, M_k), on the device of cost_mats
+    log : dict, only if log
+        "potentials": list of (f_k, g_k), "num_iters": the number of sinkhorn iterations (None for emd).
+    """
+    if backend not in OT_BACKENDS:
+        raise ValueError(f"ot_backend should be one of {OT_BACKENDS}, got {backend}")
+    device = cost_mats[0].device
+    shapes = [mat.shape for mat in cost_mats]
+    with torch.autocast(device.type, enabled=False):
+        cost_mat, a, b = _pad([mat.detach().float() for mat in cost_mats])
+        if backend == "emd":
+            optimal_transport_weights = torch.zeros_like(cost_mat)
+            f, g = torch.zeros_like(a), torch.zeros_like(b)
+            problems = [(a[k, :N].cpu(), b[k, :M].cpu(), cost_mat[k, :N, :M].cpu()) for k, (N, M) in enumerate(shapes)]
+            if num_workers > 1 and len(problems) > 1:
+                results = list(_get_executor(num_workers).map(lambda problem: _emd(*problem), problems))
+            else:
+                results = [_emd(*problem) for problem in problems]
+            for k, ((N, M), (optimal_transport_weights_k, log_k)) in enumerate(zip(shapes, results)):
+                optimal_transport_weights[k, :N, :M] = optimal_transport_weights_k.to(device)
+                f[k, :N], g[k, :M] = log_k["u"].to(device), log_k["v"].to(device)
+            sinkhorn_log = {"potentials": (f, g), "num_iters": None}
+        else:
+            optimal_transport_weights, sinkhorn_log = sinkhorn(
+                a,
+                b,
+                cost_mat,
+                epsilon=epsilon,
+                num_iters=num_iters,
+                threshold=threshold,
+                init_potentials=_pad_potentials(init_potentials, a, b),
+                log=True,
+            )
+    optimal_transport_weights = [optimal_transport_weights[k, :N, :M] for k, (N, M) in enumerate(shapes)]
+    if log:
+        f, g = sinkhorn_log["potentials"]
+        potentials = [(f[k, :N], g[k, :M]) for k, (N, M) in enumerate(shapes)]
+        return optimal_transport_weights, {"potentials": potentials, "num_iters": sinkhorn_log["num_iters"]}
+    return optimal_transport_weights
+
+
+def sliced_wasserstein_distance(x, y, num_projections=50, p=2):
+    """
+    Sliced Wasserstein distance, 1D OT along random directions solved by sorting, O(num_projections * N log N).
+    Differentiable w.r.t. x and y, unequal sizes are matched by quantiles.
+    https://arxiv.org/abs/1902.00434
+
+    Parameters
+    ----------
+    x : torch.Tensor of shape(N, D)
+    y : torch.Tensor of shape(M, D)
+    num_projections : int
+    p : int
+
+    Returns
+    -------
+    distance : torch.Tensor of shape()
+    """
+    with torch.autocast(x.device.type, enabled=False):
+        x, y = x.float(), y.float()
+        projections = torch.randn(x.shape[1], num_projections, device=x.device)
+        projections = projections / torch.norm(projections, dim=0, keepdim=True)
+        x_projected, _ = torch.sort(x @ projections, dim=0)
+        y_projected, _ = torch.sort(y @ projections, dim=0)
+        if x.shape[0] != y.shape[0]:
+            num_quantiles = max(x.shape[0], y.shape[0])
+            x_projected = _get_quantiles(x_projected, num_quantiles)
+            y_projected = _get_quantiles(y_projected, num_quantiles)
+        return torch.mean(torch.abs(x_projected - y_projected) ** p) ** (1 / p)
+
+
+def _get_quantiles(sorted_x, num_quantiles):
+    levels = (torch.arange(num_quantiles, device=sorted_x.device) + 0.5) / num_quantiles
+    return sorted_x[(levels * sorted_x.shape[0]).long()]
+
+
+def _emd(a, b, cost_mat):
+    return ot.emd(a, b, cost_mat, log=True)
+
+
+_EXECUTORS = {}
+
+
+def _get_executor(num_workers):
+    """
+    Thread pools shared by the whole process, one per num_workers.
+    """
+    if num_workers not in _EXECUTORS:
+        _EXECUTORS[num_workers] = ThreadPoolExecutor(max_workers=num_workers)
+    return _EXECUTORS[num_workers]
+
+
+class DualPotentialCache:
+    """
+    Dual potentials of the previous solves, to warm-start the next ones since consecutive batches have a similar
+    cost structure. With sample ids (e.g. a dataset yielding its indices), potentials are stored per sample and
+    looked up by id, unseen samples start from zero. Without ids, the previous potentials of the same problem
+    are reused as they are if the shape matches.
+    """
+
+    def __init__(self):
+        self._potentials = {}
+        self._potential_tables = {}
+
+    def get(self, key, shape, row_ids=None, col_ids=None):
+        """
+        Returns
+        -------
+        potentials : (torch.Tensor of shape(N, ), torch.Tensor of shape(M, )) or None
+        """
+        if (row_ids is not None) and (col_ids is not None):
+            if key not in self._potential_tables:
+                return None
+            f_table, g_table = self._potential_tables[key]
+            return _lookup(f_table, row_ids), _lookup(g_table, col_ids)
+        potentials = self._potentials.get(key)
+        if (potentials is None) or ((potentials[0].shape[0], potentials[1].shape[0]) != tuple(shape)):
+            return None
+        return potentials
+
+    def update(self, key, potentials, row_ids=None, col_ids=None):
+        f, g = potentials
+        if (row_ids is not None) and (col_ids is not None):
+            f_table, g_table = self._potential_tables.get(key, (None, None))
+            self._potential_tables[key] = (_store(f_table, row_ids, f), _store(g_table, col_ids, g))
+        else:
+            self._potentials[key] = (f.detach(), g.detach())
+
+
+def _lookup(table, ids):
+    ids = ids.to(table.device)
+    values = torch.zeros(len(ids), device=table.device)
+    is_stored = ids < len(table)
+    values[is_stored] = table[ids[is_stored]]
+    return torch.nan_to_num(values, nan=0.0)
+
+
+def _store(table, ids, values):
+    ids = ids.to(values.device)
+    size = int(ids.max().item()) + 1
+    if table is None:
+        table = torch.full((size,), float("nan"), device=values.device)
+    elif len(table) < size:
+        table = torch.cat([table, torch.full((size - len(table),), float("nan"), device=table.device)])
+    table[ids] = values.detach()
+    return table
+
+
+def _pad_potentials(potentials, a, b):
+    if potentials is None or all(item is None for item in potentials):
+        return None
+    f, g = torch.zeros_like(a), torch.zeros_like(b)
+    for k, item in enumerate(potentials):
+        if item is not None:
+            f[k, : len(item[0])], g[k, : len(item[1])] = item
+    return f, g
+
+
+def _pad(cost_mats):
+    """
+    Returns
+    -------
+    cost_mat : torch.Tensor of shape(K, N_max, M_max)
+    a : torch.Tensor of shape(K, N_max)
+        uniform over the N_k rows, zero on the padding.
+    b : torch.Tensor of shape(K, M_max)
+    """
+    K = len(cost_mats)
+    N_max = max(cost_mat.shape[0] for cost_mat in cost_mats)
+    M_max = max(cost_mat.shape[1] for cost_mat in cost_mats)
+    device = cost_mats[0].device
+    cost_mat = torch.zeros(K, N_max, M_max, device=device)
+    a = torch.zeros(K, N_max, device=device)
+    b = torch.zeros(K, M_max, device=device)
+    for k, mat in enumerate(cost_mats):
+        N, M = mat.shape
+        cost_mat[k, :N, :M] = mat
+        a[k, :N] = 1 / N
+        b[k, :M] = 1 / M
+    return cost_mat, a, b
@@ -0,0 +1,281 @@
+import itertools
+import math
+import time
+
+import torch
+from tqdm import tqdm
+
+from ..utils import utils
+from .algo_utils import (
+    EarlyStopping,
+    EvaluationScheduler,
+    MetricsAccumulator,
+    forward_fused,
+    get_adaptation_factors,
+    prefetch,
+)
+
+DEFAULT_CONFIG = {
+    "num_epochs": 1000,
+    "device": utils.DEVICE,
+    "is_changing_lr": False,
+    "epoch_thr_for_changing_lr": 200,
+    "changed_lrs": [0.00005, 0.00005],
+    "stop_during_epochs": False,
+    "epoch_thr_for_stopping": 2,
+    "do_early_stop": False,
+    "do_plot": False,
+    "do_print": False,
+    "print_interval": 1,
+    "log_interval": None,
+    "trace_interval": 1,
+    "is_fused_forward": False,
+    "is_domain_specific_bn": True,
+    "eval_interval": 1,
+    "eval_sample_size": None,
+    "is_async_eval": False,
+    "is_prefetch": False,
+    "prefetch_size": 2,
+    "is_compiled": False,
+    "drop_last": False,
+    "is_autocast": False,
+    "num_steps": None,
+    "time_budget": None,
+    "grl_gamma": 10,
+}
+
+
+class Trainer:
+    """
+    Shared epoch/batch loop of the UDA algos.
+    Subclasses only implement compute_losses(batch) and declare the loaders, optimizers and losses they use,
+    lr changing, logging, evaluation, early stopping, prefetch and torch.compile live here.
+    With is_compiled, compute_losses (forward and loss, hence the backward graph) runs under torch.compile,
+    and drop_last skips ragged batches so that the compiled step always sees the same shapes.
+    With is_autocast, compute_losses runs under bfloat16 autocast, subclasses keep the numerically sensitive
+    terms (covariance, OT cost, sigmoid/BCE, density ratio) in float32 by casting with .float().
+    With num_steps (total steps) or time_budget (seconds), loaders are cycled instead of zip-truncated,
+    an epoch is as long as the longest loader, and the weights evaluated best are restored at the end.
+    num_epochs derives from num_steps, time_budget stops training early and num_epochs still bounds it.
+
+    Parameters
+    ----------
+    data : dict
+        loaders named by loader_names and evaluation data named by eval_data_names.
+    network : dict
+        feature_extractor, task_classifier and optimizers named by task_optimizer_names, domain_optimizer_names.
+    **kwargs
+        config, overrides DEFAULT_CONFIG and default_config of the subclass.
+    """
+
+    loader_names = ["source_loader", "target_loader"]
+    eval_data_names = ["target_X", "target_y_task"]
+    task_optimizer_names = ["feature_optimizer", "task_optimizer"]
+    domain_optimizer_names = []
+    loss_names = []
+    default_config = {}
+
+    def __init__(self, data, network, **kwargs):
+        self.config = {**DEFAULT_CONFIG, **self.default_config}
+        self.config.update(kwargs)
+        self.data, self.network = data, network
+        self.feature_extractor = network["feature_extractor"]
+        self.task_classifier = network["task_classifier"]
+        self.task_optimizers = [network[name] for name in self.task_optimizer_names]
+        self.domain_optimizers = [network[name] for name in self.domain_optimizer_names]
+        self.device = self.config["device"]
+        self.device_type = torch.device(self.device).type
+        self.num_epochs = self.config["num_epochs"]
+        self.is_budgeted = (self.config["num_steps"] is not None) or (self.config["time_budget"] is not None)
+        if self.is_budgeted:
+            self.steps_per_epoch = max(len(self.data[name]) for name in self.loader_names)
+        if self.config["num_steps"] is not None:
+            self.num_epochs = math.ceil(self.config["num_steps"] / self.steps_per_epoch)
+        self.adaptation_factors = get_adaptation_factors(self.num_epochs, gamma=self.config["grl_gamma"])
+        self.adaptation_factor = None
+        self.epoch = 0
+        if self.config["is_compiled"]:
+            self._compute_losses = utils.compile_with_fallback(self.compute_losses, dynamic=False)
+        else:
+            self._compute_losses = self.compute_losses
+
+    def compute_losses(self, batch):
+        """
+        Parameters
+        ----------
+        batch : tuple
+            one batch per loader of loader_names, in the same order.
+
+        Returns
+        -------
+        loss : torch.Tensor
+            objective to be minimized.
+        losses : dict of torch.Tensor
+            terms of loss named by loss_names, to be logged.
+        """
+        raise NotImplementedError
+
+    def backward(self, loss, losses):
+        loss.backward()
+
+    def plot(self, traces, loss_task_evals):
+        pass
+
+    def float32(self):
+        """
+        Context to compute matmul-like ops in float32 even under is_autocast, inputs have to be cast by .float().
+        """
+        return torch.autocast(self.device_type, enabled=False)
+
+    def forward_features(self, X_batches):
+        """
+        Returns
+        -------
+        features : list of torch.Tensor, in the same order as X_batches
+        """
+        if self.config["is_fused_forward"]:
+            return list(forward_fused(self.feature_extractor, X_batches, self.config["is_domain_specific_bn"]))
+        return [self.feature_extractor(X_batch) for X_batch in X_batches]
+
+    def get_source_y(self, source_Y_batch):
+        """
+        Returns
+        -------
+        source_y_task_batch : torch.Tensor of shape(N, )
+            float for binary classification, long otherwise.
+        source_y_domain_batch : torch.Tensor of shape(N, )
+        """
+        if self.task_classifier.output_size == 1:
+            source_y_task_batch = source_Y_batch[:, utils.COL_IDX_TASK] > 0.5
+            source_y_task_batch = source_y_task_batch.to(torch.float32)
+            source_y_domain_batch = source_Y_batch[:, utils.COL_IDX_DOMAIN]
+        elif self.config.get("is_psuedo_weights", False):
+            output_size = source_Y_batch[:, :-1].shape[1]
+            source_y_task_batch = torch.argmax(source_Y_batch[:, :output_size], dim=1)
+            source_y_task_batch = source_y_task_batch.to(torch.long)
+            source_y_domain_batch = source_Y_batch[:, output_size]
+        else:
+            source_y_task_batch = source_Y_batch[:, utils.COL_IDX_TASK]
+            source_y_task_batch = source_y_task_batch.to(torch.long)
+            source_y_domain_batch = source_Y_batch[:, utils.COL_IDX_DOMAIN]
+        return source_y_task_batch, source_y_domain_batch
+
+    def fit(self):
+        """
+        Returns
+        -------
+        loss_task_evals : list of float
+        accuracies on the evaluation data, in epoch order.
+        """
+        config = self.config
+        loaders = [self.data[name] for name in self.loader_names]
+        eval_X, eval_y_task = [self.data[name] for name in self.eval_data_names]
+        optimizers = self.task_optimizers + self.domain_optimizers
+
+        early_stopping = EarlyStopping()
+        self.evaluator = EvaluationScheduler(
+            eval_X,
+            eval_y_task,
+            self.num_epochs,
+            eval_interval=config["eval_interval"],
+            eval_sample_size=config["eval_sample_size"],
+            is_async_eval=config["is_async_eval"],
+            is_keep_best=self.is_budgeted,
+        )
+        self.metrics = MetricsAccumulator(
+            self.loss_names,
+            device=self.device,
+            trace_interval=config["trace_interval"],
+            log_interval=config["log_interval"],
+        )
+        loss_task_evals = []
+        start = time.perf_counter()
+        num_steps = 0
+        for epoch in tqdm(range(1, self.num_epochs + 1)):
+            if config["stop_during_epochs"] & (epoch == config["epoch_thr_for_stopping"]):
+                break
+            self.epoch = epoch
+            self.adaptation_factor = self.adaptation_factors[epoch - 1]
+            if config["is_compiled"]:
+                # 0-dim tensor rather than python float, so that the compiled step is not re-specialized every epoch
+                self.adaptation_factor = torch.tensor(self.adaptation_factor)
+            self.feature_extractor.train()
+            self.task_classifier.train()
+            if config["is_changing_lr"] & (epoch == config["epoch_thr_for_changing_lr"]):
+                self._change_lr(config["changed_lrs"])
+
+            batches = self._get_batches(loaders, num_steps)
+            if config["is_prefetch"]:
+                batches = prefetch(batches, size=config["prefetch_size"])
+            for batch in batches:
+                if config["drop_last"] and not _is_full_batch(batch, loaders):
+                    continue
+                with torch.autocast(self.device_type, dtype=torch.bfloat16, enabled=config["is_autocast"]):
+                    loss, losses = self._compute_losses(batch)
+                for optimizer in optimizers:
+                    optimizer.zero_grad()
+                self.backward(loss, losses)
+                for optimizer in optimizers:
+                    optimizer.step()
+                self.metrics.update(**losses)
+                num_steps += 1
+                if self._is_time_over(start):
+                    break
+            is_budget_over = self._is_time_over(start) or (num_steps == config["num_steps"])
+
+            # Eval
+            self.evaluator.submit(epoch, self.feature_extractor, self.task_classifier, is_last=is_budget_over)
+            for acc in self.evaluator.collect():
+                early_stopping(acc)
+                loss_task_evals.append(acc)
+            epoch_losses = self.metrics.epoch_end()
+            if early_stopping.early_stop & config["do_early_stop"]:
+                break
+            if epoch % config["print_interval"] == 0:
+                self._print(epoch, epoch_losses)
+            if is_budget_over:
+                break
+        loss_task_evals.extend(self.evaluator.close())
+        if self.evaluator.best_state is not None:
+            self.feature_extractor.load_state_dict(self.evaluator.best_state[0])
+            self.task_classifier.load_state_dict(self.evaluator.best_state[1])
+        self.feature_extractor.eval()
+        self.task_classifier.eval()
+
+        self.metrics.flush()
+        if config["do_plot"]:
+            self.plot(self.metrics.traces, loss_task_evals)
+        return loss_task_evals
+
+    def _get_batches(self, loaders, num_steps):
+        if not self.is_budgeted:
+            return zip(*loaders)
+        steps = self.steps_per_epoch
+        if self.config["num_steps"] is not None:
+            steps = min(steps, self.config["num_steps"] - num_steps)
+        return itertools.islice(zip(*[_cycle(loader) for loader in loaders]), steps)
+
+    def _is_time_over(self, start):
+        return (self.config["time_budget"] is not None) and (time.perf_counter() - start >= self.config["time_budget"])
+
+    def _change_lr(self, changed_lrs):
+        for optimizer in self.task_optimizers:
+            optimizer.param_groups[0]["lr"] = changed_lrs[0]
+        for optimizer in self.domain_optimizers:
+            optimizer.param_groups[0]["lr"] = changed_lrs[1]
+
+    def _print(self, epoch, epoch_losses):
+        losses = ", ".join(f"{name.replace('_', ' ').title()}: {loss}" for name, loss in epoch_losses.items())
+        print(f"Epoch: {epoch}, {losses}, Acc: {self.evaluator.last_acc}")
+
+
+def _cycle(loader):
+    """
+    Iterate loader endlessly, reshuffling on every pass if it shuffles.
+    """
+    while True:
+        yield from loader
+
+
+def _is_full_batch(batch, loaders):
+    return all(X_batch.shape[0] == loader.batch_size for (X_batch, *_), loader in zip(batch, loaders))
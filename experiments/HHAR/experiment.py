@@ -8,7 +8,7 @@ from sklearn.preprocessing import StandardScaler
 from torch.utils.data import DataLoader, TensorDataset
 
 from ...networks import Codats, CoDATS_F_C, Danns2D, IsihDanns
-from ...utils import utils
+from ...utils import rv_utils, utils
 
 GT_TO_INT = {"bike": 0, "stairsup": 1, "stairsdown": 2, "stand": 3, "walk": 4, "sit": 5}
 USER_LIST = ["a", "b", "c", "d", "e", "f", "g", "h", "i"]
@@ -29,6 +29,16 @@ flags.DEFINE_boolean(
     True,
     "Whether or not use Reverse Validation based free params tuning method(5.1.2 algo from DANN paper)",
 )
+flags.DEFINE_integer("num_RV_workers", 1, "the number of processes running RV candidates in parallel")
+flags.DEFINE_string("RV_cache_dir", None, "directory caching the RV results across runs, no cache if None")
+flags.DEFINE_boolean("is_RV_cache_invalidated", False, "recompute the RV results even if cached")
+flags.DEFINE_string("RV_search", "grid", "RV search, grid (3 lrs, full epochs) or halving (successive halving)")
+flags.DEFINE_integer("RV_num_candidates", 27, "the number of candidates sampled by the halving RV search")
+flags.DEFINE_integer("RV_min_epochs", 10, "the epochs of the first rung of the halving RV search")
+flags.DEFINE_integer("RV_eta", 3, "the halving RV search keeps the best 1 / RV_eta candidates per rung")
+flags.DEFINE_boolean(
+    "is_fused_forward", False, "Whether or not to forward source and target batches concatenated, in one call"
+)
 
 
 class Pattern:
@@ -313,6 +323,9 @@ def main(argv):
     df["CoDATS"] = codats_accs
     df["Without Adapt"] = without_adapt_accs
     df.to_csv(f"HHAR_{str(datetime.now())}_{FLAGS.algo_name}.csv", index=False)
+    print(f"Peak RSS: {utils.get_peak_rss_mb()} MB")
+    if FLAGS.RV_cache_dir is not None:
+        print(rv_utils.get_RV_cache_report())
 
 
 def get_experimental_PAT():
@@ -9,6 +9,7 @@ from torchvision import datasets, transforms
 from torchvision.datasets import ImageFolder
 
 from ...networks import Dann, Dann_F_C, Danns2D, IsihDanns
+from ...utils import rv_utils, utils
 
 FLAGS = flags.FLAGS
 flags.DEFINE_string("algo_name", "DANN", "which algo to be used, DANN or CoRAL")
@@ -18,6 +19,16 @@ flags.DEFINE_boolean(
     True,
     "Whether or not use Reverse Validation based free params tuning method(5.1.2 algo from DANN paper)",
 )
+flags.DEFINE_integer("num_RV_workers", 1, "the number of processes running RV candidates in parallel")
+flags.DEFINE_string("RV_cache_dir", None, "directory caching the RV results across runs, no cache if None")
+flags.DEFINE_boolean("is_RV_cache_invalidated", False, "recompute the RV results even if cached")
+flags.DEFINE_string("RV_search", "grid", "RV search, grid (3 lrs, full epochs) or halving (successive halving)")
+flags.DEFINE_integer("RV_num_candidates", 27, "the number of candidates sampled by the halving RV search")
+flags.DEFINE_integer("RV_min_epochs", 10, "the epochs of the first rung of the halving RV search")
+flags.DEFINE_integer("RV_eta", 3, "the halving RV search keeps the best 1 / RV_eta candidates per rung")
+flags.DEFINE_boolean(
+    "is_fused_forward", False, "Whether or not to forward source and target batches concatenated, in one call"
+)
 
 
 class Reshape(object):
@@ -233,6 +244,9 @@ def main(argv):
     df["Without Adapt"] = [without_adapt_acc]
     df["Train on Target"] = [train_on_target_acc]
     df.to_csv(f"MNIST_{str(datetime.now())}_{FLAGS.algo_name}", index=False)
+    print(f"Peak RSS: {utils.get_peak_rss_mb()} MB")
+    if FLAGS.RV_cache_dir is not None:
+        print(rv_utils.get_RV_cache_report())
 
 
 MNIST = get_image_data_for_uda("MNIST")
@@ -0,0 +1,283 @@
+import time
+
+import pandas as pd
+import torch
+from absl import app, flags
+from torch.utils.data import DataLoader, TensorDataset
+
+from ...algo import dann_algo, jdot_algo
+from ...algo.algo_utils import _get_class_weights, get_psuedo_label_weights
+from ...networks import Codats, Dann
+from ...utils import utils
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+    "target",
+    "steps",
+    "what to benchmark, steps (training throughput), weights (time of the weights vs the loops) "
+    "or single_backward (gradient difference, time and peak memory of the DANN backward)",
+)
+flags.DEFINE_string("algo_name", "DANN", "which algo to be benchmarked, DANN or JDOT")
+flags.DEFINE_string(
+    "mode", "compile", "which execution mode to be compared with eager, compile, autocast or sliced (JDOT only)"
+)
+flags.DEFINE_integer("num_samples", 2048, "the number of synthetic samples per domain")
+flags.DEFINE_integer("num_epochs", 3, "the number of timed epochs")
+flags.DEFINE_list("batch_sizes", ["32", "128", "1024"], "batch sizes of the weights target")
+flags.DEFINE_integer("num_repeats", 100, "the number of timed calls of the weights target")
+
+CONFIGURATIONS = {
+    "ECO": {"model": lambda: Codats(experiment="ECOdataset"), "X_shape": (6, 3), "output_size": 1},
+    "HHAR": {"model": lambda: Codats(experiment="HHAR"), "X_shape": (128, 6), "output_size": 6},
+    "MNIST": {"model": lambda: Dann(experiment="MNIST"), "X_shape": (3, 28, 28), "output_size": 10},
+}
+MODES = {
+    "eager": {"drop_last": True},
+    "compile": {"is_compiled": True, "drop_last": True},
+    "autocast": {"is_autocast": True, "drop_last": True},
+    "sliced": {"alignment": "sliced", "drop_last": True},
+}
+TRAINERS = {"DANN": dann_algo.DannTrainer, "JDOT": jdot_algo.JdotTrainer}
+
+
+def _get_data(model, X_shape, output_size, num_samples):
+    """
+    Synthetic data shaped like the configuration, throughput does not depend on the values.
+    """
+    num_classes = max(output_size, 2)
+    source_X = torch.randn(num_samples, *X_shape).to(model.device)
+    source_y_task = torch.randint(0, num_classes, (num_samples,)).to(torch.float32).to(model.device)
+    source_Y = torch.stack([source_y_task, torch.zeros_like(source_y_task)], dim=1)
+    target_X = torch.randn(num_samples, *X_shape).to(model.device)
+    target_y_domain = torch.ones(num_samples).to(model.device)
+    target_y_task = torch.randint(0, num_classes, (num_samples,)).to(model.device)
+    return {
+        "source_loader": DataLoader(TensorDataset(source_X, source_Y), batch_size=model.batch_size, shuffle=True),
+        "target_loader": DataLoader(
+            TensorDataset(target_X, target_y_domain), batch_size=model.batch_size, shuffle=True
+        ),
+        "target_X": target_X,
+        "target_y_task": target_y_task,
+    }
+
+
+def _get_trainer(configuration: str, trainer_class, **kwargs):
+    model = CONFIGURATIONS[configuration]["model"]()
+    data = _get_data(
+        model, CONFIGURATIONS[configuration]["X_shape"], CONFIGURATIONS[configuration]["output_size"], FLAGS.num_samples
+    )
+    network = {
+        "feature_extractor": model.feature_extractor,
+        "domain_classifier": model.domain_classifier,
+        "task_classifier": model.task_classifier,
+        "criterion": model.criterion,
+        "feature_optimizer": model.feature_optimizer,
+        "domain_optimizer": model.domain_optimizer,
+        "task_optimizer": model.task_optimizer,
+    }
+    config = {
+        "num_epochs": FLAGS.num_epochs,
+        "is_target_weights": model.is_target_weights,
+        "device": model.device,
+        "is_fused_forward": model.is_fused_forward,
+        "is_domain_specific_bn": model.is_domain_specific_bn,
+        "eval_interval": FLAGS.num_epochs,
+        "eval_sample_size": model.batch_size,
+        **kwargs,
+    }
+    return trainer_class(data, network, **config)
+
+
+def get_steps_per_sec(configuration: str, mode: str) -> float:
+    trainer = _get_trainer(configuration, TRAINERS[FLAGS.algo_name], **MODES[mode])
+    # warm up, compilation and allocator caches are not measured
+    trainer.fit()
+    start = time.perf_counter()
+    trainer.fit()
+    return trainer.metrics.num_steps / (time.perf_counter() - start)
+
+
+def benchmark_steps():
+    df = pd.DataFrame()
+    df["configuration"] = list(CONFIGURATIONS)
+    for mode in ["eager", FLAGS.mode]:
+        df[f"{mode} steps/sec"] = [get_steps_per_sec(configuration, mode) for configuration in CONFIGURATIONS]
+    df["speedup"] = df[f"{FLAGS.mode} steps/sec"] / df["eager steps/sec"]
+    print(df.to_string(index=False))
+
+
+def _get_psuedo_label_weights_loop(source_Y_batch, thr=0.75, alpha=1, device=utils.DEVICE):
+    """
+    Element-wise reference of get_psuedo_label_weights, as it was before vectorization.
+    """
+    output_size = source_Y_batch[:, :-1].shape[1]
+    psuedo_label_weights = []
+
+    if output_size == 1:
+        pred_y = source_Y_batch[:, utils.COL_IDX_TASK]
+        for i in pred_y:
+            if i > thr:
+                psuedo_label_weights.append(1)
+            elif i < 1 - thr:
+                psuedo_label_weights.append(1)
+            else:
+                if i > 0.5:
+                    psuedo_label_weights.append(i ** alpha + (1 - thr))
+                else:
+                    psuedo_label_weights.append((1 - i) ** alpha + (1 - thr))
+
+    else:
+        pred_y = source_Y_batch[:, :output_size]
+        pred_y = torch.max(pred_y, axis=1).values
+        for i in pred_y:
+            if i > thr:
+                psuedo_label_weights.append(1)
+            else:
+                psuedo_label_weights.append(i ** alpha + (1 - thr))
+    return torch.tensor(psuedo_label_weights, dtype=torch.float32).to(device)
+
+
+def _get_class_weights_loop(source_y_task_batch):
+    """
+    Element-wise reference of _get_class_weights, as it was before vectorization.
+    """
+    p_occupied = sum(source_y_task_batch) / source_y_task_batch.shape[0]
+    p_unoccupied = 1 - p_occupied
+    class_weights = torch.zeros_like(source_y_task_batch)
+    for i, y in enumerate(source_y_task_batch):
+        if y == 1:
+            class_weights[i] = p_unoccupied
+        elif y == 0:
+            class_weights[i] = p_occupied
+    return class_weights
+
+
+def _get_source_Y(batch_size, output_size):
+    """
+    Random predicted probabilities (task) and zeros (domain), as the pseudo-labelled source of isih-DA.
+    """
+    if output_size == 1:
+        pred_y_task = torch.rand(batch_size, 1)
+    else:
+        pred_y_task = torch.softmax(torch.randn(batch_size, output_size) * 3, dim=1)
+    return torch.cat([pred_y_task, torch.zeros(batch_size, 1)], dim=1).to(utils.DEVICE)
+
+
+def get_ms_per_call(fn, *args):
+    fn(*args)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(FLAGS.num_repeats):
+        fn(*args)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / FLAGS.num_repeats * 1000
+
+
+def benchmark_weights():
+    """
+    Time the vectorized weights against the element-wise reference ones on random labels,
+    their parity is tested by tests/test_algo_utils.py.
+    """
+    df = pd.DataFrame()
+    for batch_size in map(int, FLAGS.batch_sizes):
+        cases = {
+            "psuedo label binary": (
+                get_psuedo_label_weights,
+                _get_psuedo_label_weights_loop,
+                _get_source_Y(batch_size, 1),
+            ),
+            "psuedo label multiclass": (
+                get_psuedo_label_weights,
+                _get_psuedo_label_weights_loop,
+                _get_source_Y(batch_size, 6),
+            ),
+            "class": (
+                _get_class_weights,
+                _get_class_weights_loop,
+                torch.randint(0, 2, (batch_size,)).to(torch.float32).to(utils.DEVICE),
+            ),
+        }
+        for name, (fn, loop_fn, x) in cases.items():
+            row = {
+                "weights": name,
+                "batch size": batch_size,
+                "max abs diff": (fn(x) - loop_fn(x)).abs().max().item(),
+                "loop ms": get_ms_per_call(loop_fn, x),
+                "vectorized ms": get_ms_per_call(fn, x),
+            }
+            row["speedup"] = row["loop ms"] / row["vectorized ms"]
+            df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
+    print(df.to_string(index=False))
+
+
+def _get_gradients(trainer, batch):
+    """
+    One DANN step on batch, without the optimizer step.
+
+    Returns
+    -------
+    gradients : dict of torch.Tensor
+        gradient of every parameter by name, zeros if it got none.
+    """
+    modules = {
+        "feature_extractor": trainer.feature_extractor,
+        "domain_classifier": trainer.domain_classifier,
+        "task_classifier": trainer.task_classifier,
+    }
+    for module in modules.values():
+        module.zero_grad(set_to_none=True)
+    loss, losses = trainer.compute_losses(batch)
+    trainer.backward(loss, losses)
+    return {
+        f"{module_name}.{name}": param.grad.clone() if param.grad is not None else torch.zeros_like(param)
+        for module_name, module in modules.items()
+        for name, param in module.named_parameters()
+    }
+
+
+def benchmark_single_backward():
+    """
+    Compare the gradients, the time and the peak memory of a step of the single backward of DannTrainer
+    and of the two backwards on the same seeded model and batch, their parity is tested by tests/test_dann.py.
+    """
+    df = pd.DataFrame()
+    for configuration in CONFIGURATIONS:
+        row = {"configuration": configuration}
+        gradients = {}
+        for is_single_backward in [False, True]:
+            name = "single" if is_single_backward else "two"
+            torch.manual_seed(0)
+            trainer = _get_trainer(configuration, dann_algo.DannTrainer, is_single_backward=is_single_backward)
+            batch = next(zip(*[trainer.data[loader_name] for loader_name in trainer.loader_names]))
+            trainer.adaptation_factor = trainer.adaptation_factors[-1]
+            # same dropout masks in both
+            torch.manual_seed(1)
+            gradients[name] = _get_gradients(trainer, batch)
+            if torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+            row[f"{name} backward ms"] = get_ms_per_call(_get_gradients, trainer, batch)
+            row[f"{name} backward peak MB"] = (
+                torch.cuda.max_memory_allocated() / 2 ** 20 if torch.cuda.is_available() else float("nan")
+            )
+        row["max abs grad diff"] = max(
+            (gradients["single"][param_name] - gradient).abs().max().item()
+            for param_name, gradient in gradients["two"].items()
+        )
+        df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
+    # peak memory is of CUDA only, NaN on CPU
+    print(df.to_string(index=False))
+
+
+def main(argv):
+    if FLAGS.target == "weights":
+        benchmark_weights()
+    elif FLAGS.target == "single_backward":
+        benchmark_single_backward()
+    else:
+        benchmark_steps()
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,104 @@
+import time
+
+import pandas as pd
+import torch
+from absl import app, flags
+from torch.utils.data import DataLoader, TensorDataset
+
+from ...algo.coral2D_algo import Coral2DTrainer
+from ...algo.coral_algo import get_covariance_matrices
+from ...networks import Codats
+
+FLAGS = flags.FLAGS
+flags.DEFINE_list(
+    "num_domains", ["3", "4", "6", "8"], "the number of domains, source + target + intermediates + target prime"
+)
+flags.DEFINE_integer("num_samples", 2048, "the number of synthetic samples per domain")
+flags.DEFINE_integer("num_epochs", 3, "the number of timed epochs")
+flags.DEFINE_integer("num_repeats", 100, "the number of timed covariance computations")
+
+
+def _get_loader(X, Y, batch_size):
+    return DataLoader(TensorDataset(X, Y), batch_size=batch_size, shuffle=True)
+
+
+def _get_data(model, num_domains):
+    """
+    Synthetic data shaped like ecodataset, throughput does not depend on the values.
+    """
+    X_shape = (6, 3)
+    source_X = torch.randn(FLAGS.num_samples, *X_shape).to(model.device)
+    source_y_task = torch.randint(0, 2, (FLAGS.num_samples,)).to(torch.float32).to(model.device)
+    source_Y = torch.stack([source_y_task, torch.zeros_like(source_y_task)], dim=1)
+    target_loaders = [
+        _get_loader(
+            torch.randn(FLAGS.num_samples, *X_shape).to(model.device),
+            torch.ones(FLAGS.num_samples).to(model.device),
+            model.batch_size,
+        )
+        for _ in range(num_domains - 1)
+    ]
+    return {
+        "source_loader": _get_loader(source_X, source_Y, model.batch_size),
+        "target_loader": target_loaders[0],
+        "intermediate_loaders": target_loaders[1:-1],
+        "target_prime_loader": target_loaders[-1],
+        "target_prime_X": torch.randn(FLAGS.num_samples, *X_shape).to(model.device),
+        "target_prime_y_task": torch.randint(0, 2, (FLAGS.num_samples,)).to(model.device),
+    }
+
+
+def get_ms_per_step(num_domains):
+    model = Codats(experiment="ECOdataset")
+    network = {
+        "feature_extractor": model.feature_extractor,
+        "task_classifier": model.task_classifier,
+        "criterion": model.criterion,
+        "feature_optimizer": model.feature_optimizer,
+        "task_optimizer": model.task_optimizer,
+    }
+    config = {"num_epochs": FLAGS.num_epochs, "device": model.device, "eval_interval": FLAGS.num_epochs}
+    trainer = Coral2DTrainer(_get_data(model, num_domains), network, **config)
+    # warm up, allocator caches are not measured
+    trainer.fit()
+    start = time.perf_counter()
+    trainer.fit()
+    return (time.perf_counter() - start) / trainer.metrics.num_steps * 1000
+
+
+def get_ms_per_covariances(fn, outs):
+    fn(outs)
+    if outs[0].is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(FLAGS.num_repeats):
+        fn(outs)
+    if outs[0].is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / FLAGS.num_repeats * 1000
+
+
+def get_looped_covariance_matrices(outs):
+    """
+    One kernel per domain, as the reference of the batched one.
+    """
+    return [get_covariance_matrices([out])[0] for out in outs]
+
+
+def main(argv):
+    df = pd.DataFrame()
+    for num_domains in map(int, FLAGS.num_domains):
+        model = Codats(experiment="ECOdataset")
+        outs = [torch.randn(model.batch_size, 128, device=model.device) for _ in range(num_domains)]
+        row = {
+            "num domains": num_domains,
+            "ms/step": get_ms_per_step(num_domains),
+            "batched covariances ms": get_ms_per_covariances(get_covariance_matrices, outs),
+            "looped covariances ms": get_ms_per_covariances(get_looped_covariance_matrices, outs),
+        }
+        df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
+    print(df.to_string(index=False))
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -9,7 +9,7 @@ from torch.utils.data import DataLoader, TensorDataset
 from tqdm import tqdm
 
 from ...networks import Codats, CoDATS_F_C, Danns2D, IsihDanns
-from ...utils import utils
+from ...utils import rv_utils, utils
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 HOUSEHOLD_IDXS = [1, 2, 3, 4, 5]
@@ -21,6 +21,16 @@ flags.DEFINE_boolean(
     True,
     "Whether or not use Reverse Validation based free params tuning method(5.1.2 algo from DANN paper)",
 )
+flags.DEFINE_integer("num_RV_workers", 1, "the number of processes running RV candidates in parallel")
+flags.DEFINE_string("RV_cache_dir", None, "directory caching the RV results across runs, no cache if None")
+flags.DEFINE_boolean("is_RV_cache_invalidated", False, "recompute the RV results even if cached")
+flags.DEFINE_string("RV_search", "grid", "RV search, grid (3 lrs, full epochs) or halving (successive halving)")
+flags.DEFINE_integer("RV_num_candidates", 27, "the number of candidates sampled by the halving RV search")
+flags.DEFINE_integer("RV_min_epochs", 10, "the epochs of the first rung of the halving RV search")
+flags.DEFINE_integer("RV_eta", 3, "the halving RV search keeps the best 1 / RV_eta candidates per rung")
+flags.DEFINE_boolean(
+    "is_fused_forward", False, "Whether or not to forward source and target batches concatenated, in one call"
+)
 
 
 def _get_source_target_from_ecodataset(source_idx, target_idx, source_season_idx, target_season_idx):
@@ -140,7 +150,8 @@ def _get_source_target_prime_from_ecodataset(source_idx, target_prime_idx, sourc
 
 def danns_2d(source_idx: int, target_idx: int, winter_idx: int, summer_idx: int, num_repeats: int = 10,) -> float:
     accs = []
-    for _ in range(num_repeats):
+    danns_2d = Danns2D(experiment="ECOdataset")
+    for i in range(num_repeats):
         # Prepare Data
         source_loader, target_loader, scaler, _, _, _, _ = _get_source_target_from_ecodataset(
             source_idx=source_idx, target_idx=target_idx, source_season_idx=winter_idx, target_season_idx=winter_idx
@@ -160,7 +171,7 @@ def danns_2d(source_idx: int, target_idx: int, winter_idx: int, summer_idx: int,
         target_prime_loader = DataLoader(target_prime_ds, shuffle=True, batch_size=32)
 
         # Init 2D-DANNs
-        danns_2d = Danns2D(experiment="ECOdataset")
+        danns_2d.reset(seed=i)
         acc = danns_2d.fit(
             source_loader, target_loader, target_prime_loader, test_target_prime_X, test_target_prime_y_task
         )
@@ -174,7 +185,8 @@ def isih_da_house(source_idx: int, target_idx: int, winter_idx: int, summer_idx:
     TODO: Attach paper
     """
     accs = []
-    for _ in range(num_repeats):
+    isih_dann = IsihDanns(experiment="ECOdataset")
+    for i in range(num_repeats):
         # Algo1. Inter-Households DA
         ## Prepare Data
         _, _, scaler, source_ds, target_ds, test_target_X, test_target_y_task = _get_source_target_from_ecodataset(
@@ -188,7 +200,7 @@ def isih_da_house(source_idx: int, target_idx: int, winter_idx: int, summer_idx:
         test_target_y_task = test_target_y_task.to(DEVICE)
 
         ## isih-DA fit, predict for 1st dimension
-        isih_dann = IsihDanns(experiment="ECOdataset")
+        isih_dann.reset(seed=i)
         isih_dann.fit_1st_dim(source_ds, target_ds, test_target_X, test_target_y_task)
         pred_y_task = isih_dann.predict_proba(test_target_X, is_1st_dim=True)
 
@@ -225,7 +237,8 @@ def isih_da_season(source_idx: int, target_idx: int, winter_idx: int, summer_idx
     TODO: Attach paper
     """
     accs = []
-    for _ in range(num_repeats):
+    isih_dann = IsihDanns(experiment="ECOdataset")
+    for i in range(num_repeats):
         # Algo1. Inter-Seasons DA
         ## Prepare Data
         _, _, scaler, source_ds, target_ds, test_target_X, test_target_y_task = _get_source_target_from_ecodataset(
@@ -239,7 +252,7 @@ def isih_da_season(source_idx: int, target_idx: int, winter_idx: int, summer_idx
         test_target_y_task = test_target_y_task.to(DEVICE)
 
         ## isih-DA fit, predict for 1st dimension
-        isih_dann = IsihDanns(experiment="ECOdataset")
+        isih_dann.reset(seed=i)
         isih_dann.fit_1st_dim(source_ds, target_ds, test_target_X, test_target_y_task)
         pred_y_task = isih_dann.predict_proba(test_target_X, is_1st_dim=True)
 
@@ -290,7 +303,8 @@ def codats(source_idx: int, target_idx: int, winter_idx: int, summer_idx: int, n
         target_prime_season_ix=summer_idx,
     )
     accs = []
-    for _ in range(num_repeats):
+    codats = Codats(experiment="ECOdataset")
+    for i in range(num_repeats):
         source_loader, target_loader, _, _, _, _, source_ds, target_ds = utils.get_loader(
             train_source_X, train_target_X, train_source_y_task, train_target_y_task, shuffle=True, return_ds=True
         )
@@ -301,7 +315,7 @@ def codats(source_idx: int, target_idx: int, winter_idx: int, summer_idx: int, n
         test_target_y_task = test_target_y_task.to(DEVICE)
 
         ## CoDATS fit, predict
-        codats = Codats(experiment="ECOdataset")
+        codats.reset(seed=i)
         acc = codats.fit(source_ds, target_ds, test_target_X, test_target_y_task)
         accs.append(acc)
     return sum(accs) / num_repeats
@@ -336,9 +350,7 @@ def without_adapt(source_idx: int, target_idx: int, winter_idx: int, summer_idx:
         without_adapt = CoDATS_F_C(experiment="ECOdataset")
         without_adapt.fit_without_adapt(source_loader)
         without_adapt.eval()
-        pred_y_task = without_adapt(test_target_X)
-        pred_y_task = torch.sigmoid(pred_y_task).reshape(-1)
-        pred_y_task = pred_y_task > 0.5
+        pred_y_task = without_adapt.predict(test_target_X)
         acc = sum(pred_y_task == test_target_y_task) / test_target_y_task.shape[0]
         accs.append(acc.item())
     return sum(accs) / num_repeats
@@ -490,6 +502,9 @@ def main(argv):
     df["Train_on_Target"] = train_on_target_accs
     df["Ground Truth Ratio"] = ground_truth_ratios
     df.to_csv(f"ecodataset_{str(datetime.now())}_{FLAGS.algo_name}.csv", index=False)
+    print(f"Peak RSS: {utils.get_peak_rss_mb()} MB")
+    if FLAGS.RV_cache_dir is not None:
+        print(rv_utils.get_RV_cache_report())
 
 
 if __name__ == "__main__":
@@ -1,5 +1,6 @@
 from datetime import datetime
 
+import numpy as np
 import pandas as pd
 import torch
 from absl import app, flags
@@ -9,7 +10,7 @@ from torch.utils.data import DataLoader, TensorDataset
 from tqdm import tqdm
 
 from ...networks import Codats, CoDATS_F_C, Danns2D, IsihDanns
-from ...utils import utils
+from ...utils import rv_utils, utils
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 HOUSEHOLD_IDX = [1, 2, 3, 4, 5]
@@ -32,6 +33,19 @@ flags.DEFINE_boolean(
     True,
     "Whether or not use Reverse Validation based free params tuning method(5.1.2 algo from DANN paper)",
 )
+flags.DEFINE_integer("num_RV_workers", 1, "the number of processes running RV candidates in parallel")
+flags.DEFINE_string("RV_cache_dir", None, "directory caching the RV results across runs, no cache if None")
+flags.DEFINE_boolean("is_RV_cache_invalidated", False, "recompute the RV results even if cached")
+flags.DEFINE_string("RV_search", "grid", "RV search, grid (3 lrs, full epochs) or halving (successive halving)")
+flags.DEFINE_integer("RV_num_candidates", 27, "the number of candidates sampled by the halving RV search")
+flags.DEFINE_integer("RV_min_epochs", 10, "the epochs of the first rung of the halving RV search")
+flags.DEFINE_integer("RV_eta", 3, "the halving RV search keeps the best 1 / RV_eta candidates per rung")
+flags.DEFINE_boolean(
+    "is_fused_forward", False, "Whether or not to forward source and target batches concatenated, in one call"
+)
+flags.DEFINE_boolean(
+    "is_intermediate_lags", False, "Whether or not 2D-DANNs CoRAL also aligns every lag between lag_1 and lag_2"
+)
 
 flags.mark_flag_as_required("lag_1")
 flags.mark_flag_as_required("lag_2")
@@ -117,9 +131,33 @@ def _split_normalize_sliding_window_for_target_prime(target_prime_X, target_prim
     return train_target_prime_X, train_target_prime_y_task, test_target_prime_X, test_target_prime_y_task
 
 
+def _get_intermediate_loaders_from_ecodataset(source_idx, season_idx):
+    """
+    X_T of every lag between lag_1 and lag_2, normalized, sliding windowed and loaded with domain label 1.
+    """
+    train_source_X = pd.read_csv(f"./domain-invariant-learning/deep_occupancy_detection/data/{source_idx}_X_train.csv")
+    train_source_X = train_source_X[train_source_X.Season == season_idx]
+    intermediate_loaders = []
+    for lag in range(FLAGS.lag_1 + 1, FLAGS.lag_2):
+        intermediate_X = train_source_X.copy()
+        time_list = LAG_NUM_TO_TIME_LIST[lag]
+        time_list = time_list * int(train_source_X.shape[0] / 32)
+        intermediate_X["Time"] = time_list
+
+        scaler = preprocessing.StandardScaler()
+        intermediate_X = scaler.fit_transform(intermediate_X)
+        intermediate_X, _ = utils.apply_sliding_window(intermediate_X, np.zeros(intermediate_X.shape[0]), filter_len=6)
+        intermediate_X = torch.tensor(intermediate_X, dtype=torch.float32).to(DEVICE)
+        intermediate_y_domain = torch.ones(intermediate_X.shape[0]).to(DEVICE)
+        intermediate_ds = TensorDataset(intermediate_X, intermediate_y_domain)
+        intermediate_loaders.append(DataLoader(intermediate_ds, shuffle=True, batch_size=32))
+    return intermediate_loaders
+
+
 def danns_2d(source_idx=2, season_idx=0, num_repeats: int = 10):
     accs = []
-    for _ in range(num_repeats):
+    danns_2d = Danns2D(experiment="ECOdataset_synthetic")
+    for i in range(num_repeats):
         (
             source_loader,
             target_loader,
@@ -143,11 +181,22 @@ def danns_2d(source_idx=2, season_idx=0, num_repeats: int = 10):
         train_target_prime_y_domain = torch.ones(train_target_prime_X.shape[0]).to(DEVICE)
         target_prime_ds = TensorDataset(train_target_prime_X, train_target_prime_y_domain)
         target_prime_loader = DataLoader(target_prime_ds, shuffle=True, batch_size=32)
+        if FLAGS.is_intermediate_lags:
+            intermediate_loaders = _get_intermediate_loaders_from_ecodataset(
+                source_idx=source_idx, season_idx=season_idx
+            )
+        else:
+            intermediate_loaders = []
 
         # 2D-DANNs
-        danns_2d = Danns2D(experiment="ECOdataset_synthetic")
+        danns_2d.reset(seed=i)
         acc = danns_2d.fit(
-            source_loader, target_loader, target_prime_loader, test_target_prime_X, test_target_prime_y_task
+            source_loader,
+            target_loader,
+            target_prime_loader,
+            test_target_prime_X,
+            test_target_prime_y_task,
+            intermediate_loaders,
         )
         accs.append(acc)
     return sum(accs) / num_repeats
@@ -155,7 +204,8 @@ def danns_2d(source_idx=2, season_idx=0, num_repeats: int = 10):
 
 def isih_da(source_idx=2, season_idx=0, num_repeats: int = 10):
     accs = []
-    for _ in range(num_repeats):
+    isih_dann = IsihDanns(experiment="ECOdataset_synthetic")
+    for i in range(num_repeats):
         (
             _,
             _,
@@ -173,7 +223,7 @@ def isih_da(source_idx=2, season_idx=0, num_repeats: int = 10):
         test_target_X = test_target_X.to(DEVICE)
         test_target_y_task = test_target_y_task.to(DEVICE)
 
-        isih_dann = IsihDanns(experiment="ECOdataset_synthetic")
+        isih_dann.reset(seed=i)
         isih_dann.fit_1st_dim(source_ds, target_ds, test_target_X, test_target_y_task)
         pred_y_task = isih_dann.predict_proba(test_target_X, is_1st_dim=True)
         train_source_X = target_X
@@ -231,12 +281,13 @@ def codats(source_idx=2, season_idx=0, num_repeats: int = 10):
         test_target_X,
         test_target_y_task,
     ) = _split_normalize_sliding_window_for_target_prime(target_prime_X=target_X, target_prime_y_task=target_y_task)
-    for _ in range(num_repeats):
+    codats = Codats(experiment="ECOdataset_synthetic")
+    for i in range(num_repeats):
         source_loader, target_loader, _, _, _, _, source_ds, target_ds = utils.get_loader(
             train_source_X, train_target_X, train_source_y_task, train_target_y_task, shuffle=True, return_ds=True
         )
         ## CoDATS fit, predict
-        codats = Codats(experiment="ECOdataset_synthetic")
+        codats.reset(seed=i)
         acc = codats.fit(source_ds, target_ds, test_target_X, test_target_y_task)
         accs.append(acc)
     return sum(accs) / num_repeats
@@ -280,9 +331,7 @@ def without_adapt(source_idx=2, season_idx=0, num_repeats: int = 10):
         without_adapt.fit_without_adapt(source_loader)
 
         without_adapt.eval()
-        pred_y = without_adapt(test_target_X)
-        pred_y = torch.sigmoid(pred_y).reshape(-1)
-        pred_y = pred_y > 0.5
+        pred_y = without_adapt.predict(test_target_X)
         acc = sum(pred_y == test_target_y_task) / pred_y.shape[0]
         accs.append(acc.item())
     return sum(accs) / num_repeats
@@ -369,6 +418,9 @@ def main(argv):
         f"ecodataset_synthetic_lag{FLAGS.lag_1}_lag{FLAGS.lag_2}_{str(datetime.now())}_{FLAGS.algo_name}.csv",
         index=False,
     )
+    print(f"Peak RSS: {utils.get_peak_rss_mb()} MB")
+    if FLAGS.RV_cache_dir is not None:
+        print(rv_utils.get_RV_cache_report())
 
 
 if __name__ == "__main__":
@@ -15,6 +15,8 @@ device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 FLAGS = flags.FLAGS
 flags.DEFINE_integer("rotation_degree", -25, "rotation degree for target data")
 flags.DEFINE_string("algo_name", "DANN", "Which algo to use, DANN or CoRAL")
+flags.DEFINE_bool("is_autocast", False, "train UDA algos under bfloat16 autocast, for accuracy parity with float32")
+flags.DEFINE_string("jdot_alignment", "ot", "alignment of JDOT, ot (exact/entropic plan) or sliced")
 flags.mark_flag_as_required("rotation_degree")
 flags.mark_flag_as_required("algo_name")
 
@@ -82,6 +84,7 @@ def main(argv):
             "num_epochs": 1000,
             "do_plot": True,
             "is_target_weights": True,
+            "is_autocast": FLAGS.is_autocast,
         }
     elif FLAGS.algo_name == "CoRAL":
         network = {
@@ -95,6 +98,7 @@ def main(argv):
             "num_epochs": 1000,
             "alpha": 1,
             "do_plot": True,
+            "is_autocast": FLAGS.is_autocast,
         }
     if FLAGS.algo_name == "JDOT":
         network = {
@@ -107,6 +111,8 @@ def main(argv):
         config = {
             "num_epochs": 1500,
             "do_plot": True,
+            "is_autocast": FLAGS.is_autocast,
+            "alignment": FLAGS.jdot_alignment,
         }
     feature_extractor, task_classifier, _ = ALGORYTHMS[FLAGS.algo_name].fit(data, network, **config)
 
@@ -177,17 +183,25 @@ def main(argv):
         "domain_optimizer_dim2": domain_optimizer_dim2,
         "task_optimizer": task_optimizer,
     }
-    config = {"num_epochs": 1000, "do_plot": True}
+    config = {"num_epochs": 1000, "do_plot": True, "is_autocast": FLAGS.is_autocast}
     if FLAGS.algo_name == "DANN":
         algo_2D = dann2D_algo
     elif FLAGS.algo_name == "CoRAL":
         algo_2D = coral2D_algo
     elif FLAGS.algo_name == "JDOT":
         algo_2D = jdot2D_algo
-        config = {"num_epochs": 1500, "do_plot": True}
+        config = {
+            "num_epochs": 1500,
+            "do_plot": True,
+            "is_autocast": FLAGS.is_autocast,
+            "alignment": FLAGS.jdot_alignment,
+        }
     feature_extractor_dim12, task_classifier, _ = algo_2D.fit(data, network, **config)
-    y_grid = task_classifier.predict_proba(feature_extractor_dim12(x_grid.T)).cpu().detach().numpy()
-    pred_y_task = task_classifier.predict(feature_extractor_dim12(target_prime_X.to(device)))
+    y_grid = utils.predict_in_chunks(lambda x: task_classifier.predict_proba(feature_extractor_dim12(x)), x_grid.T)
+    y_grid = y_grid.cpu().numpy()
+    pred_y_task = utils.predict_in_chunks(
+        lambda x: task_classifier.predict(feature_extractor_dim12(x)), target_prime_X.to(device)
+    )
     danns_2D_acc = sum(pred_y_task == target_prime_y_task) / len(pred_y_task)
     print(f"2D-DANNs Accuracy: {danns_2D_acc.item()}")
     plt.figure()
@@ -248,6 +262,7 @@ def main(argv):
             "num_epochs": 200,
             "do_plot": True,
             "is_target_weights": True,
+            "is_autocast": FLAGS.is_autocast,
         }
 
     elif FLAGS.algo_name == "CoRAL":
@@ -258,7 +273,7 @@ def main(argv):
             "task_optimizer": task_optimizer_dim1,
             "feature_optimizer": feature_optimizer_dim1,
         }
-        config = {"num_epochs": 200, "alpha": 1, "do_plot": True}
+        config = {"num_epochs": 200, "alpha": 1, "do_plot": True, "is_autocast": FLAGS.is_autocast}
 
     elif FLAGS.algo_name == "JDOT":
         network = {
@@ -271,6 +286,8 @@ def main(argv):
         config = {
             "num_epochs": 500,
             "do_plot": True,
+            "is_autocast": FLAGS.is_autocast,
+            "alignment": FLAGS.jdot_alignment,
         }
     feature_extractor_dim12, task_classifier_dim1, _ = ALGORYTHMS[FLAGS.algo_name].fit(data, network, **config)
 
@@ -301,7 +318,13 @@ def main(argv):
             "domain_optimizer": domain_optimizer_dim2,
             "task_optimizer": task_optimizer_dim2,
         }
-        config = {"num_epochs": 800, "do_plot": True, "is_target_weights": True, "is_psuedo_weights": True}
+        config = {
+            "num_epochs": 800,
+            "do_plot": True,
+            "is_target_weights": True,
+            "is_psuedo_weights": True,
+            "is_autocast": FLAGS.is_autocast,
+        }
 
     elif FLAGS.algo_name == "CoRAL":
         network = {
@@ -311,7 +334,13 @@ def main(argv):
             "task_optimizer": task_optimizer_dim2,
             "feature_optimizer": feature_optimizer_dim2,
         }
-        config = {"num_epochs": 800, "alpha": 1, "is_psuedo_weights": True, "do_plot": True}
+        config = {
+            "num_epochs": 800,
+            "alpha": 1,
+            "is_psuedo_weights": True,
+            "do_plot": True,
+            "is_autocast": FLAGS.is_autocast,
+        }
 
     elif FLAGS.algo_name == "JDOT":
         feature_extractor_dim12 = Encoder(input_size=source_X.shape[1], output_size=hidden_size).to(device)
@@ -322,7 +351,13 @@ def main(argv):
             "feature_optimizer": feature_optimizer_dim2,
             "task_optimizer": task_optimizer_dim2,
         }
-        config = {"num_epochs": 1000, "do_plot": True, "is_pseudo_weights": True}
+        config = {
+            "num_epochs": 1000,
+            "do_plot": True,
+            "is_pseudo_weights": True,
+            "is_autocast": FLAGS.is_autocast,
+            "alignment": FLAGS.jdot_alignment,
+        }
     feature_extractor_dim12, task_classifier_dim2, _ = ALGORYTHMS[FLAGS.algo_name].fit(data, network, **config)
 
     ## Eval
@@ -438,6 +473,9 @@ def main(argv):
     df["stepbystep-DANNs"] = [stepbystep_dann_acc.item()]
     df["DANNs"] = [dann_acc.item()]
     df["WithoutAdapt"] = [without_adapt_acc.item()]
+    df["is_autocast"] = [FLAGS.is_autocast]
+    df["jdot_alignment"] = [FLAGS.jdot_alignment]
+    # accuracy parity: compare with the csv of a run without --is_autocast
     df.to_csv(f"make_moons_{str(datetime.now())}_{FLAGS.algo_name}.csv", index=False)
 
 
@@ -0,0 +1,87 @@
+import time
+
+import pandas as pd
+import torch
+from absl import app, flags
+
+from ...algo.dan_algo import get_linear_MMD, get_MMD, get_RFF_MMD
+from ...utils import utils
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+    "target", "time", "what to benchmark, time (vs batch size) or error (vs the number of rff features)"
+)
+flags.DEFINE_list("batch_sizes", ["64", "256", "1024", "4096"], "batch sizes to be benchmarked, time only")
+flags.DEFINE_list("num_rff_features", ["16", "64", "256", "1024", "4096"], "rff features per kernel, error only")
+flags.DEFINE_integer("batch_size", 512, "batch size of the error benchmark")
+flags.DEFINE_integer("num_features", 128, "dimension of the synthetic features")
+flags.DEFINE_float("shift", 0.5, "mean shift between the synthetic source and target features")
+flags.DEFINE_integer("num_repeats", 10, "the number of timed (time) or sampled (error) estimates")
+
+ESTIMATORS = {"quadratic": get_MMD, "linear": get_linear_MMD, "rff": get_RFF_MMD}
+
+
+def get_features(batch_size):
+    source_X = torch.randn(batch_size, FLAGS.num_features, device=utils.DEVICE)
+    target_X = torch.randn(batch_size, FLAGS.num_features, device=utils.DEVICE) + FLAGS.shift
+    return source_X.requires_grad_(), target_X.requires_grad_()
+
+
+def get_ms_per_step(estimator, source_X, target_X):
+    """
+    Forward + backward, as in a training step.
+    """
+    # warm up
+    estimator(source_X, target_X).backward()
+    if source_X.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(FLAGS.num_repeats):
+        estimator(source_X, target_X).backward()
+    if source_X.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / FLAGS.num_repeats * 1000
+
+
+def benchmark_time():
+    df = pd.DataFrame()
+    for batch_size in map(int, FLAGS.batch_sizes):
+        source_X, target_X = get_features(batch_size)
+        row = {"batch size": batch_size}
+        for name, estimator in ESTIMATORS.items():
+            row[f"{name} ms/step"] = get_ms_per_step(estimator, source_X, target_X)
+        df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
+    print(df.to_string(index=False))
+
+
+def benchmark_error():
+    df = pd.DataFrame()
+    source_X, target_X = get_features(FLAGS.batch_size)
+    with torch.no_grad():
+        mmd_quadratic = get_MMD(source_X, target_X).item()
+        # unbiased, so not an approximation of the (biased) quadratic estimate, reported for its scale only
+        mmd_linear = get_linear_MMD(source_X, target_X).item()
+        for num_rff_features in map(int, FLAGS.num_rff_features):
+            mmds = [get_RFF_MMD(source_X, target_X, num_features=num_rff_features) for _ in range(FLAGS.num_repeats)]
+            mmds = torch.stack(mmds).cpu()
+            row = {
+                "rff features": num_rff_features,
+                "quadratic mmd": mmd_quadratic,
+                "linear mmd": mmd_linear,
+                "rff mmd mean": mmds.mean().item(),
+                "rff mmd std": mmds.std().item(),
+                "relative error %": (mmds - mmd_quadratic).abs().mean().item() / mmd_quadratic * 100,
+            }
+            df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
+    print(df.to_string(index=False))
+
+
+def main(argv):
+    if FLAGS.target == "error":
+        benchmark_error()
+    else:
+        benchmark_time()
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,155 @@
+import time
+
+import pandas as pd
+import torch
+from absl import app, flags
+from torch import nn
+
+from ...algo.jdot_algo import get_pseudo_task_loss_mat
+from ...algo.ot_utils import get_optimal_transport_weights
+from ...utils import utils
+
+FLAGS = flags.FLAGS
+flags.DEFINE_string(
+    "target", "plan", "what to benchmark, plan (emd vs sinkhorn), cost (expanded vs fused) or workers (threaded emd)"
+)
+flags.DEFINE_list("batch_sizes", ["32", "64", "128", "256", "512", "1024"], "batch sizes to be benchmarked")
+flags.DEFINE_integer("num_classes", 10, "the number of classes of the synthetic predictions, cost only")
+flags.DEFINE_integer("num_features", 128, "dimension of the synthetic features")
+flags.DEFINE_integer("num_repeats", 10, "the number of timed solves per batch size")
+flags.DEFINE_float("sinkhorn_epsilon", 0.1, "entropic regularization of sinkhorn")
+flags.DEFINE_integer("sinkhorn_num_iters", 100, "the number of sinkhorn iterations")
+flags.DEFINE_integer("num_problems", 4, "the number of plans solved together, workers only")
+flags.DEFINE_integer("num_workers", 4, "the number of threads solving emd, workers only")
+
+
+def get_sec_per_plan(cost_mat, backend):
+    kwargs = {"backend": backend, "epsilon": FLAGS.sinkhorn_epsilon, "num_iters": FLAGS.sinkhorn_num_iters}
+    # warm up
+    get_optimal_transport_weights([cost_mat], **kwargs)
+    if cost_mat.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(FLAGS.num_repeats):
+        (optimal_transport_weights,) = get_optimal_transport_weights([cost_mat], **kwargs)
+    if cost_mat.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / FLAGS.num_repeats, optimal_transport_weights
+
+
+def get_cost_mat(batch_size):
+    # cost of the same scale as JDOT: feature distance + cross entropy
+    target_X = torch.randn(batch_size, FLAGS.num_features, device=utils.DEVICE)
+    source_X = torch.randn(batch_size, FLAGS.num_features, device=utils.DEVICE)
+    cost_mat = torch.cdist(target_X, source_X, p=2) / FLAGS.num_features ** 0.5
+    return cost_mat + torch.rand(batch_size, batch_size, device=utils.DEVICE) * torch.log(torch.tensor(10.0))
+
+
+def benchmark_workers():
+    df = pd.DataFrame()
+    for batch_size in map(int, FLAGS.batch_sizes):
+        cost_mats = [get_cost_mat(batch_size) for _ in range(FLAGS.num_problems)]
+        row = {"batch size": batch_size, "num problems": FLAGS.num_problems}
+        plans = {}
+        for num_workers in [1, FLAGS.num_workers]:
+            # warm up, thread pool creation is not measured
+            get_optimal_transport_weights(cost_mats, num_workers=num_workers)
+            start = time.perf_counter()
+            for _ in range(FLAGS.num_repeats):
+                plans[num_workers] = get_optimal_transport_weights(cost_mats, num_workers=num_workers)
+            row[f"{num_workers} workers ms/step"] = (time.perf_counter() - start) / FLAGS.num_repeats * 1000
+        # deterministic, the same plans as the serial solves
+        assert all(torch.equal(serial, threaded) for serial, threaded in zip(plans[1], plans[FLAGS.num_workers]))
+        row["speedup"] = row["1 workers ms/step"] / row[f"{FLAGS.num_workers} workers ms/step"]
+        df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
+    print(df.to_string(index=False))
+
+
+def get_pseudo_task_loss_mat_expanded(pred_y_task, y_task):
+    """
+    Former JDOT construction, (N, M, C) expansion + nn.CrossEntropyLoss, as the reference of equivalence.
+    """
+    if pred_y_task.dim() == 1:
+        pred_y_task = torch.cat([(1 - pred_y_task).reshape(-1, 1), pred_y_task.reshape(-1, 1)], dim=1)
+    N, C = pred_y_task.shape
+    M = len(y_task)
+    pred_y_task = pred_y_task.unsqueeze(0).expand(M, -1, -1)
+    y_task = y_task.unsqueeze(1).expand(-1, N)
+    loss_mat = nn.CrossEntropyLoss(reduction="none")(pred_y_task.reshape(-1, C), y_task.reshape(-1).to(torch.long))
+    return loss_mat.reshape(M, N).T
+
+
+def get_peak_memory_mb(fn, *args):
+    """
+    Peak memory of fn(*args) forward + backward, CUDA allocator if available, otherwise growth of peak RSS.
+    """
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+        start = torch.cuda.memory_allocated()
+        fn(*args).sum().backward()
+        return (torch.cuda.max_memory_allocated() - start) / 1024 ** 2
+    start = utils.get_peak_rss_mb()
+    fn(*args).sum().backward()
+    return utils.get_peak_rss_mb() - start
+
+
+def benchmark_cost():
+    df = pd.DataFrame()
+    for batch_size in map(int, FLAGS.batch_sizes):
+        for num_classes in [1, FLAGS.num_classes]:
+            logits = torch.randn(batch_size, num_classes, device=utils.DEVICE)
+            if num_classes == 1:
+                pred_y_task = torch.sigmoid(logits).reshape(-1).requires_grad_()
+                y_task = torch.randint(0, 2, (batch_size,), device=utils.DEVICE)
+            else:
+                pred_y_task = torch.softmax(logits, dim=1).requires_grad_()
+                y_task = torch.randint(0, num_classes, (batch_size,), device=utils.DEVICE)
+
+            # equivalence of values and gradients is tested by tests/test_jdot.py
+            with torch.no_grad():
+                loss_mat_fused = get_pseudo_task_loss_mat(pred_y_task, y_task)
+                loss_mat_expanded = get_pseudo_task_loss_mat_expanded(pred_y_task, y_task)
+
+            # fused first, peak RSS only grows
+            row = {
+                "batch size": batch_size,
+                "num classes": num_classes,
+                "fused MB": get_peak_memory_mb(get_pseudo_task_loss_mat, pred_y_task, y_task),
+                "expanded MB": get_peak_memory_mb(get_pseudo_task_loss_mat_expanded, pred_y_task, y_task),
+                "max abs diff": (loss_mat_fused - loss_mat_expanded).abs().max().item(),
+            }
+            df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
+    print(df.to_string(index=False))
+
+
+def benchmark_plan():
+    df = pd.DataFrame()
+    for batch_size in map(int, FLAGS.batch_sizes):
+        cost_mat = get_cost_mat(batch_size)
+
+        sec_emd, optimal_transport_weights_emd = get_sec_per_plan(cost_mat, "emd")
+        sec_sinkhorn, optimal_transport_weights_sinkhorn = get_sec_per_plan(cost_mat, "sinkhorn")
+        cost_emd = torch.sum(optimal_transport_weights_emd * cost_mat).item()
+        cost_sinkhorn = torch.sum(optimal_transport_weights_sinkhorn * cost_mat).item()
+        row = {
+            "batch size": batch_size,
+            "emd ms/plan": sec_emd * 1000,
+            "sinkhorn ms/plan": sec_sinkhorn * 1000,
+            "speedup": sec_emd / sec_sinkhorn,
+            "transport cost gap %": (cost_sinkhorn - cost_emd) / cost_emd * 100,
+        }
+        df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
+    print(df.to_string(index=False))
+
+
+def main(argv):
+    if FLAGS.target == "cost":
+        benchmark_cost()
+    elif FLAGS.target == "workers":
+        benchmark_workers()
+    else:
+        benchmark_plan()
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,51 @@
+import time
+
+import pandas as pd
+import torch
+from absl import app, flags
+
+from ...networks import Codats, Dann, Danns2D, IsihDanns
+
+FLAGS = flags.FLAGS
+flags.DEFINE_integer("num_repeats", 20, "the number of timed re-initializations per model")
+
+CONFIGURATIONS = {
+    "CoDATS ECO": lambda: Codats(experiment="ECOdataset"),
+    "CoDATS HHAR": lambda: Codats(experiment="HHAR"),
+    "DANN MNIST": lambda: Dann(experiment="MNIST"),
+    "2D-DANNs ECO": lambda: Danns2D(experiment="ECOdataset"),
+    "isih-DA ECO": lambda: IsihDanns(experiment="ECOdataset"),
+    "isih-DA MNIST": lambda: IsihDanns(experiment="MNIST"),
+}
+
+
+def get_ms_per_call(fn):
+    # warm up
+    fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(FLAGS.num_repeats):
+        fn()
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / FLAGS.num_repeats * 1000
+
+
+def main(argv):
+    df = pd.DataFrame()
+    for name, build_model in CONFIGURATIONS.items():
+        model = build_model()
+        row = {
+            "model": name,
+            # what every RV candidate used to pay
+            "__init__ ms": get_ms_per_call(lambda: model.__init__(model.experiment)),
+            "reset ms": get_ms_per_call(model.reset),
+            "reset(seed) ms": get_ms_per_call(lambda: model.reset(seed=0)),
+        }
+        df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
+    print(df.to_string(index=False))
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -1,19 +1,20 @@
 from abc import ABC
 
-import numpy as np
 import torch
 from absl import flags
 from torch import nn
 from torch.utils.data import DataLoader, TensorDataset
 
-from ..algo import coral_algo, dann_algo, jdot_algo, supervised_algo
-from ..utils import utils
+from ..algo import coral_algo, dan_algo, dann_algo, jdot_algo, supervised_algo
+from ..utils import rv_utils, utils
+from .resettable import Resettable
+from .training_config import TrainingConfig
 
 FLAGS = flags.FLAGS
-ALGORYTHMS = {"DANN": dann_algo, "CoRAL": coral_algo, "JDOT": jdot_algo}
+ALGORYTHMS = {"DANN": dann_algo, "CoRAL": coral_algo, "JDOT": jdot_algo, "DAN": dan_algo}
 
 
-class DannsBase(ABC):
+class DannsBase(Resettable, TrainingConfig, ABC):
     def __init__(self, experiment: str) -> None:
         pass
 
@@ -51,70 +52,34 @@ class DannsBase(ABC):
         train_source_loader, val_source_loader = utils.tensordataset_to_splitted_loaders(source_ds, self.batch_size)
         train_target_loader, val_target_loader = utils.tensordataset_to_splitted_loaders(target_ds, self.batch_size)
 
+        val_source_X = val_source_loader.dataset.X
+        val_source_y_task = val_source_loader.dataset.y[:, utils.COL_IDX_TASK]
+
         # 2. free params
         free_params = [
             {"lr": 0.00001, "eps": 1e-08, "weight_decay": 0},
             {"lr": 0.0001, "eps": 1e-08, "weight_decay": 0},
             {"lr": 0.001, "eps": 1e-08, "weight_decay": 0},
         ]
-        RV_scores = {"free_params": [], "scores": []}
-        for param in free_params:
-            self.__init__(self.experiment)
-            self.feature_optimizer.param_groups[0].update(param)
-            self.domain_optimizer.param_groups[0].update(param)
-            self.task_optimizer.param_groups[0].update(param)
-
-            # 3. RV algo
-            ## 3.1 fit f_i
-            val_source_X = torch.cat([X for X, _ in val_source_loader], dim=0)
-            val_source_y_task = torch.cat([y[:, utils.COL_IDX_TASK] for _, y in val_source_loader], dim=0)
-            self.do_early_stop = True
-            self._fit(train_source_loader, train_target_loader, val_source_X, val_source_y_task)
-
-            ## 3.2 fit \bar{f}_i
-            train_target_X = torch.cat([X for X, _ in train_target_loader], dim=0)
-            train_target_pred_y_task = self.predict(train_target_X)
-            val_target_X = torch.cat([X for X, _ in val_target_loader], dim=0)
-            val_target_pred_y_task = self.predict(val_target_X)
-
-            train_target_ds = TensorDataset(
-                train_target_X,
-                torch.cat(
-                    [
-                        train_target_pred_y_task.reshape(-1, 1),
-                        torch.zeros_like(train_target_pred_y_task).reshape(-1, 1).to(torch.float32),
-                    ],
-                    dim=1,
-                ),
-            )
-            target_as_source_loader = DataLoader(train_target_ds, batch_size=self.batch_size, shuffle=True)
-
-            train_source_X = torch.cat([X for X, _ in train_source_loader], dim=0)
-            train_source_ds = TensorDataset(
-                train_source_X, torch.ones(train_source_X.shape[0]).to(torch.float32).to(self.device)
-            )
-            train_source_as_target_loader = DataLoader(train_source_ds, batch_size=self.batch_size, shuffle=True)
-            self.__init__(self.experiment)
-            self.feature_optimizer.param_groups[0].update(param)
-            self.domain_optimizer.param_groups[0].update(param)
-            self.task_optimizer.param_groups[0].update(param)
-            self.do_early_stop = True
-            self._fit(target_as_source_loader, train_source_as_target_loader, val_target_X, val_target_pred_y_task)
-
-            ## 3.3 get RV loss
-            pred_y_task = self.predict(val_source_X)
-            acc_RV = sum(pred_y_task == val_source_y_task) / val_source_y_task.shape[0]
-
-            # 3.4 get terminal evaluation
-            RV_scores["free_params"].append(param)
-            RV_scores["scores"].append(acc_RV.item())
+        # 3. RV algo, grid or successive halving by RV_search, one candidate per worker with num_RV_workers > 1
+        RV_scores = rv_utils.search_free_params(
+            self,
+            "_get_RV_score",
+            free_params,
+            **rv_utils.get_RV_options(),
+            train_source_loader=train_source_loader,
+            train_target_loader=train_target_loader,
+            val_target_loader=val_target_loader,
+            val_source_X=val_source_X,
+            val_source_y_task=val_source_y_task,
+        )
 
         # 4. Retraining
-        best_param = RV_scores["free_params"][np.argmax(RV_scores["scores"])]
-        self.__init__(self.experiment)
-        self.feature_optimizer.param_groups[0].update(best_param)
-        self.domain_optimizer.param_groups[0].update(best_param)
-        self.task_optimizer.param_groups[0].update(best_param)
+        best_param = rv_utils.get_best_free_params(RV_scores)
+        self.reset()
+        rv_utils.apply_free_params(
+            self, [self.feature_optimizer, self.domain_optimizer, self.task_optimizer], best_param
+        )
         source_loader = DataLoader(source_ds, batch_size=self.batch_size, shuffle=True)
         target_loader = DataLoader(target_ds, batch_size=self.batch_size, shuffle=True)
         self.do_early_stop = False
@@ -124,6 +89,60 @@ class DannsBase(ABC):
         acc = sum(pred_y_task == test_target_y_task) / test_target_y_task.shape[0]
         return acc.item()
 
+    def _get_RV_score(
+        self,
+        param: dict,
+        train_source_loader: torch.utils.data.dataloader.DataLoader,
+        train_target_loader: torch.utils.data.dataloader.DataLoader,
+        val_target_loader: torch.utils.data.dataloader.DataLoader,
+        val_source_X: torch.Tensor,
+        val_source_y_task: torch.Tensor,
+    ) -> float:
+        """
+        Train the forward and the reverse classifiers from scratch with param, and return the RV accuracy.
+        """
+        self.reset()
+        rv_utils.apply_free_params(self, [self.feature_optimizer, self.domain_optimizer, self.task_optimizer], param)
+        train_source_loader = rv_utils.rebatch(train_source_loader, self.batch_size)
+        train_target_loader = rv_utils.rebatch(train_target_loader, self.batch_size)
+
+        ## 3.1 fit f_i
+        self.do_early_stop = True
+        self._fit(train_source_loader, train_target_loader, val_source_X, val_source_y_task)
+
+        ## 3.2 fit \bar{f}_i
+        train_target_X = train_target_loader.dataset.X
+        train_target_pred_y_task = self.predict(train_target_X)
+        val_target_X = val_target_loader.dataset.X
+        val_target_pred_y_task = self.predict(val_target_X)
+
+        train_target_ds = TensorDataset(
+            train_target_X,
+            torch.cat(
+                [
+                    train_target_pred_y_task.reshape(-1, 1),
+                    torch.zeros_like(train_target_pred_y_task).reshape(-1, 1).to(torch.float32),
+                ],
+                dim=1,
+            ),
+        )
+        target_as_source_loader = DataLoader(train_target_ds, batch_size=self.batch_size, shuffle=True)
+
+        train_source_X = train_source_loader.dataset.X
+        train_source_ds = TensorDataset(
+            train_source_X, torch.ones(train_source_X.shape[0]).to(torch.float32).to(self.device)
+        )
+        train_source_as_target_loader = DataLoader(train_source_ds, batch_size=self.batch_size, shuffle=True)
+        self.reset()
+        rv_utils.apply_free_params(self, [self.feature_optimizer, self.domain_optimizer, self.task_optimizer], param)
+        self.do_early_stop = True
+        self._fit(target_as_source_loader, train_source_as_target_loader, val_target_X, val_target_pred_y_task)
+
+        ## 3.3 get RV loss
+        pred_y_task = self.predict(val_source_X)
+        acc_RV = sum(pred_y_task == val_source_y_task) / val_source_y_task.shape[0]
+        return acc_RV.item()
+
     def _fit(
         self,
         source_loader: torch.utils.data.dataloader.DataLoader,
@@ -147,13 +166,8 @@ class DannsBase(ABC):
                 "domain_optimizer": self.domain_optimizer,
                 "task_optimizer": self.task_optimizer,
             }
-            config = {
-                "num_epochs": self.num_epochs,
-                "is_target_weights": self.is_target_weights,
-                "do_early_stop": self.do_early_stop,
-                "device": self.device,
-            }
-        elif FLAGS.algo_name == "CoRAL":
+            config = self.get_trainer_config(num_epochs=self.num_epochs, is_target_weights=self.is_target_weights)
+        elif FLAGS.algo_name in ["CoRAL", "DAN"]:
             network = {
                 "feature_extractor": self.feature_extractor,
                 "task_classifier": self.task_classifier,
@@ -161,7 +175,7 @@ class DannsBase(ABC):
                 "feature_optimizer": self.feature_optimizer,
                 "task_optimizer": self.task_optimizer,
             }
-            config = {"num_epochs": self.num_epochs, "do_early_stop": self.do_early_stop, "device": self.device}
+            config = self.get_trainer_config(num_epochs=self.num_epochs)
         elif FLAGS.algo_name == "JDOT":
             network = {
                 "feature_extractor": self.feature_extractor,
@@ -170,14 +184,26 @@ class DannsBase(ABC):
                 "feature_optimizer": self.feature_optimizer,
                 "task_optimizer": self.task_optimizer,
             }
-            config = {"num_epochs": self.num_epochs, "do_early_stop": self.do_early_stop, "device": self.device}
+            config = self.get_trainer_config(
+                num_epochs=self.num_epochs,
+                ot_backend=self.ot_backend,
+                sinkhorn_threshold=self.sinkhorn_threshold,
+                is_warm_start=self.is_warm_start,
+            )
         self.feature_extractor, self.task_classifier, _ = ALGORYTHMS[FLAGS.algo_name].fit(data, network, **config)
 
-    def predict(self, x: torch.Tensor) -> torch.Tensor:
-        return self.task_classifier.predict(self.feature_extractor(x))
+    def predict(self, x: torch.Tensor, **kwargs) -> torch.Tensor:
+        return utils.predict_in_chunks(
+            lambda x: self.task_classifier.predict(self.feature_extractor(x)), x, is_compiled=self.is_compiled, **kwargs
+        )
 
-    def predict_proba(self, x: torch.Tensor) -> torch.Tensor:
-        return self.task_classifier.predict_proba(self.feature_extractor(x))
+    def predict_proba(self, x: torch.Tensor, **kwargs) -> torch.Tensor:
+        return utils.predict_in_chunks(
+            lambda x: self.task_classifier.predict_proba(self.feature_extractor(x)),
+            x,
+            is_compiled=self.is_compiled,
+            **kwargs,
+        )
 
     def set_eval(self):
         self.task_classifier.eval()
@@ -216,8 +242,8 @@ class SupervisedBase(nn.Module):
     def forward(self, x):
         return self.decoder(self.encoder(x))
 
-    def predict(self, x):
-        return self.decoder.predict(self.encoder(x))
+    def predict(self, x, **kwargs):
+        return utils.predict_in_chunks(lambda x: self.decoder.predict(self.encoder(x)), x, **kwargs)
 
-    def predict_proba(self, x):
-        return self.decoder.predict_proba(self.encoder(x))
+    def predict_proba(self, x, **kwargs):
+        return utils.predict_in_chunks(lambda x: self.decoder.predict_proba(self.encoder(x)), x, **kwargs)
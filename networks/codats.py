@@ -13,6 +13,7 @@ class Codats(DannsBase):
     """
 
     def __init__(self, experiment: str) -> None:
+        self.set_training_defaults()
         if experiment in ["ECOdataset", "ECOdataset_synthetic"]:
             self.device = utils.DEVICE
             self.feature_extractor = Conv1dTwoLayers(input_size=3).to(self.device)
@@ -32,6 +33,7 @@ class Codats(DannsBase):
             self.experiment = experiment
             self.batch_size = 32
             self.do_early_stop = False
+            self.is_domain_specific_bn = True
 
         elif experiment == "HHAR":
             self.device = utils.DEVICE
@@ -50,3 +52,5 @@ class Codats(DannsBase):
             self.experiment = experiment
             self.batch_size = 128
             self.do_early_stop = False
+            self.is_domain_specific_bn = True
+        self.save_initial_state()
@@ -8,6 +8,7 @@ from .mlp_decoder_three_layers import ThreeLayersDecoder
 
 class Dann(DannsBase):
     def __init__(self, experiment="MNIST"):
+        self.set_training_defaults()
         if experiment == "MNIST":
             self.device = torch.device("cpu")
 
@@ -29,3 +30,4 @@ class Dann(DannsBase):
             self.batch_size = 64
             self.experiment = experiment
             self.do_early_stop = False
+        self.save_initial_state()
@@ -1,24 +1,26 @@
-import numpy as np
 import torch
 from absl import flags
 from torch import nn, optim
 from torch.utils.data import DataLoader, TensorDataset
 
 from ..algo import coral2D_algo, dann2D_algo, jdot2D_algo
-from ..utils import utils
+from ..utils import rv_utils, utils
 from .conv1d_three_layers import Conv1dThreeLayers
 from .conv1d_two_layers import Conv1dTwoLayers
 from .conv2d import Conv2d
 from .mlp_decoder_three_layers import ThreeLayersDecoder
+from .resettable import Resettable
+from .training_config import TrainingConfig
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 FLAGS = flags.FLAGS
 ALGORYTHMS = {"DANN": dann2D_algo, "CoRAL": coral2D_algo, "JDOT": jdot2D_algo}
 
 
-class Danns2D:
+class Danns2D(Resettable, TrainingConfig):
     def __init__(self, experiment: str):
         assert experiment in ["ECOdataset", "ECOdataset_synthetic", "HHAR", "MNIST"]
+        self.set_training_defaults()
         if experiment in ["ECOdataset", "ECOdataset_synthetic"]:
             self.feature_extractor = Conv1dTwoLayers(input_size=3).to(DEVICE)
             self.domain_classifier_dim1 = ThreeLayersDecoder(
@@ -41,6 +43,7 @@ class Danns2D:
             self.batch_size = 32
             self.experiment = experiment
             self.do_early_stop = False
+            self.is_domain_specific_bn = True
 
         elif experiment == "HHAR":
             self.feature_extractor = Conv1dThreeLayers(input_size=6).to(DEVICE)
@@ -61,6 +64,7 @@ class Danns2D:
             self.batch_size = 128
             self.experiment = experiment
             self.do_early_stop = False
+            self.is_domain_specific_bn = True
 
         elif experiment in ["MNIST"]:
             self.feature_extractor = Conv2d()
@@ -82,26 +86,56 @@ class Danns2D:
             self.batch_size = 16
             self.experiment = experiment
             self.do_early_stop = False
+        self.save_initial_state()
 
-    def fit(self, source_loader, target_loader, target_prime_loader, test_target_prime_X, test_target_prime_y_task):
+    def fit(
+        self,
+        source_loader,
+        target_loader,
+        target_prime_loader,
+        test_target_prime_X,
+        test_target_prime_y_task,
+        intermediate_loaders=(),
+    ):
+        """
+        intermediate_loaders are the domains between target and target prime (e.g. every lag in between),
+        aligned too by CoRAL and ignored by the other algos.
+        """
         if FLAGS.is_RV_tuning:
             return self._fit_RV(
-                source_loader, target_loader, target_prime_loader, test_target_prime_X, test_target_prime_y_task
+                source_loader,
+                target_loader,
+                target_prime_loader,
+                test_target_prime_X,
+                test_target_prime_y_task,
+                intermediate_loaders,
             )
         else:
             return self._fit(
-                source_loader, target_loader, target_prime_loader, test_target_prime_X, test_target_prime_y_task
+                source_loader,
+                target_loader,
+                target_prime_loader,
+                test_target_prime_X,
+                test_target_prime_y_task,
+                intermediate_loaders,
             )
 
-    def _fit_RV(self, source_loader, target_loader, target_prime_loader, test_target_prime_X, test_target_prime_y_task):
+    def _fit_RV(
+        self,
+        source_loader,
+        target_loader,
+        target_prime_loader,
+        test_target_prime_X,
+        test_target_prime_y_task,
+        intermediate_loaders=(),
+    ):
         """
         Algorythm, Proof: https://drive.google.com/file/d/1YkNMMKeOY4P-HfL2G5GgIrnRJD-lYY96/view?usp=sharing
         Theory: 3.1 ~ 4.2 from https://link.springer.com/chapter/10.1007/978-3-642-15939-8_35
         """
-        # S -> S', S_V
-        source_X = torch.cat([X for X, _ in source_loader], dim=0)
-        source_y_task = torch.cat([y for _, y in source_loader], dim=0)
-        source_ds = TensorDataset(source_X, source_y_task)
+        # S -> S', S_V, split at random as the shuffled source_loader used to be
+        source_ds = utils.DatasetView.from_loader(source_loader)
+        source_ds = source_ds.subview(torch.randperm(len(source_ds)))
         train_source_loader, val_source_loader = utils.tensordataset_to_splitted_loaders(source_ds, self.batch_size)
 
         free_params = [
@@ -109,76 +143,133 @@ class Danns2D:
             {"lr": 0.0001, "eps": 1e-08, "weight_decay": 0},
             {"lr": 0.001, "eps": 1e-08, "weight_decay": 0},
         ]
-        RV_scores = {"free_params": [], "scores": []}
-
-        for param in free_params:
-            # Fit eta
-            self.__init__(self.experiment)
-            self.feature_optimizer.param_groups[0].update(param)
-            self.domain_optimizer_dim1.param_groups[0].update(param)
-            self.domain_optimizer_dim2.param_groups[0].update(param)
-            self.task_optimizer.param_groups[0].update(param)
-
-            val_source_X = torch.cat([X for X, _ in val_source_loader], dim=0)
-            val_source_y_task = torch.cat([y[:, utils.COL_IDX_TASK] for _, y in val_source_loader], dim=0)
-            self.do_early_stop = True
-            self._fit(train_source_loader, target_loader, target_prime_loader, val_source_X, val_source_y_task)
-            # Fit eta_r
-            target_prime_X = torch.cat([X for X, _ in target_prime_loader], dim=0)
-            pred_y_task = self.predict(target_prime_X)
-            target_prime_ds = TensorDataset(
-                target_prime_X,
-                torch.cat(
-                    [pred_y_task.reshape(-1, 1), torch.zeros_like(pred_y_task).reshape(-1, 1).to(torch.float32)], dim=1
-                ),
-            )
-            target_prime_as_source_loader = DataLoader(target_prime_ds, batch_size=self.batch_size, shuffle=True)
-
-            train_source_X = torch.cat([X for X, _ in train_source_loader], dim=0)
-            train_source_ds = TensorDataset(
-                train_source_X, torch.ones(train_source_X.shape[0]).to(torch.float32).to(self.device)
-            )
-            train_source_as_target_prime_loader = DataLoader(train_source_ds, batch_size=self.batch_size, shuffle=True)
-            self.__init__(self.experiment)
-            self.feature_optimizer.param_groups[0].update(param)
-            self.domain_optimizer_dim1.param_groups[0].update(param)
-            self.domain_optimizer_dim2.param_groups[0].update(param)
-            self.task_optimizer.param_groups[0].update(param)
-            self.do_early_stop = True
-            self._fit(
-                target_prime_as_source_loader,
-                target_loader,
-                train_source_as_target_prime_loader,
-                target_prime_X,
-                pred_y_task,
-            )
-
-            # Get RV Loss
-            pred_y_task = self.predict(val_source_X)
-            acc_RV = sum(pred_y_task == val_source_y_task) / len(pred_y_task)
-            RV_scores["free_params"].append(param)
-            RV_scores["scores"].append(acc_RV.item())
+        val_source_X = val_source_loader.dataset.X
+        val_source_y_task = val_source_loader.dataset.y[:, utils.COL_IDX_TASK]
+        # every candidate predicts T', a view of it instead of concatenating the loader per candidate
+        target_prime_view_loader = DataLoader(
+            utils.DatasetView.from_loader(target_prime_loader), batch_size=target_prime_loader.batch_size, shuffle=True
+        )
+        # grid or successive halving by RV_search, one candidate per worker with num_RV_workers > 1
+        RV_scores = rv_utils.search_free_params(
+            self,
+            "_get_RV_score",
+            free_params,
+            **rv_utils.get_RV_options(),
+            train_source_loader=train_source_loader,
+            target_loader=target_loader,
+            target_prime_loader=target_prime_view_loader,
+            val_source_X=val_source_X,
+            val_source_y_task=val_source_y_task,
+            intermediate_loaders=list(intermediate_loaders),
+        )
 
         # Retraining
-        best_param = RV_scores["free_params"][np.argmax(RV_scores["scores"])]
-        self.__init__(self.experiment)
-        self.feature_optimizer.param_groups[0].update(best_param)
-        self.domain_optimizer_dim1.param_groups[0].update(best_param)
-        self.domain_optimizer_dim2.param_groups[0].update(best_param)
-        self.task_optimizer.param_groups[0].update(best_param)
+        best_param = rv_utils.get_best_free_params(RV_scores)
+        self.reset()
+        rv_utils.apply_free_params(
+            self,
+            [self.feature_optimizer, self.domain_optimizer_dim1, self.domain_optimizer_dim2, self.task_optimizer],
+            best_param,
+        )
+        source_loader = rv_utils.rebatch(source_loader, self.batch_size)
+        target_loader = rv_utils.rebatch(target_loader, self.batch_size)
+        target_prime_loader = rv_utils.rebatch(target_prime_loader, self.batch_size)
+        intermediate_loaders = [rv_utils.rebatch(loader, self.batch_size) for loader in intermediate_loaders]
         if self.experiment == "MNIST":
             self.do_early_stop = True
         else:
             self.do_early_stop = False
-        self._fit(source_loader, target_loader, target_prime_loader, val_source_X, val_source_y_task)
+        self._fit(
+            source_loader, target_loader, target_prime_loader, val_source_X, val_source_y_task, intermediate_loaders
+        )
         pred_y_task = self.predict(test_target_prime_X)
         acc = sum(pred_y_task == test_target_prime_y_task) / pred_y_task.shape[0]
         return acc.item()
 
-    def _fit(self, source_loader, target_loader, target_prime_loader, test_target_prime_X, test_target_prime_y_task):
+    def _get_RV_score(
+        self,
+        param,
+        train_source_loader,
+        target_loader,
+        target_prime_loader,
+        val_source_X,
+        val_source_y_task,
+        intermediate_loaders=(),
+    ):
+        """
+        Fit eta and eta_r from scratch with param, and return the RV accuracy on the source validation set.
+        """
+        # Fit eta
+        self.reset()
+        rv_utils.apply_free_params(
+            self,
+            [self.feature_optimizer, self.domain_optimizer_dim1, self.domain_optimizer_dim2, self.task_optimizer],
+            param,
+        )
+        train_source_loader = rv_utils.rebatch(train_source_loader, self.batch_size)
+        target_loader = rv_utils.rebatch(target_loader, self.batch_size)
+        target_prime_loader = rv_utils.rebatch(target_prime_loader, self.batch_size)
+        intermediate_loaders = [rv_utils.rebatch(loader, self.batch_size) for loader in intermediate_loaders]
+
+        self.do_early_stop = True
+        self._fit(
+            train_source_loader,
+            target_loader,
+            target_prime_loader,
+            val_source_X,
+            val_source_y_task,
+            intermediate_loaders,
+        )
+        # Fit eta_r
+        target_prime_X = target_prime_loader.dataset.X
+        pred_y_task = self.predict(target_prime_X)
+        target_prime_ds = TensorDataset(
+            target_prime_X,
+            torch.cat(
+                [pred_y_task.reshape(-1, 1), torch.zeros_like(pred_y_task).reshape(-1, 1).to(torch.float32)], dim=1
+            ),
+        )
+        target_prime_as_source_loader = DataLoader(target_prime_ds, batch_size=self.batch_size, shuffle=True)
+
+        train_source_X = train_source_loader.dataset.X
+        train_source_ds = TensorDataset(
+            train_source_X, torch.ones(train_source_X.shape[0]).to(torch.float32).to(self.device)
+        )
+        train_source_as_target_prime_loader = DataLoader(train_source_ds, batch_size=self.batch_size, shuffle=True)
+        self.reset()
+        rv_utils.apply_free_params(
+            self,
+            [self.feature_optimizer, self.domain_optimizer_dim1, self.domain_optimizer_dim2, self.task_optimizer],
+            param,
+        )
+        self.do_early_stop = True
+        self._fit(
+            target_prime_as_source_loader,
+            target_loader,
+            train_source_as_target_prime_loader,
+            target_prime_X,
+            pred_y_task,
+            intermediate_loaders,
+        )
+
+        # Get RV Loss
+        pred_y_task = self.predict(val_source_X)
+        acc_RV = sum(pred_y_task == val_source_y_task) / len(pred_y_task)
+        return acc_RV.item()
+
+    def _fit(
+        self,
+        source_loader,
+        target_loader,
+        target_prime_loader,
+        test_target_prime_X,
+        test_target_prime_y_task,
+        intermediate_loaders=(),
+    ):
         data = {
             "source_loader": source_loader,
             "target_loader": target_loader,
+            "intermediate_loaders": list(intermediate_loaders),
             "target_prime_loader": target_prime_loader,
             "target_prime_X": test_target_prime_X,
             "target_prime_y_task": test_target_prime_y_task,
@@ -194,11 +285,16 @@ class Danns2D:
             "domain_optimizer_dim2": self.domain_optimizer_dim2,
             "task_optimizer": self.task_optimizer,
         }
-        config = {"num_epochs": self.num_epochs, "device": self.device, "do_early_stop": self.do_early_stop}
+        config = self.get_trainer_config(
+            num_epochs=self.num_epochs,
+            ot_backend=self.ot_backend,
+            sinkhorn_threshold=self.sinkhorn_threshold,
+            is_warm_start=self.is_warm_start,
+        )
         self.feature_extractor, self.task_classifier, acc = ALGORYTHMS[FLAGS.algo_name].fit(data, network, **config)
         return acc
 
-    def predict(self, X):
-        out = self.feature_extractor(X)
-        out = self.task_classifier.predict(out)
-        return out
+    def predict(self, X, **kwargs):
+        return utils.predict_in_chunks(
+            lambda X: self.task_classifier.predict(self.feature_extractor(X)), X, is_compiled=self.is_compiled, **kwargs
+        )
@@ -0,0 +1,15 @@
+import torch
+from torch import nn
+
+
+class DomainSpecificBatchNorm1d(nn.BatchNorm1d):
+    """
+    nn.BatchNorm1d which can normalize a fused batch of several domains chunk by chunk,
+    so that batch statistics stay per-domain as if each domain was forwarded separately.
+    """
+
+    def forward(self, x, domain_sizes=None):
+        if domain_sizes is None:
+            return super().forward(x)
+        x_domains = torch.split(x, domain_sizes, dim=0)
+        return torch.cat([super(DomainSpecificBatchNorm1d, self).forward(x_domain) for x_domain in x_domains], dim=0)
@@ -1,28 +1,30 @@
-import numpy as np
 import torch
 from absl import flags
 from torch import nn, optim
 from torch.utils.data import DataLoader, TensorDataset
 
-from ..algo import coral_algo, dann_algo, jdot_algo
-from ..utils import utils
+from ..algo import coral_algo, dan_algo, dann_algo, jdot_algo
+from ..utils import rv_utils, utils
 from .conv1d_three_layers import Conv1dThreeLayers
 from .conv1d_two_layers import Conv1dTwoLayers
 from .conv2d import Conv2d
 from .mlp_decoder_three_layers import ThreeLayersDecoder
+from .resettable import Resettable
+from .training_config import TrainingConfig
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 FLAGS = flags.FLAGS
-ALGORYTHMS = {"DANN": dann_algo, "CoRAL": coral_algo, "JDOT": jdot_algo}
+ALGORYTHMS = {"DANN": dann_algo, "CoRAL": coral_algo, "JDOT": jdot_algo, "DAN": dan_algo}
 
 
-class IsihDanns:
+class IsihDanns(Resettable, TrainingConfig):
     """
     TODO: Attach paper
     """
 
     def __init__(self, experiment: str):
         assert experiment in ["ECOdataset", "ECOdataset_synthetic", "HHAR", "MNIST"]
+        self.set_training_defaults()
 
         if experiment in ["ECOdataset", "ECOdataset_synthetic"]:
             self.feature_extractor = Conv1dTwoLayers(input_size=3).to(DEVICE)
@@ -57,6 +59,7 @@ class IsihDanns:
             self.batch_size = 32
             self.experiment = experiment
             self.do_early_stop = False
+            self.is_domain_specific_bn = True
 
         elif experiment == "HHAR":
             self.feature_extractor = Conv1dThreeLayers(input_size=6).to(DEVICE)
@@ -86,6 +89,7 @@ class IsihDanns:
             self.batch_size = 128
             self.experiment = experiment
             self.do_early_stop = False
+            self.is_domain_specific_bn = True
 
         elif experiment in ["MNIST"]:
             self.feature_extractor = Conv2d()
@@ -117,6 +121,7 @@ class IsihDanns:
             self.batch_size = 64
             self.experiment = experiment
             self.do_early_stop = False
+        self.save_initial_state()
 
     def fit_1st_dim(
         self,
@@ -149,62 +154,28 @@ class IsihDanns:
             {"lr": 0.0001, "eps": 1e-08, "weight_decay": 0},
             {"lr": 0.001, "eps": 1e-08, "weight_decay": 0},
         ]
-        RV_scores = {"free_params": [], "scores": []}
-        for param in free_params:
-            self.__init__(self.experiment)
-            self.feature_optimizer_dim1.param_groups[0].update(param)
-            self.domain_optimizer_dim1.param_groups[0].update(param)
-            self.task_optimizer_dim1.param_groups[0].update(param)
-            # 3. RV algo
-            ## 3.1 fit f_i
-            val_source_X = torch.cat([X for X, _ in val_source_loader], dim=0)
-            val_source_y_task = torch.cat([y[:, utils.COL_IDX_TASK] for _, y in val_source_loader], dim=0)
-            self.do_early_stop = True
-            self._fit_1st_dim(train_source_loader, train_target_loader, val_source_X, val_source_y_task)
-            ## 3.2 fit \bar{f}_i
-            train_target_X = torch.cat([X for X, _ in train_target_loader], dim=0)
-            train_target_pred_y_task = self.predict(train_target_X, is_1st_dim=True)
-            val_target_X = torch.cat([X for X, _ in val_target_loader], dim=0)
-            val_target_pred_y_task = self.predict(val_target_X, is_1st_dim=True)
-
-            train_target_ds = TensorDataset(
-                train_target_X,
-                torch.cat(
-                    [
-                        train_target_pred_y_task.reshape(-1, 1),
-                        torch.zeros_like(train_target_pred_y_task).reshape(-1, 1).to(torch.float32),
-                    ],
-                    dim=1,
-                ),
-            )
-            target_as_source_loader = DataLoader(train_target_ds, batch_size=self.batch_size, shuffle=True)
-
-            train_source_X = torch.cat([X for X, _ in train_source_loader], dim=0)
-            train_source_ds = TensorDataset(
-                train_source_X, torch.ones(train_source_X.shape[0]).to(torch.float32).to(self.device)
-            )
-            train_source_as_target_loader = DataLoader(train_source_ds, batch_size=self.batch_size, shuffle=True)
-
-            self.__init__(self.experiment)
-            self.feature_optimizer_dim1.param_groups[0].update(param)
-            self.domain_optimizer_dim1.param_groups[0].update(param)
-            self.task_optimizer_dim1.param_groups[0].update(param)
-            self.do_early_stop = True
-            self._fit_1st_dim(
-                target_as_source_loader, train_source_as_target_loader, val_target_X, val_target_pred_y_task
-            )
-            ## 3.3 get RV loss
-            pred_y_task = self.predict(val_source_X, is_1st_dim=True)
-            acc_RV = sum(pred_y_task == val_source_y_task) / val_source_y_task.shape[0]
-            RV_scores["free_params"].append(param)
-            RV_scores["scores"].append(acc_RV.item())
+        val_source_X = val_source_loader.dataset.X
+        val_source_y_task = val_source_loader.dataset.y[:, utils.COL_IDX_TASK]
+        # 3. RV algo, grid or successive halving by RV_search, one candidate per worker with num_RV_workers > 1
+        RV_scores = rv_utils.search_free_params(
+            self,
+            "_get_RV_score_1st_dim",
+            free_params,
+            **rv_utils.get_RV_options(),
+            epoch_names=("num_epochs_dim1",),
+            train_source_loader=train_source_loader,
+            train_target_loader=train_target_loader,
+            val_target_loader=val_target_loader,
+            val_source_X=val_source_X,
+            val_source_y_task=val_source_y_task,
+        )
 
         # 4. Retraining
-        best_param = RV_scores["free_params"][np.argmax(RV_scores["scores"])]
-        self.__init__(self.experiment)
-        self.feature_optimizer_dim1.param_groups[0].update(best_param)
-        self.domain_optimizer_dim1.param_groups[0].update(best_param)
-        self.task_optimizer_dim1.param_groups[0].update(best_param)
+        best_param = rv_utils.get_best_free_params(RV_scores)
+        self.reset()
+        rv_utils.apply_free_params(
+            self, [self.feature_optimizer_dim1, self.domain_optimizer_dim1, self.task_optimizer_dim1], best_param
+        )
         source_loader = DataLoader(source_ds, batch_size=self.batch_size, shuffle=True)
         target_loader = DataLoader(target_ds, batch_size=self.batch_size, shuffle=True)
         if self.experiment == "MNIST":
@@ -213,6 +184,62 @@ class IsihDanns:
             self.do_early_stop = False
         self._fit_1st_dim(source_loader, target_loader, val_source_X, val_source_y_task)
 
+    def _get_RV_score_1st_dim(
+        self,
+        param: dict,
+        train_source_loader: torch.utils.data.dataloader.DataLoader,
+        train_target_loader: torch.utils.data.dataloader.DataLoader,
+        val_target_loader: torch.utils.data.dataloader.DataLoader,
+        val_source_X: torch.Tensor,
+        val_source_y_task: torch.Tensor,
+    ) -> float:
+        """
+        Train the forward and the reverse classifiers of the 1st dim from scratch with param, return the RV accuracy.
+        """
+        self.reset()
+        rv_utils.apply_free_params(
+            self, [self.feature_optimizer_dim1, self.domain_optimizer_dim1, self.task_optimizer_dim1], param
+        )
+        train_source_loader = rv_utils.rebatch(train_source_loader, self.batch_size)
+        train_target_loader = rv_utils.rebatch(train_target_loader, self.batch_size)
+        ## 3.1 fit f_i
+        self.do_early_stop = True
+        self._fit_1st_dim(train_source_loader, train_target_loader, val_source_X, val_source_y_task)
+        ## 3.2 fit \bar{f}_i
+        train_target_X = train_target_loader.dataset.X
+        train_target_pred_y_task = self.predict(train_target_X, is_1st_dim=True)
+        val_target_X = val_target_loader.dataset.X
+        val_target_pred_y_task = self.predict(val_target_X, is_1st_dim=True)
+
+        train_target_ds = TensorDataset(
+            train_target_X,
+            torch.cat(
+                [
+                    train_target_pred_y_task.reshape(-1, 1),
+                    torch.zeros_like(train_target_pred_y_task).reshape(-1, 1).to(torch.float32),
+                ],
+                dim=1,
+            ),
+        )
+        target_as_source_loader = DataLoader(train_target_ds, batch_size=self.batch_size, shuffle=True)
+
+        train_source_X = train_source_loader.dataset.X
+        train_source_ds = TensorDataset(
+            train_source_X, torch.ones(train_source_X.shape[0]).to(torch.float32).to(self.device)
+        )
+        train_source_as_target_loader = DataLoader(train_source_ds, batch_size=self.batch_size, shuffle=True)
+
+        self.reset()
+        rv_utils.apply_free_params(
+            self, [self.feature_optimizer_dim1, self.domain_optimizer_dim1, self.task_optimizer_dim1], param
+        )
+        self.do_early_stop = True
+        self._fit_1st_dim(target_as_source_loader, train_source_as_target_loader, val_target_X, val_target_pred_y_task)
+        ## 3.3 get RV loss
+        pred_y_task = self.predict(val_source_X, is_1st_dim=True)
+        acc_RV = sum(pred_y_task == val_source_y_task) / val_source_y_task.shape[0]
+        return acc_RV.item()
+
     def _fit_1st_dim(self, source_loader, target_loader, test_target_X: torch.Tensor, test_target_y_task: torch.Tensor):
         data = {
             "source_loader": source_loader,
@@ -230,13 +257,8 @@ class IsihDanns:
                 "domain_optimizer": self.domain_optimizer_dim1,
                 "task_optimizer": self.task_optimizer_dim1,
             }
-            config = {
-                "num_epochs": self.num_epochs_dim1,
-                "is_target_weights": self.is_target_weights,
-                "device": self.device,
-                "do_early_stop": self.do_early_stop,
-            }
-        elif FLAGS.algo_name == "CoRAL":
+            config = self.get_trainer_config(num_epochs=self.num_epochs_dim1, is_target_weights=self.is_target_weights)
+        elif FLAGS.algo_name in ["CoRAL", "DAN"]:
             network = {
                 "feature_extractor": self.feature_extractor,
                 "task_classifier": self.task_classifier_dim1,
@@ -244,11 +266,7 @@ class IsihDanns:
                 "feature_optimizer": self.feature_optimizer_dim1,
                 "task_optimizer": self.task_optimizer_dim1,
             }
-            config = {
-                "num_epochs": self.num_epochs_dim1,
-                "device": self.device,
-                "do_early_stop": self.do_early_stop,
-            }
+            config = self.get_trainer_config(num_epochs=self.num_epochs_dim1)
         elif FLAGS.algo_name == "JDOT":
             network = {
                 "feature_extractor": self.feature_extractor,
@@ -257,11 +275,12 @@ class IsihDanns:
                 "feature_optimizer": self.feature_optimizer_dim1,
                 "task_optimizer": self.task_optimizer_dim1,
             }
-            config = {
-                "num_epochs": self.num_epochs_dim1,
-                "device": self.device,
-                "do_early_stop": self.do_early_stop,
-            }
+            config = self.get_trainer_config(
+                num_epochs=self.num_epochs_dim1,
+                ot_backend=self.ot_backend,
+                sinkhorn_threshold=self.sinkhorn_threshold,
+                is_warm_start=self.is_warm_start,
+            )
         self.feature_extractor, self.task_classifier_dim1, _ = ALGORYTHMS[FLAGS.algo_name].fit(data, network, **config)
 
     def fit_2nd_dim(
@@ -299,74 +318,38 @@ class IsihDanns:
             {"lr": 0.0001, "eps": 1e-08, "weight_decay": 0},
             {"lr": 0.001, "eps": 1e-08, "weight_decay": 0},
         ]
-        RV_scores = {"free_params": [], "scores": []}
-        tmp = self.feature_extractor
-
-        for param in free_params:
-            self.__init__(self.experiment)
-            self.feature_extractor.load_state_dict(tmp.state_dict())
-            self.feature_optimizer_dim2.param_groups[0].update(param)
-            self.domain_optimizer_dim2.param_groups[0].update(param)
-            self.task_optimizer_dim2.param_groups[0].update(param)
-
-            # 3. RV algo
-            ## 3.1 fit f_i
-            val_source_X = torch.cat([X for X, _ in val_source_loader], dim=0)
-            if self.task_classifier_dim1.output_size == 1:
-                val_source_y_task = torch.cat([y[:, utils.COL_IDX_TASK] > 0.5 for _, y in val_source_loader], dim=0)
-            else:
-                val_source_y_task = torch.cat([y[:, :-1].argmax(dim=1) for _, y in val_source_loader], dim=0)
-            self.do_early_stop = True
-            self._fit_2nd_dim(train_source_loader, train_target_loader, val_source_X, val_source_y_task)
-            ## 3.2 fit \bar{f}_i
-            train_target_X = torch.cat([X for X, _ in train_target_loader], dim=0)
-            train_target_pred_y_task = self.predict(train_target_X, is_1st_dim=False)
-            val_target_X = torch.cat([X for X, _ in val_target_loader], dim=0)
-            val_target_pred_y_task = self.predict(val_target_X, is_1st_dim=False)
-
-            train_target_ds = TensorDataset(
-                train_target_X,
-                torch.cat(
-                    [
-                        train_target_pred_y_task.reshape(-1, 1),
-                        torch.zeros_like(train_target_pred_y_task).reshape(-1, 1).to(torch.float32),
-                    ],
-                    dim=1,
-                ),
-            )
-            target_as_source_loader = DataLoader(train_target_ds, batch_size=self.batch_size, shuffle=True)
-
-            train_source_X = torch.cat([X for X, _ in train_source_loader], dim=0)
-            train_source_ds = TensorDataset(
-                train_source_X, torch.ones(train_source_X.shape[0]).to(torch.float32).to(self.device)
-            )
-            train_source_as_target_loader = DataLoader(train_source_ds, batch_size=self.batch_size, shuffle=True)
-
-            self.__init__(self.experiment)
-            self.feature_extractor.load_state_dict(tmp.state_dict())
-            self.feature_optimizer_dim1.param_groups[0].update(param)
-            self.domain_optimizer_dim1.param_groups[0].update(param)
-            self.task_optimizer_dim1.param_groups[0].update(param)
-            self.do_early_stop = True
-            self._fit_1st_dim(
-                target_as_source_loader, train_source_as_target_loader, val_target_X, val_target_pred_y_task
-            )
-            ## 3.3 get RV loss
-            pred_y_task = self.predict(val_source_X, is_1st_dim=True)
-            acc_RV = sum(pred_y_task == val_source_y_task) / val_source_y_task.shape[0]
-            RV_scores["free_params"].append(param)
-            RV_scores["scores"].append(acc_RV.item())
+        # reset() overwrites the feature extractor of the 1st dim in place, so keep a copy of its weights
+        feature_extractor_state = {key: value.clone() for key, value in self.feature_extractor.state_dict().items()}
+        val_source_X = val_source_loader.dataset.X
+        if self.task_classifier_dim1.output_size == 1:
+            val_source_y_task = val_source_loader.dataset.y[:, utils.COL_IDX_TASK] > 0.5
+        else:
+            val_source_y_task = val_source_loader.dataset.y[:, :-1].argmax(dim=1)
+        # 3. RV algo, grid or successive halving by RV_search, one candidate per worker with num_RV_workers > 1
+        RV_scores = rv_utils.search_free_params(
+            self,
+            "_get_RV_score_2nd_dim",
+            free_params,
+            **rv_utils.get_RV_options(),
+            epoch_names=("num_epochs_dim2", "num_epochs_dim1"),
+            feature_extractor_state=feature_extractor_state,
+            train_source_loader=train_source_loader,
+            train_target_loader=train_target_loader,
+            val_target_loader=val_target_loader,
+            val_source_X=val_source_X,
+            val_source_y_task=val_source_y_task,
+        )
         # 4. Retraining
-        best_param = RV_scores["free_params"][np.argmax(RV_scores["scores"])]
+        best_param = rv_utils.get_best_free_params(RV_scores)
 
-        self.__init__(self.experiment)
-        self.feature_extractor.load_state_dict(tmp.state_dict())
+        self.reset()
+        self.feature_extractor.load_state_dict(feature_extractor_state)
         # self.feature_optimizer_dim2 = optim.Adam(self.feature_extractor.parameters())
         # TODO: Understand that this line causes lower evaluation score
 
-        self.feature_optimizer_dim2.param_groups[0].update(best_param)
-        self.domain_optimizer_dim2.param_groups[0].update(best_param)
-        self.task_optimizer_dim2.param_groups[0].update(best_param)
+        rv_utils.apply_free_params(
+            self, [self.feature_optimizer_dim2, self.domain_optimizer_dim2, self.task_optimizer_dim2], best_param
+        )
         source_loader = DataLoader(source_ds, batch_size=self.batch_size, shuffle=True)
         target_loader = DataLoader(target_ds, batch_size=self.batch_size, shuffle=True)
         if self.experiment == "MNIST":
@@ -379,6 +362,67 @@ class IsihDanns:
         acc = sum(pred_y_task == test_target_y_task) / test_target_y_task.shape[0]
         return acc.item()
 
+    def _get_RV_score_2nd_dim(
+        self,
+        param: dict,
+        feature_extractor_state: dict,
+        train_source_loader: torch.utils.data.dataloader.DataLoader,
+        train_target_loader: torch.utils.data.dataloader.DataLoader,
+        val_target_loader: torch.utils.data.dataloader.DataLoader,
+        val_source_X: torch.Tensor,
+        val_source_y_task: torch.Tensor,
+    ) -> float:
+        """
+        Train the forward and the reverse classifiers of the 2nd dim with param, starting from the feature extractor
+        of the 1st dim, return the RV accuracy.
+        """
+        self.reset()
+        self.feature_extractor.load_state_dict(feature_extractor_state)
+        rv_utils.apply_free_params(
+            self, [self.feature_optimizer_dim2, self.domain_optimizer_dim2, self.task_optimizer_dim2], param
+        )
+        train_source_loader = rv_utils.rebatch(train_source_loader, self.batch_size)
+        train_target_loader = rv_utils.rebatch(train_target_loader, self.batch_size)
+
+        ## 3.1 fit f_i
+        self.do_early_stop = True
+        self._fit_2nd_dim(train_source_loader, train_target_loader, val_source_X, val_source_y_task)
+        ## 3.2 fit \bar{f}_i
+        train_target_X = train_target_loader.dataset.X
+        train_target_pred_y_task = self.predict(train_target_X, is_1st_dim=False)
+        val_target_X = val_target_loader.dataset.X
+        val_target_pred_y_task = self.predict(val_target_X, is_1st_dim=False)
+
+        train_target_ds = TensorDataset(
+            train_target_X,
+            torch.cat(
+                [
+                    train_target_pred_y_task.reshape(-1, 1),
+                    torch.zeros_like(train_target_pred_y_task).reshape(-1, 1).to(torch.float32),
+                ],
+                dim=1,
+            ),
+        )
+        target_as_source_loader = DataLoader(train_target_ds, batch_size=self.batch_size, shuffle=True)
+
+        train_source_X = train_source_loader.dataset.X
+        train_source_ds = TensorDataset(
+            train_source_X, torch.ones(train_source_X.shape[0]).to(torch.float32).to(self.device)
+        )
+        train_source_as_target_loader = DataLoader(train_source_ds, batch_size=self.batch_size, shuffle=True)
+
+        self.reset()
+        self.feature_extractor.load_state_dict(feature_extractor_state)
+        rv_utils.apply_free_params(
+            self, [self.feature_optimizer_dim1, self.domain_optimizer_dim1, self.task_optimizer_dim1], param
+        )
+        self.do_early_stop = True
+        self._fit_1st_dim(target_as_source_loader, train_source_as_target_loader, val_target_X, val_target_pred_y_task)
+        ## 3.3 get RV loss
+        pred_y_task = self.predict(val_source_X, is_1st_dim=True)
+        acc_RV = sum(pred_y_task == val_source_y_task) / val_source_y_task.shape[0]
+        return acc_RV.item()
+
     def _fit_2nd_dim(self, source_loader, target_loader, test_target_X: torch.Tensor, test_target_y_task: torch.Tensor):
         data = {
             "source_loader": source_loader,
@@ -396,14 +440,10 @@ class IsihDanns:
                 "domain_optimizer": self.domain_optimizer_dim2,
                 "task_optimizer": self.task_optimizer_dim2,
             }
-            config = {
-                "num_epochs": self.num_epochs_dim2,
-                "is_psuedo_weights": True,
-                "is_target_weights": self.is_target_weights,
-                "device": self.device,
-                "do_early_stop": self.do_early_stop,
-            }
-        elif FLAGS.algo_name == "CoRAL":
+            config = self.get_trainer_config(
+                num_epochs=self.num_epochs_dim2, is_psuedo_weights=True, is_target_weights=self.is_target_weights
+            )
+        elif FLAGS.algo_name in ["CoRAL", "DAN"]:
             network = {
                 "feature_extractor": self.feature_extractor,
                 "task_classifier": self.task_classifier_dim2,
@@ -411,12 +451,7 @@ class IsihDanns:
                 "feature_optimizer": self.feature_optimizer_dim2,
                 "task_optimizer": self.task_optimizer_dim2,
             }
-            config = {
-                "num_epochs": self.num_epochs_dim2,
-                "is_psuedo_weights": True,
-                "device": self.device,
-                "do_early_stop": self.do_early_stop,
-            }
+            config = self.get_trainer_config(num_epochs=self.num_epochs_dim2, is_psuedo_weights=True)
         elif FLAGS.algo_name == "JDOT":
             network = {
                 "feature_extractor": self.feature_extractor,
@@ -425,25 +460,29 @@ class IsihDanns:
                 "feature_optimizer": self.feature_optimizer_dim2,
                 "task_optimizer": self.task_optimizer_dim2,
             }
-            config = {
-                "num_epochs": self.num_epochs_dim2,
-                "is_psuedo_weights": True,
-                "device": self.device,
-                "do_early_stop": self.do_early_stop,
-            }
+            config = self.get_trainer_config(
+                num_epochs=self.num_epochs_dim2,
+                is_psuedo_weights=True,
+                ot_backend=self.ot_backend,
+                sinkhorn_threshold=self.sinkhorn_threshold,
+                is_warm_start=self.is_warm_start,
+            )
         self.feature_extractor, self.task_classifier_dim2, _ = ALGORYTHMS[FLAGS.algo_name].fit(data, network, **config)
 
-    def predict(self, X: torch.Tensor, is_1st_dim: bool) -> torch.Tensor:
-        if is_1st_dim:
-            return self.task_classifier_dim1.predict(self.feature_extractor(X))
-        else:
-            return self.task_classifier_dim2.predict(self.feature_extractor(X))
-
-    def predict_proba(self, X: torch.Tensor, is_1st_dim: bool) -> torch.Tensor:
-        if is_1st_dim:
-            return self.task_classifier_dim1.predict_proba(self.feature_extractor(X))
-        else:
-            return self.task_classifier_dim2.predict_proba(self.feature_extractor(X))
+    def predict(self, X: torch.Tensor, is_1st_dim: bool, **kwargs) -> torch.Tensor:
+        task_classifier = self.task_classifier_dim1 if is_1st_dim else self.task_classifier_dim2
+        return utils.predict_in_chunks(
+            lambda X: task_classifier.predict(self.feature_extractor(X)), X, is_compiled=self.is_compiled, **kwargs
+        )
+
+    def predict_proba(self, X: torch.Tensor, is_1st_dim: bool, **kwargs) -> torch.Tensor:
+        task_classifier = self.task_classifier_dim1 if is_1st_dim else self.task_classifier_dim2
+        return utils.predict_in_chunks(
+            lambda X: task_classifier.predict_proba(self.feature_extractor(X)),
+            X,
+            is_compiled=self.is_compiled,
+            **kwargs,
+        )
 
     def set_eval(self):
         self.task_classifier_dim2.eval()
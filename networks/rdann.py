@@ -12,6 +12,7 @@ class Rdann(DannsBase):
     """
 
     def __init__(self, experiment: str) -> None:
+        self.set_training_defaults()
         if experiment == "HHAR":
             self.feature_extractor = ManyToOneRNN(input_size=6, hidden_size=128, num_layers=3).to(utils.DEVICE)
             self.domain_classifier = ThreeLayersDecoder(input_size=128, output_size=1).to(utils.DEVICE)
@@ -27,3 +28,4 @@ class Rdann(DannsBase):
             self.is_target_weights = True
             self.experiment = experiment
             self.device = utils.DEVICE
+        self.save_initial_state()
@@ -0,0 +1,69 @@
+import torch
+from torch import nn, optim
+
+
+class Resettable:
+    """
+    Models whose networks, optimizers and free params can be put back to the state right after __init__ in place,
+    instead of re-running __init__, which rebuilds every network, moves it to the device and recreates optimizers.
+    __init__ calls save_initial_state() once at its end.
+    """
+
+    def save_initial_state(self):
+        self.initial_state = {
+            "modules": {
+                name: {key: value.detach().clone() for key, value in module.state_dict().items()}
+                for name, module in vars(self).items()
+                if isinstance(module, nn.Module)
+            },
+            "training": {name: module.training for name, module in vars(self).items() if isinstance(module, nn.Module)},
+            "optimizers": {
+                name: [
+                    {key: value for key, value in group.items() if key != "params"} for group in optimizer.param_groups
+                ]
+                for name, optimizer in vars(self).items()
+                if isinstance(optimizer, optim.Optimizer)
+            },
+            "attributes": {
+                name: value
+                for name, value in vars(self).items()
+                if not isinstance(value, (nn.Module, optim.Optimizer)) and name != "initial_state"
+            },
+        }
+
+    def reset(self, seed=None):
+        """
+        Copy the initial weights back into the existing parameters and buffers, clear the optimizer states
+        and restore the train/eval modes, the hyperparameters of the param groups and the other attributes.
+
+        Parameters
+        ----------
+        seed : int or None
+            if given, draw new initial weights by reset_parameters with seed instead, which later reset() calls
+            (e.g. of reverse validation) go back to. A different but reproducible initialization per experiment repeat.
+        """
+        for name, state_dict in self.initial_state["modules"].items():
+            module = getattr(self, name)
+            with torch.no_grad():
+                for key, value in module.state_dict().items():
+                    value.copy_(state_dict[key])
+        if seed is not None:
+            # the global RNG, e.g. of the shuffling of the loaders, is left as is
+            with torch.random.fork_rng():
+                torch.manual_seed(seed)
+                for name in self.initial_state["modules"]:
+                    for module in getattr(self, name).modules():
+                        if hasattr(module, "reset_parameters"):
+                            module.reset_parameters()
+            for name, state_dict in self.initial_state["modules"].items():
+                for key, value in getattr(self, name).state_dict().items():
+                    state_dict[key].copy_(value)
+        for name, training in self.initial_state["training"].items():
+            getattr(self, name).train(training)
+        for name, groups in self.initial_state["optimizers"].items():
+            optimizer = getattr(self, name)
+            optimizer.state.clear()
+            for group, initial_group in zip(optimizer.param_groups, groups):
+                group.update(initial_group)
+        for name, value in self.initial_state["attributes"].items():
+            setattr(self, name, value)
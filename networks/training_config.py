@@ -0,0 +1,43 @@
+from absl import flags
+
+FLAGS = flags.FLAGS
+# trainer options shared by every experiment, a flag of the same name defined by the experiment overrides one
+TRAINING_DEFAULTS = {
+    "is_fused_forward": False,
+    "is_domain_specific_bn": False,
+    "is_compiled": False,
+    "is_autocast": False,
+    "num_steps": None,
+    "time_budget": None,
+    "grl_gamma": 10,
+    "ot_backend": "emd",
+    "sinkhorn_threshold": None,
+    "is_warm_start": False,
+}
+
+
+class TrainingConfig:
+    """
+    Models sharing TRAINING_DEFAULTS. __init__ calls set_training_defaults() once at its start
+    and only sets the options an experiment overrides, _fit passes get_trainer_config() to the algo.
+    """
+
+    def set_training_defaults(self):
+        # as instance attributes, so that reset() and the RV cache key see them
+        for name, value in TRAINING_DEFAULTS.items():
+            setattr(self, name, FLAGS[name].value if name in FLAGS else value)
+
+    def get_trainer_config(self, **kwargs):
+        config = {
+            "do_early_stop": self.do_early_stop,
+            "device": self.device,
+            "is_fused_forward": self.is_fused_forward,
+            "is_domain_specific_bn": self.is_domain_specific_bn,
+            "is_compiled": self.is_compiled,
+            "drop_last": self.is_compiled,
+            "is_autocast": self.is_autocast,
+            "num_steps": self.num_steps,
+            "time_budget": self.time_budget,
+            "grl_gamma": self.grl_gamma,
+        }
+        return {**config, **kwargs}
@@ -0,0 +1,10 @@
+import sys
+import types
+from pathlib import Path
+
+# the repository is the package (python -m domain-invariant-learning.experiments...), whose modules import each
+# other relatively, so it is registered under an importable name for the tests
+ROOT = Path(__file__).resolve().parents[1]
+package = types.ModuleType("domain_invariant_learning")
+package.__path__ = [str(ROOT)]
+sys.modules.setdefault("domain_invariant_learning", package)
@@ -0,0 +1,76 @@
+import pytest
+import torch
+
+from domain_invariant_learning.algo.algo_utils import _get_class_weights, get_psuedo_label_weights
+from domain_invariant_learning.utils import utils
+
+
+def _get_psuedo_label_weights_loop(source_Y_batch, thr=0.75, alpha=1):
+    """
+    Element-wise reference of get_psuedo_label_weights, as it was before vectorization.
+    """
+    output_size = source_Y_batch[:, :-1].shape[1]
+    psuedo_label_weights = []
+
+    if output_size == 1:
+        pred_y = source_Y_batch[:, utils.COL_IDX_TASK]
+        for i in pred_y:
+            if i > thr:
+                psuedo_label_weights.append(1)
+            elif i < 1 - thr:
+                psuedo_label_weights.append(1)
+            else:
+                if i > 0.5:
+                    psuedo_label_weights.append(i ** alpha + (1 - thr))
+                else:
+                    psuedo_label_weights.append((1 - i) ** alpha + (1 - thr))
+
+    else:
+        pred_y = source_Y_batch[:, :output_size]
+        pred_y = torch.max(pred_y, axis=1).values
+        for i in pred_y:
+            if i > thr:
+                psuedo_label_weights.append(1)
+            else:
+                psuedo_label_weights.append(i ** alpha + (1 - thr))
+    return torch.tensor(psuedo_label_weights, dtype=torch.float32).to(source_Y_batch.device)
+
+
+def _get_class_weights_loop(source_y_task_batch):
+    """
+    Element-wise reference of _get_class_weights, as it was before vectorization.
+    """
+    p_occupied = sum(source_y_task_batch) / source_y_task_batch.shape[0]
+    p_unoccupied = 1 - p_occupied
+    class_weights = torch.zeros_like(source_y_task_batch)
+    for i, y in enumerate(source_y_task_batch):
+        if y == 1:
+            class_weights[i] = p_unoccupied
+        elif y == 0:
+            class_weights[i] = p_occupied
+    return class_weights
+
+
+@pytest.mark.parametrize("output_size", [1, 6])
+@pytest.mark.parametrize("batch_size", [1, 32, 128])
+def test_psuedo_label_weights_parity(output_size, batch_size):
+    torch.manual_seed(0)
+    if output_size == 1:
+        pred_y_task = torch.rand(batch_size, 1)
+    else:
+        pred_y_task = torch.softmax(torch.randn(batch_size, output_size) * 3, dim=1)
+    source_Y_batch = torch.cat([pred_y_task, torch.zeros(batch_size, 1)], dim=1).to(utils.DEVICE)
+    weights = get_psuedo_label_weights(source_Y_batch, device=utils.DEVICE)
+    loop_weights = _get_psuedo_label_weights_loop(source_Y_batch)
+    assert weights.dtype == loop_weights.dtype
+    torch.testing.assert_close(weights, loop_weights)
+
+
+@pytest.mark.parametrize("batch_size", [1, 32, 128])
+def test_class_weights_parity(batch_size):
+    torch.manual_seed(0)
+    source_y_task_batch = torch.randint(0, 2, (batch_size,)).to(torch.float32).to(utils.DEVICE)
+    weights = _get_class_weights(source_y_task_batch)
+    loop_weights = _get_class_weights_loop(source_y_task_batch)
+    assert weights.dtype == loop_weights.dtype
+    torch.testing.assert_close(weights, loop_weights)
@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from domain_invariant_learning.algo import dan_algo
+
+ESTIMATORS = [dan_algo.get_MMD, dan_algo.get_linear_MMD, dan_algo.get_RFF_MMD]
+
+
+@pytest.mark.parametrize("get_MMD", ESTIMATORS)
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_mmd_small_batches(get_MMD, batch_size):
+    torch.manual_seed(0)
+    x = torch.randn(batch_size, 8, requires_grad=True)
+    y = torch.randn(batch_size, 8) + 1
+    mmd = get_MMD(x, y)
+    assert mmd.shape == ()
+    assert torch.isfinite(mmd)
+    if get_MMD is dan_algo.get_linear_MMD and batch_size == 1:
+        assert mmd.item() == 0
+    if mmd.requires_grad:
+        mmd.backward()
+        assert torch.isfinite(x.grad).all()
+
+
+@pytest.mark.parametrize("get_MMD", ESTIMATORS)
+def test_mmd_equal_samples(get_MMD):
+    x = torch.ones(4, 8)
+    assert get_MMD(x, x.clone()).item() == pytest.approx(0, abs=1e-6)
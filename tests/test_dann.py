@@ -0,0 +1,60 @@
+import pytest
+import torch
+from torch import nn, optim
+from torch.utils.data import DataLoader, TensorDataset
+
+from domain_invariant_learning.algo.dann_algo import DannTrainer
+from domain_invariant_learning.networks import Encoder, ThreeLayersDecoder
+
+
+def _get_trainer(output_size, is_single_backward, batch_size=16, input_size=4):
+    torch.manual_seed(0)
+    feature_extractor = Encoder(input_size=input_size, output_size=8)
+    domain_classifier = ThreeLayersDecoder(input_size=8, output_size=1, fc1_size=16, fc2_size=16)
+    task_classifier = ThreeLayersDecoder(input_size=8, output_size=output_size, fc1_size=16, fc2_size=16)
+    source_X = torch.randn(batch_size, input_size)
+    source_y_task = torch.randint(0, max(output_size, 2), (batch_size,)).to(torch.float32)
+    source_Y = torch.stack([source_y_task, torch.zeros_like(source_y_task)], dim=1)
+    target_X = torch.randn(batch_size, input_size)
+    data = {
+        "source_loader": DataLoader(TensorDataset(source_X, source_Y), batch_size=batch_size),
+        "target_loader": DataLoader(TensorDataset(target_X, torch.ones(batch_size)), batch_size=batch_size),
+        "target_X": target_X,
+        "target_y_task": source_y_task,
+    }
+    network = {
+        "feature_extractor": feature_extractor,
+        "domain_classifier": domain_classifier,
+        "task_classifier": task_classifier,
+        "criterion": nn.BCELoss(),
+        "feature_optimizer": optim.Adam(feature_extractor.parameters()),
+        "domain_optimizer": optim.Adam(domain_classifier.parameters()),
+        "task_optimizer": optim.Adam(task_classifier.parameters()),
+    }
+    return DannTrainer(data, network, num_epochs=1, device="cpu", is_single_backward=is_single_backward)
+
+
+def _get_gradients(trainer):
+    trainer.adaptation_factor = trainer.adaptation_factors[-1]
+    batch = next(zip(*[trainer.data[name] for name in trainer.loader_names]))
+    loss, losses = trainer.compute_losses(batch)
+    trainer.backward(loss, losses)
+    modules = {
+        "feature_extractor": trainer.feature_extractor,
+        "domain_classifier": trainer.domain_classifier,
+        "task_classifier": trainer.task_classifier,
+    }
+    return {
+        f"{module_name}.{name}": param.grad
+        for module_name, module in modules.items()
+        for name, param in module.named_parameters()
+    }
+
+
+@pytest.mark.parametrize("output_size", [1, 6])
+def test_single_backward_gradient_parity(output_size):
+    gradients = _get_gradients(_get_trainer(output_size, is_single_backward=True))
+    two_backward_gradients = _get_gradients(_get_trainer(output_size, is_single_backward=False))
+    assert gradients.keys() == two_backward_gradients.keys()
+    for name, gradient in two_backward_gradients.items():
+        torch.testing.assert_close(gradients[name], gradient, rtol=1e-4, atol=1e-6, msg=name)
@@ -0,0 +1,40 @@
+import pytest
+import torch
+from torch import nn
+
+from domain_invariant_learning.algo.jdot_algo import get_pseudo_task_loss_mat
+
+
+def _get_pseudo_task_loss_mat_expanded(pred_y_task, y_task):
+    """
+    Former JDOT construction, (N, M, C) expansion + nn.CrossEntropyLoss, as the reference of equivalence.
+    """
+    if pred_y_task.dim() == 1:
+        pred_y_task = torch.cat([(1 - pred_y_task).reshape(-1, 1), pred_y_task.reshape(-1, 1)], dim=1)
+    N, C = pred_y_task.shape
+    M = len(y_task)
+    pred_y_task = pred_y_task.unsqueeze(0).expand(M, -1, -1)
+    y_task = y_task.unsqueeze(1).expand(-1, N)
+    loss_mat = nn.CrossEntropyLoss(reduction="none")(pred_y_task.reshape(-1, C), y_task.reshape(-1).to(torch.long))
+    return loss_mat.reshape(M, N).T
+
+
+@pytest.mark.parametrize("num_classes", [1, 10])
+@pytest.mark.parametrize("batch_size", [1, 32, 128])
+def test_pseudo_task_loss_mat_parity(num_classes, batch_size):
+    torch.manual_seed(0)
+    logits = torch.randn(batch_size, num_classes)
+    if num_classes == 1:
+        pred_y_task = torch.sigmoid(logits).reshape(-1).requires_grad_()
+        y_task = torch.randint(0, 2, (batch_size + 1,))
+    else:
+        pred_y_task = torch.softmax(logits, dim=1).requires_grad_()
+        y_task = torch.randint(0, num_classes, (batch_size + 1,))
+
+    loss_mat = get_pseudo_task_loss_mat(pred_y_task, y_task)
+    (grad,) = torch.autograd.grad(loss_mat.sum(), pred_y_task)
+    loss_mat_expanded = _get_pseudo_task_loss_mat_expanded(pred_y_task, y_task)
+    (grad_expanded,) = torch.autograd.grad(loss_mat_expanded.sum(), pred_y_task)
+    assert loss_mat.shape == (batch_size, batch_size + 1)
+    torch.testing.assert_close(loss_mat, loss_mat_expanded)
+    torch.testing.assert_close(grad, grad_expanded)
@@ -0,0 +1,71 @@
+import pytest
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from domain_invariant_learning.utils import rv_utils, utils
+
+
+class FakeModel:
+    """
+    Scores a candidate the way the models do, apply_free_params overrides num_epochs with the epoch budget.
+    """
+
+    def __init__(self):
+        self.experiment = "fake"
+        self.num_epochs = 300
+        self.batch_size = 32
+        self.grl_gamma = 10
+        self.budgets = []
+
+    def _get_RV_score(self, param):
+        rv_utils.apply_free_params(self, [], param)
+        self.budgets.append(self.num_epochs)
+        return param["lr"] + param["weight_decay"]
+
+
+@pytest.mark.parametrize("search", ["grid", "halving"])
+def test_search_free_params_restores_model(search):
+    model = FakeModel()
+    rv_utils.search_free_params(
+        model, "_get_RV_score", [{"lr": 0.001, "num_epochs": 5}], search=search, num_candidates=9, seed=0
+    )
+    assert (model.num_epochs, model.batch_size, model.grl_gamma) == (300, 32, 10)
+
+
+def test_search_free_params_halving_budgets():
+    model = FakeModel()
+    RV_scores = rv_utils.search_free_params(
+        model, "_get_RV_score", [], search="halving", num_candidates=81, min_epochs=10, eta=3, seed=0
+    )
+    # 81, 27, 9 and 3 candidates, with 300 // 27, 300 // 9, 300 // 3 and 300 epochs
+    assert model.budgets == [11] * 81 + [33] * 27 + [100] * 9 + [300] * 3
+    assert len(RV_scores["free_params"]) == len(RV_scores["scores"]) == 3
+
+
+class CountingDataset(Dataset):
+    def __init__(self):
+        self.data = torch.arange(20, dtype=torch.float32).reshape(10, 2)
+        self.targets = torch.arange(10)
+        self.num_reads = 0
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, idx):
+        self.num_reads += 1
+        return self.data[idx], self.targets[idx]
+
+
+def test_RV_cache_key_of_lazy_views_reads_no_samples():
+    dataset = CountingDataset()
+    view = utils.DatasetView.from_dataset(dataset)
+    assert isinstance(view, utils.LazyDatasetView)
+    model = FakeModel()
+
+    def get_key(view):
+        return rv_utils.get_RV_cache_key(model, "_get_RV_score", [], {"loader": DataLoader(view, batch_size=4)})
+
+    key = get_key(view.subview(slice(0, 5)))
+    assert key == get_key(view.subview(slice(0, 5)))
+    assert key != get_key(view.subview(slice(5, 10)))
+    assert dataset.num_reads == 0
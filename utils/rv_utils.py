@@ -0,0 +1,362 @@
+import hashlib
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import weakref
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from absl import flags
+from torch.utils.data import DataLoader, Dataset, Subset, TensorDataset
+
+from .utils import DatasetView, LazyDatasetView
+
+FLAGS = flags.FLAGS
+RV_CACHE_STATS = {"hits": 0, "misses": 0}
+# fingerprints of the base datasets of LazyDatasetViews, hashed once instead of loading the views every RV sweep
+DATASET_FINGERPRINTS = weakref.WeakKeyDictionary()
+RV_SEARCHES = ["grid", "halving"]
+# seed of the search when caching, so that a rerun samples the same candidates and hits the cache
+RV_CACHE_SEED = 0
+OPTIMIZER_PARAM_NAMES = ["lr", "eps", "weight_decay"]
+# batch_size is relative to the default batch size of the model, grl_gamma is gamma of get_adaptation_factors
+RV_SEARCH_SPACE = {
+    "lr": [0.00001, 0.00003, 0.0001, 0.0003, 0.001],
+    "weight_decay": [0, 0.00001, 0.0001],
+    "batch_size": [0.5, 1, 2],
+    "grl_gamma": [5, 10, 20],
+}
+
+
+def get_RV_options():
+    """
+    RV options of the experiment flags, to be passed to search_free_params.
+    """
+    return {
+        "search": FLAGS.RV_search,
+        "num_candidates": FLAGS.RV_num_candidates,
+        "min_epochs": FLAGS.RV_min_epochs,
+        "eta": FLAGS.RV_eta,
+        "num_workers": FLAGS.num_RV_workers,
+        "cache_dir": FLAGS.RV_cache_dir,
+        "is_cache_invalidated": FLAGS.is_RV_cache_invalidated,
+    }
+
+
+def search_free_params(
+    model,
+    score_method_name,
+    free_params,
+    search="grid",
+    num_candidates=27,
+    min_epochs=10,
+    eta=3,
+    seed=None,
+    epoch_names=("num_epochs",),
+    **kwargs,
+):
+    """
+    "grid" scores every candidate of free_params with the full epochs of model.
+    "halving" samples num_candidates from RV_SEARCH_SPACE instead and runs successive halving: every rung scores
+    the candidates with an epoch budget, keeps the best 1 / eta of them and multiplies the budget by eta,
+    from min_epochs up to the epochs of model, and stops once one candidate would be left.
+    https://arxiv.org/abs/1502.07943
+
+    Parameters
+    ----------
+    seed : int or None
+        RV_CACHE_SEED if None and kwargs has a cache_dir, drawn from the torch RNG otherwise.
+    epoch_names : tuple of str
+        attributes of model that score_method trains for, e.g. ("num_epochs_dim2", "num_epochs_dim1")
+        when it fits the 2nd dim and then the reverse classifier of the 1st dim.
+        The first one sets the number of rungs, every one is divided by the same power of eta in a rung.
+
+    Returns
+    -------
+    RV_scores : dict
+        "free_params" (without the epoch budgets), "scores" of the last rung, to choose the best param from.
+    """
+    if search not in RV_SEARCHES:
+        raise ValueError(f"RV_search should be one of {RV_SEARCHES}, got {search}")
+    if seed is None and kwargs.get("cache_dir") is not None:
+        seed = RV_CACHE_SEED
+    elif seed is None:
+        seed = int(torch.randint(2 ** 31 - 1, ()).item())
+    # scoring a candidate overrides attributes of model (apply_free_params), so the config of the cache key,
+    # the full epochs of the budgets and the attributes restored after the search are all read before it
+    config = get_RV_config(model)
+    full_epochs = {name: getattr(model, name) for name in epoch_names}
+    names = {*epoch_names, *RV_SEARCH_SPACE, *(name for param in free_params for name in param)}
+    attributes = {name: getattr(model, name) for name in names - set(OPTIMIZER_PARAM_NAMES) if hasattr(model, name)}
+    try:
+        if search == "grid":
+            return get_RV_scores(model, score_method_name, free_params, seed=seed, config=config, **kwargs)
+
+        candidates = sample_free_params(model, num_candidates, seed)
+        num_rungs = max(math.floor(math.log(full_epochs[epoch_names[0]] / min_epochs, eta)), 0) + 1
+        for rung in range(num_rungs):
+            budget = {name: max(epochs // eta ** (num_rungs - 1 - rung), 1) for name, epochs in full_epochs.items()}
+            RV_scores = get_RV_scores(
+                model,
+                score_method_name,
+                [{**param, **budget} for param in candidates],
+                seed=seed + rung * num_candidates,
+                config=config,
+                **kwargs,
+            )
+            num_kept = max(math.ceil(len(candidates) / eta), 1)
+            if rung == num_rungs - 1 or num_kept == 1:
+                break
+            ranks = sorted(range(len(candidates)), key=lambda i: RV_scores["scores"][i], reverse=True)
+            candidates = [candidates[i] for i in ranks[:num_kept]]
+        return {"free_params": candidates, "scores": RV_scores["scores"]}
+    finally:
+        for name, value in attributes.items():
+            setattr(model, name, value)
+
+
+def get_best_free_params(RV_scores):
+    """
+    The candidate of the best RV score.
+    """
+    scores = RV_scores["scores"]
+    return dict(RV_scores["free_params"][max(range(len(scores)), key=scores.__getitem__)])
+
+
+def sample_free_params(model, num_candidates, seed):
+    """
+    Returns
+    -------
+    free_params : list of dict
+        num_candidates distinct points of RV_SEARCH_SPACE (all of them if fewer), batch_size made absolute.
+    """
+    grid = [dict(zip(RV_SEARCH_SPACE, values)) for values in itertools.product(*RV_SEARCH_SPACE.values())]
+    free_params = random.Random(seed).sample(grid, min(num_candidates, len(grid)))
+    for param in free_params:
+        param["batch_size"] = max(int(model.batch_size * param["batch_size"]), 1)
+        param["eps"] = 1e-08
+    return free_params
+
+
+def apply_free_params(model, optimizers, param):
+    """
+    Optimizer params go to the param groups of optimizers, the others (batch_size, grl_gamma, epoch budgets)
+    override the attributes of model.
+    """
+    optimizer_param = {name: value for name, value in param.items() if name in OPTIMIZER_PARAM_NAMES}
+    for optimizer in optimizers:
+        optimizer.param_groups[0].update(optimizer_param)
+    for name, value in param.items():
+        if name not in OPTIMIZER_PARAM_NAMES:
+            setattr(model, name, value)
+
+
+def rebatch(loader, batch_size):
+    """
+    loader itself if it already has batch_size, otherwise a shuffled loader of the same dataset.
+    """
+    if loader.batch_size == batch_size:
+        return loader
+    return DataLoader(loader.dataset, batch_size=batch_size, shuffle=True)
+
+
+def get_RV_scores(
+    model,
+    score_method_name,
+    free_params,
+    num_workers=1,
+    seed=None,
+    cache_dir=None,
+    is_cache_invalidated=False,
+    config=None,
+    **kwargs,
+):
+    """
+    Reverse validation score of every candidate of free_params, serially or one worker process per candidate.
+    Every candidate is seeded with seed + its index, so that the scores do not depend on the other candidates
+    nor on num_workers, and the parallel scores are the same as the serial ones.
+
+    Parameters
+    ----------
+    model : DannsBase, Danns2D or IsihDanns
+        workers rebuild it by type(model)(model.experiment) with the initial_state of model.
+    score_method_name : str
+        method of model, score_method(param, **kwargs) trains from scratch with param and returns the RV accuracy.
+    free_params : list of dict
+    num_workers : int
+        the number of worker processes, the intra-op threads of this process are split between them.
+    seed : int or None
+        drawn from the torch RNG if None.
+    cache_dir : str or None
+        directory of the RV results keyed by get_RV_cache_key, a hit skips every candidate. No cache if None.
+    is_cache_invalidated : bool
+        recompute and overwrite the cached result.
+    config : dict or None
+        config of model in the cache key, get_RV_config(model) if None.
+    **kwargs
+        data of score_method, picklable (tensors are shared with the workers by torch.multiprocessing).
+
+    Returns
+    -------
+    RV_scores : dict
+        "free_params": free_params, "scores": list of float in the same order.
+    """
+    if seed is None:
+        seed = int(torch.randint(2 ** 31 - 1, ()).item())
+    if cache_dir is not None:
+        cache_key = get_RV_cache_key(model, score_method_name, free_params, kwargs, config)
+        cache_path = os.path.join(cache_dir, f"{cache_key}.json")
+        if os.path.exists(cache_path) and not is_cache_invalidated:
+            RV_CACHE_STATS["hits"] += 1
+            with open(cache_path) as f:
+                return json.load(f)
+        RV_CACHE_STATS["misses"] += 1
+    num_workers = min(num_workers, len(free_params))
+    if num_workers <= 1:
+        scores = [
+            _get_RV_score(model, score_method_name, param, seed + i, kwargs) for i, param in enumerate(free_params)
+        ]
+    else:
+        num_threads = max(torch.get_num_threads() // num_workers, 1)
+        with ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(sys.argv, num_threads),
+        ) as executor:
+            futures = [
+                executor.submit(
+                    _get_RV_score_in_worker,
+                    type(model),
+                    model.experiment,
+                    model.initial_state,
+                    score_method_name,
+                    param,
+                    seed + i,
+                    kwargs,
+                )
+                for i, param in enumerate(free_params)
+            ]
+            scores = [future.result() for future in futures]
+    RV_scores = {"free_params": list(free_params), "scores": scores}
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(f"{cache_path}.tmp", "w") as f:
+            json.dump(RV_scores, f)
+        os.replace(f"{cache_path}.tmp", cache_path)
+    return RV_scores
+
+
+def get_RV_config(model):
+    """
+    Attributes of model of plain types, its device and algo_name.
+    """
+    config = {name: value for name, value in vars(model).items() if isinstance(value, (bool, int, float, str))}
+    config["device"] = str(getattr(model, "device", None))
+    config["algo_name"] = FLAGS["algo_name"].value if "algo_name" in FLAGS else None
+    return config
+
+
+def get_RV_cache_key(model, score_method_name, free_params, data, config=None):
+    """
+    sha256 of everything the RV scores depend on: the train/val data, the model class, its config
+    (get_RV_config(model) if None), algo_name and the free_params grid.
+    """
+    if config is None:
+        config = get_RV_config(model)
+    sha256 = hashlib.sha256()
+    sha256.update(f"{type(model).__module__}.{type(model).__qualname__}.{score_method_name}".encode())
+    sha256.update(json.dumps(config, sort_keys=True).encode())
+    sha256.update(json.dumps(free_params, sort_keys=True).encode())
+    _update_fingerprint(sha256, data)
+    return sha256.hexdigest()
+
+
+def get_RV_cache_report():
+    """
+    Returns
+    -------
+    report : str
+        cache hits over the RV sweeps of this process.
+    """
+    num_sweeps = RV_CACHE_STATS["hits"] + RV_CACHE_STATS["misses"]
+    hit_rate = RV_CACHE_STATS["hits"] / num_sweeps * 100 if num_sweeps else 0
+    return f"RV cache: {RV_CACHE_STATS['hits']} hits / {num_sweeps} sweeps ({hit_rate:.1f}%)"
+
+
+def _update_fingerprint(sha256, obj):
+    if isinstance(obj, torch.Tensor):
+        obj = obj.detach().cpu().contiguous()
+        sha256.update(f"{obj.dtype}{tuple(obj.shape)}".encode())
+        sha256.update(obj.reshape(-1).view(torch.uint8).numpy().tobytes())
+    elif isinstance(obj, DataLoader):
+        sha256.update(f"DataLoader{obj.batch_size}".encode())
+        _update_fingerprint(sha256, obj.dataset)
+    elif isinstance(obj, LazyDatasetView):
+        sha256.update(_get_dataset_fingerprint(obj.dataset).encode())
+        _update_fingerprint(sha256, obj.indices)
+    elif isinstance(obj, DatasetView):
+        _update_fingerprint(sha256, [obj.X, obj.y])
+    elif isinstance(obj, Subset):
+        _update_fingerprint(sha256, torch.as_tensor(obj.indices))
+        _update_fingerprint(sha256, obj.dataset)
+    elif isinstance(obj, TensorDataset):
+        _update_fingerprint(sha256, list(obj.tensors))
+    elif isinstance(obj, dict):
+        for key in sorted(obj):
+            sha256.update(str(key).encode())
+            _update_fingerprint(sha256, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            _update_fingerprint(sha256, item)
+    else:
+        sha256.update(repr(obj).encode())
+
+
+def _get_dataset_fingerprint(dataset):
+    """
+    sha256 of the class of dataset and of its attributes of tensors, arrays, plain types and nested datasets
+    (e.g. MNIST wrapped by a dataset adding the domain labels), transforms excluded.
+    """
+    if dataset not in DATASET_FINGERPRINTS:
+        sha256 = hashlib.sha256(f"{type(dataset).__module__}.{type(dataset).__qualname__}".encode())
+        for name, value in sorted(vars(dataset).items()):
+            if isinstance(value, np.ndarray):
+                value = torch.as_tensor(value)
+            if isinstance(value, Dataset):
+                sha256.update(f"{name}{_get_dataset_fingerprint(value)}".encode())
+            elif isinstance(value, (torch.Tensor, list, tuple, bool, int, float, str)):
+                sha256.update(name.encode())
+                _update_fingerprint(sha256, value)
+        DATASET_FINGERPRINTS[dataset] = sha256.hexdigest()
+    return DATASET_FINGERPRINTS[dataset]
+
+
+def _get_RV_score(model, score_method_name, param, seed, kwargs):
+    # the RNG of the caller, e.g. of the shuffling of the later loaders, is left as is
+    with torch.random.fork_rng():
+        torch.manual_seed(seed)
+        return getattr(model, score_method_name)(param, **kwargs)
+
+
+def _get_RV_score_in_worker(model_class, experiment, initial_state, score_method_name, param, seed, kwargs):
+    """
+    score_method resets the model first, to the initial state of the model of the main process as in serial runs.
+    """
+    model = model_class(experiment)
+    model.initial_state = initial_state
+    return _get_RV_score(model, score_method_name, param, seed, kwargs)
+
+
+def _init_worker(argv, num_threads):
+    """
+    Spawned workers re-import the experiment module, which defines the flags, but do not parse them.
+    """
+    if not FLAGS.is_parsed():
+        FLAGS(argv, known_only=True)
+    torch.set_num_threads(num_threads)
@@ -1,13 +1,17 @@
+import resource
+import warnings
+
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
 from sklearn.datasets import make_moons
 from sklearn.manifold import TSNE
-from torch.utils.data import DataLoader, Subset, TensorDataset
+from torch.utils.data import DataLoader, Dataset, Subset, TensorDataset
 
 DEVICE = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 COL_IDX_TASK = 0
 COL_IDX_DOMAIN = 1
+PREDICT_CHUNK_SIZE = 1024
 
 
 def get_source_target_from_make_moons(n_samples=100, noise=0.05, rotation_degree=-30):
@@ -227,12 +231,208 @@ def visualize_tSNE(target_feature, source_feature):
     plt.show()
 
 
+class DatasetView(Dataset):
+    """
+    (X, y) samples at indices of the storage tensors, without copying them.
+    indices is a slice, whose .X / .y are views of the storage, or an index tensor, gathered only when accessed.
+    """
+
+    def __init__(self, tensors, indices=None):
+        self.tensors = tuple(tensors)
+        self.indices = slice(0, self.tensors[0].shape[0], 1) if indices is None else indices
+
+    @classmethod
+    def from_dataset(cls, ds, batch_size=1024):
+        """
+        View of ds sharing the storage of TensorDataset, Subset of it or DatasetView ds.
+        Other datasets (e.g. of transformed images) are indexed lazily by a LazyDatasetView instead of being loaded.
+        """
+        if isinstance(ds, DatasetView):
+            return ds
+        elif isinstance(ds, TensorDataset):
+            return DatasetView(ds.tensors)
+        elif isinstance(ds, Subset):
+            return DatasetView.from_dataset(ds.dataset, batch_size).subview(torch.as_tensor(ds.indices))
+        return LazyDatasetView(ds, batch_size=batch_size)
+
+    @classmethod
+    def from_loader(cls, loader):
+        return cls.from_dataset(loader.dataset, batch_size=loader.batch_size or 1024)
+
+    @property
+    def device(self):
+        return self.tensors[0].device
+
+    @property
+    def X(self):
+        return self.tensors[0][self.indices]
+
+    @property
+    def y(self):
+        return self.tensors[1][self.indices]
+
+    def subview(self, indices):
+        """
+        View of the samples at indices (slice or index tensor) of this view, on the same storage.
+        """
+        return DatasetView(self.tensors, self._get_storage_indices(indices))
+
+    def _get_storage_indices(self, indices):
+        if isinstance(self.indices, torch.Tensor):
+            return self.indices[indices]
+        if isinstance(indices, torch.Tensor):
+            return indices.to(self.device) * self.indices.step + self.indices.start
+        positions = range(self.indices.start, self.indices.stop, self.indices.step)[indices]
+        if isinstance(positions, range) and positions.step < 0:
+            return torch.tensor(positions, device=self.device)
+        elif isinstance(positions, range):
+            return slice(positions.start, positions.stop, positions.step)
+        return positions
+
+    def __getitem__(self, idx):
+        storage_idx = self._get_storage_indices(idx)
+        return tuple(tensor[storage_idx] for tensor in self.tensors)
+
+    def __len__(self):
+        if isinstance(self.indices, torch.Tensor):
+            return self.indices.shape[0]
+        return len(range(self.indices.start, self.indices.stop, self.indices.step))
+
+
+class LazyDatasetView(DatasetView):
+    """
+    (X, y) samples at indices of a dataset that is not tensor-like (e.g. MNIST with transforms), without loading it.
+    Samples are read from the dataset by __getitem__, .X / .y load the samples of the view by batch_size when accessed.
+    """
+
+    def __init__(self, dataset, indices=None, batch_size=1024):
+        self.dataset = dataset
+        self.indices = slice(0, len(dataset), 1) if indices is None else indices
+        self.batch_size = batch_size
+
+    @property
+    def device(self):
+        return torch.device("cpu")
+
+    @property
+    def X(self):
+        return self._load(0)
+
+    @property
+    def y(self):
+        return self._load(1)
+
+    def _load(self, position):
+        if isinstance(self.indices, torch.Tensor):
+            storage_indices = self.indices.tolist()
+        else:
+            storage_indices = range(self.indices.start, self.indices.stop, self.indices.step)
+        batches = DataLoader(Subset(self.dataset, storage_indices), batch_size=self.batch_size)
+        return torch.cat([batch[position] for batch in batches], dim=0)
+
+    def subview(self, indices):
+        return LazyDatasetView(self.dataset, self._get_storage_indices(indices), self.batch_size)
+
+    def __getitem__(self, idx):
+        return self.dataset[int(self._get_storage_indices(idx))]
+
+
 def tensordataset_to_splitted_loaders(ds, batch_size):
-    N_dataset = len(ds)
-    train_idx = [i for i in range(0, N_dataset // 2, 1)]
-    val_idx = [i for i in range(N_dataset // 2, N_dataset, 1)]
-    train_ds = Subset(ds, train_idx)
-    val_ds = Subset(ds, val_idx)
+    """
+    The first and the second halves of ds as contiguous DatasetViews, train and val loaders of them.
+    """
+    view = DatasetView.from_dataset(ds)
+    N_dataset = len(view)
+    train_ds = view.subview(slice(0, N_dataset // 2))
+    val_ds = view.subview(slice(N_dataset // 2, N_dataset))
     train_loader = DataLoader(train_ds, batch_size=batch_size, shuffle=True)
     val_loader = DataLoader(val_ds, batch_size=batch_size, shuffle=True)
     return train_loader, val_loader
+
+
+def compile_with_fallback(fn, **compile_kwargs):
+    """
+    torch.compile fn, and fall back to eager fn from then on when compilation or the compiled call fails.
+
+    Parameters
+    ----------
+    fn : callable
+    **compile_kwargs
+        passed to torch.compile.
+
+    Returns
+    -------
+    wrapped_fn : callable
+    """
+    state = {"compiled_fn": torch.compile(fn, **compile_kwargs)}
+
+    def wrapped_fn(*args, **kwargs):
+        if state["compiled_fn"] is not None:
+            try:
+                return state["compiled_fn"](*args, **kwargs)
+            except Exception as e:  # pylint: disable=broad-except
+                warnings.warn(f"torch.compile failed, falling back to eager mode: {e}")
+                state["compiled_fn"] = None
+        return fn(*args, **kwargs)
+
+    return wrapped_fn
+
+
+def predict_in_chunks(predict_fn, X, chunk_size=None, max_memory_mb=None, is_compiled=False):
+    """
+    Run predict_fn over X chunk by chunk under torch.inference_mode,
+    streaming the outputs into a preallocated tensor, so that no autograd graph is built
+    and peak memory is bounded by one chunk.
+
+    Parameters
+    ----------
+    predict_fn : callable
+        maps torch.Tensor of shape(n, ...) to torch.Tensor of shape(n, ...).
+    X : torch.Tensor of shape(N, ...)
+    chunk_size : int or None
+        the number of samples per chunk, PREDICT_CHUNK_SIZE when both chunk_size and max_memory_mb are None.
+    max_memory_mb : float or None
+        memory budget of an input chunk in MB, used to derive chunk_size when chunk_size is None.
+    is_compiled : bool
+        run predict_fn with torch.compile, the ragged last chunk is padded so that every call has the same shape.
+
+    Returns
+    -------
+    out : torch.Tensor of shape(N, ...)
+    Allocated outside inference mode, so it can be used as a label of later training.
+    """
+    N = X.shape[0]
+    if chunk_size is None:
+        if max_memory_mb is None:
+            chunk_size = PREDICT_CHUNK_SIZE
+        else:
+            bytes_per_sample = X[0].numel() * X.element_size() if N > 0 else 1
+            chunk_size = max(int(max_memory_mb * 2 ** 20) // bytes_per_sample, 1)
+
+    chunk_size = min(chunk_size, max(N, 1))
+    if is_compiled:
+        predict_fn = compile_with_fallback(predict_fn, dynamic=False)
+
+    out = None
+    for start in range(0, max(N, 1), chunk_size):
+        X_chunk = X[start : start + chunk_size]
+        num_chunk = X_chunk.shape[0]
+        if is_compiled and (0 < num_chunk < chunk_size):
+            X_pad = X_chunk[-1:].expand(chunk_size - num_chunk, *X_chunk.shape[1:])
+            X_chunk = torch.cat([X_chunk, X_pad], dim=0)
+        with torch.inference_mode():
+            out_chunk = predict_fn(X_chunk)[:num_chunk]
+        if out is None:
+            out = torch.empty((N, *out_chunk.shape[1:]), dtype=out_chunk.dtype, device=out_chunk.device)
+        out[start : start + out_chunk.shape[0]] = out_chunk
+    return out
+
+
+def get_peak_rss_mb():
+    """
+    Returns
+    -------
+    peak_rss_mb : float
+    peak resident set size of this process in MB.
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024